@@ -3,30 +3,49 @@ module: backend.app
 description: This module contains the FastAPI application for the AI Assistant.
 author: Karim Garba
 date_created: 08-04-25
-date_modified: 08-04-25
+date_modified: 17-10-26
 last_modified_by: Karim Garba
-version: 0.1
+version: 0.3
 """
+import asyncio
+import hashlib
 import os
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional, Dict, Any
 import uuid
+import json
 from dotenv import load_dotenv
 
-from services.db_handler import DatabaseHandler
+# Load environment variables before the services read their settings
+load_dotenv()
+
+from services import metrics
+from services.db_handler import DatabaseHandler, encode_cursor
 from services.ai_handler import AIHandler
+from services.quotas import QuotaExceededError
+from services.request_tracker import RequestCancelledError
+from services.scheduler import PRIORITIES, QueueFullError
 
-# Load environment variables
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the background services without waiting for the database or Ollama, and stop them on shutdown"""
+    ai_handler.start()
+    yield
+    # Stop refreshing the model catalog and write any queued messages
+    await ai_handler.stop()
+    await db_handler.run_async(db_handler.stop_writer)
 
 # Initialize FastAPI app
 app = FastAPI(
     title="AI Assistant API",
     description="API for interacting with the AI Assistant",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -38,6 +57,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def record_request_metrics(request: Request, call_next):
+    """Count requests per route and add a Server-Timing header when enabled"""
+    started_at = time.perf_counter()
+    timings = {}
+    token = metrics.request_timings.set(timings) if metrics.SERVER_TIMING else None
+    try:
+        response = await call_next(request)
+    finally:
+        if token is not None:
+            metrics.request_timings.reset(token)
+
+    elapsed = time.perf_counter() - started_at
+    route = request.scope.get("route")
+    route_path = route.path if route else "unmatched"
+    metrics.HTTP_REQUESTS.inc(request.method, route_path, response.status_code)
+    metrics.HTTP_DURATION.observe(elapsed, request.method, route_path)
+    if metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.format_server_timing(timings, elapsed)
+    return response
+
+# The middleware is only installed when it has something to record
+if metrics.ENABLED or metrics.SERVER_TIMING:
+    app.middleware("http")(record_request_metrics)
+
 # Database connection
 db_path = os.getenv("DB_PATH", "data/assistant.db")
 db_handler = DatabaseHandler(db_path=db_path)
@@ -45,11 +88,26 @@ db_handler = DatabaseHandler(db_path=db_path)
 # AI Handler
 ai_handler = AIHandler(db_handler=db_handler)
 
+# Messages read per query when streaming a full session history
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+
 # Pydantic models
 class MessageRequest(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     prompt: str
     system_prompt: Optional[str] = None
     session_id: Optional[str] = None
+    # The frontend sends the selected model as "model_name"
+    model: Optional[str] = Field(None, alias="model_name")
+    stream: bool = False
+    options: Optional[Dict[str, Any]] = None
+    cache: bool = True
+    # Chosen by the client so it can cancel the request before any response arrives
+    request_id: Optional[str] = None
+    timeout: Optional[float] = None
+    # "batch" lets chat requests of other clients go first
+    priority: str = "interactive"
 
 class ModelRequest(BaseModel):
     model_name: str
@@ -74,84 +132,378 @@ async def root(request: Request):
     print(f"Request received at root: {request.client.host}")
     return {"status": "online", "message": "AI Assistant API is running"}
 
+@app.get("/api/ready")
+async def readiness():
+    """Report whether the database is open and the model catalog loaded, with a 503 until both are"""
+    status = ai_handler.readiness()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
 @app.get("/api/models")
-async def get_models():
-    """Get available AI models"""
-    models = ai_handler.get_models()
-    return {"models": models}
+async def get_models(request: Request, details: bool = False):
+    """Get available AI models, optionally with their metadata"""
+    registry = ai_handler.model_registry
+    models = await registry.list_models()
+    if details:
+        content = {"models": await asyncio.gather(*(registry.get_details(model["name"]) for model in models))}
+        # Hashed from the payload, the details of a model change once ollama.show answers for it
+        etag = f'"{hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()}"'
+    else:
+        content = {"models": [model["name"] for model in models]}
+        etag = f'"{registry.etag}"' if registry.etag else None
+    if etag and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=content, headers={"ETag": etag} if etag else None)
+
+@app.get("/api/models/{model_name:path}")
+async def get_model_details(model_name: str):
+    """Get the metadata of an AI model"""
+    details = await ai_handler.model_registry.get_details(model_name)
+    if not details:
+        raise HTTPException(status_code=404, detail=f"Model {model_name} is not available.")
+    return details
 
 @app.post("/api/models/select")
 async def select_model(request: ModelRequest):
     """Select an AI model"""
     try:
-        ai_handler.set_model(request.model_name)
+        await ai_handler.set_model(request.model_name)
         return {"status": "success", "model": request.model_name}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+def cancelled_response(active_request, session_id: str):
+    """Build the final message of a cancelled request, with the part of the response generated so far"""
+    return {
+        "response": active_request.partial,
+        "session_id": session_id,
+        "request_id": active_request.request_id,
+        "cancelled": True,
+        "reason": active_request.reason,
+        "done": True,
+    }
+
+async def stream_lines(*lines):
+    """Stream fixed JSON lines"""
+    for line in lines:
+        yield json.dumps(line) + "\n"
+
+async def cancel_on_disconnect(http_request: Request, active_request):
+    """Cancel a request once its client disconnects"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            active_request.cancel("disconnected")
+            return
+
+def get_client(http_request: Request):
+    """Identify the client a request is counted against, by API key or IP address"""
+    return ai_handler.quotas.identify(http_request.headers, http_request.client.host if http_request.client else None)
+
+def record_usage(client: str, active_request):
+    """Count the tokens generated for a request against the quota of its client, before the request is finished"""
+    flight = active_request.flight
+    if flight:
+        ai_handler.quotas.record_tokens(client, flight.timings.get("eval_count") or len(flight.chunks))
+
+async def stream_chat(http_request: Request, tokens, first_token: Optional[str], session, active_request, client: str):
+    """
+    Forwards tokens from the model to the client as newline-delimited JSON.
+    The upstream generation is closed as soon as the client disconnects or the request is cancelled.
+    """
+    session_id = session.session_id
+    try:
+        if first_token is not None:
+            yield json.dumps({"token": first_token}) + "\n"
+        async for token in tokens:
+            if await http_request.is_disconnected():
+                print(f"Client disconnected, cancelling generation for session {session_id}")
+                active_request.cancel("disconnected")
+                break
+            yield json.dumps({"token": token}) + "\n"
+        else:
+            yield json.dumps({"done": True, "session_id": session_id, "request_id": active_request.request_id, "timings": session.last_timings}) + "\n"
+    except RequestCancelledError:
+        yield json.dumps(cancelled_response(active_request, session_id)) + "\n"
+    except Exception as e:
+        print(f"Error streaming response: {e}")
+        yield json.dumps({"error": str(e), "done": True, "session_id": session_id}) + "\n"
+    finally:
+        await tokens.aclose()
+        record_usage(client, active_request)
+        active_request.finish()
+
 @app.post("/api/chat")
-async def generate_response(request: MessageRequest):
+async def generate_response(request: MessageRequest, http_request: Request):
     """Generate a response from the AI model"""
     print(f"Chat request received: {request}")
+    active_request = None
+    client = get_client(http_request)
     try:
+        if request.priority not in PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+        # Rejected before any work is done for a client over its quota
+        quota_headers = ai_handler.quotas.acquire(client)
+
+        # Each request carries its own session, a new one is started if none is provided
+        session = await ai_handler.get_chat_session(request.session_id)
+
         # Ensure a model is selected
-        if not ai_handler.current_model:
-            raise HTTPException(status_code=400, detail="No model selected. Please select a model before generating a response.")
-        
-        # Set session if provided
-        if request.session_id:
-            ai_handler.set_session_id(request.session_id)
-        
-        # Generate response
-        response = ai_handler.generate_response(request.prompt, request.system_prompt)
-        
-        return {
+        try:
+            model = await ai_handler.resolve_model(request.model, session)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Registered for cancellation, with a deadline from the request and the model
+        try:
+            active_request = ai_handler.requests.open(session.session_id, model, request.timeout, request.request_id)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        headers = {"X-Request-Id": active_request.request_id, **quota_headers}
+
+        if request.stream:
+            tokens = ai_handler.stream_response(
+                request.prompt, request.system_prompt, session.session_id, request.model, request.options, active_request,
+                request.priority
+            )
+            # Wait for the first token so queueing errors are still reported with a proper status code
+            try:
+                first_token = await active_request.run(tokens.__anext__())
+            except StopAsyncIteration:
+                first_token = None
+            except RequestCancelledError:
+                await tokens.aclose()
+                active_request.finish()
+                return StreamingResponse(
+                    stream_lines(cancelled_response(active_request, session.session_id)),
+                    media_type="application/x-ndjson",
+                    headers=headers
+                )
+            except BaseException:
+                await tokens.aclose()
+                raise
+            # The response now owns the request and finishes it when the stream ends
+            streamed_request, active_request = active_request, None
+            return StreamingResponse(
+                stream_chat(http_request, tokens, first_token, session, streamed_request, client),
+                media_type="application/x-ndjson",
+                headers=headers
+            )
+
+        # Generate response, cancelled if the client goes away before it is ready
+        watcher = asyncio.create_task(cancel_on_disconnect(http_request, active_request))
+        try:
+            response = await active_request.run(ai_handler.generate_response(
+                request.prompt, request.system_prompt, session.session_id, request.model, request.options, request.cache, active_request,
+                request.priority
+            ))
+        except RequestCancelledError:
+            return JSONResponse(content=cancelled_response(active_request, session.session_id), headers=headers)
+        finally:
+            watcher.cancel()
+
+        return JSONResponse(content={
             "response": response,
-            "session_id": ai_handler.current_session_id
-        }
+            "session_id": session.session_id,
+            "request_id": active_request.request_id,
+            "timings": session.last_timings
+        }, headers=headers)
     except HTTPException:
         raise
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after), **e.headers})
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if active_request:
+            record_usage(client, active_request)
+            active_request.finish()
+
+@app.post("/api/chat/{request_id}/cancel")
+async def cancel_chat(request_id: str):
+    """Cancel a chat request in progress, stopping its generation and freeing its slot"""
+    if not ai_handler.cancel_request(request_id):
+        raise HTTPException(status_code=404, detail="Request not found or already finished")
+    return {"status": "cancelled", "request_id": request_id}
+
+def parse_batch_lines(body: bytes):
+    """Parse a JSONL body into batch items, invalid lines become None and are reported as failed items"""
+    items = []
+    for line in body.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError:
+            items.append(None)
+    return items
+
+async def stream_batch(header: dict, results):
+    """Stream the batch header and results as JSON lines"""
+    try:
+        yield json.dumps(header) + "\n"
+        async for result in results:
+            yield json.dumps(result) + "\n"
+    finally:
+        await results.aclose()
+
+@app.post("/api/batch")
+async def run_batch(
+    http_request: Request,
+    job_id: Optional[str] = None,
+    concurrency: Optional[int] = Query(None, ge=1, le=64)
+):
+    """Run a JSONL file of prompts and stream the results back as JSONL as they complete.
+    Sending the same file with the job_id of an interrupted run resumes it."""
+    client = get_client(http_request)
+    try:
+        # A job counts as one request, its items wait for the token quota to refill as they go
+        quota_headers = ai_handler.quotas.acquire(client)
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after), **e.headers})
+
+    items = parse_batch_lines(await http_request.body())
+    if not items:
+        raise HTTPException(status_code=400, detail="The request body must contain one JSON object per line.")
+
+    results = ai_handler.run_batch(items, job_id, concurrency, client)
+    header = await results.__anext__()
+    return StreamingResponse(
+        stream_batch(header, results),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Job-Id": header["job_id"], **quota_headers}
+    )
+
+@app.get("/api/batch/{job_id}")
+async def get_batch_results(job_id: str):
+    """Get the stored results of a batch job"""
+    try:
+        results = await ai_handler.get_batch_results(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not results:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    completed = sum(1 for result in results if result["status"] == "completed")
+    return {"job_id": job_id, "completed": completed, "failed": len(results) - completed, "results": results}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose the request, generation and database metrics in the Prometheus text format"""
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/scheduler")
+async def get_scheduler_stats():
+    """Get slot usage, queue depth and wait times per model, how many requests shared a generation, the requests in progress, the client quotas and the leases of the shared state"""
+    return {
+        "models": ai_handler.scheduler.stats(),
+        "coalescing": ai_handler.single_flight.stats(),
+        "requests": ai_handler.requests.stats(),
+        "quotas": ai_handler.quotas.stats(),
+        "state": ai_handler.state.stats()
+    }
+
+@app.get("/api/quota")
+async def get_quota(http_request: Request):
+    """Get the remaining request and token quota of the caller, without using any of it"""
+    client = get_client(http_request)
+    headers = ai_handler.quotas.headers(client)
+    return JSONResponse(content={"client": client, "enabled": ai_handler.quotas.enabled, "quota": headers}, headers=headers)
+
+@app.get("/api/backends")
+async def get_backends():
+    """Get the health, load and loaded models of each Ollama server"""
+    return {"backends": ai_handler.client.stats()}
+
+@app.get("/api/cache")
+async def get_cache_stats():
+    """Get the hit and miss counters of the response cache and the conversation cache"""
+    return {"cache": ai_handler.response_cache.stats(), "sessions": ai_handler.sessions.stats()}
+
+@app.get("/api/maintenance")
+async def get_maintenance_stats():
+    """Get the retention and archival settings, what the database maintenance did so far and the size of the database"""
+    storage = await ai_handler.db_handler.run_async(ai_handler.db_handler.get_storage_stats)
+    return {"maintenance": ai_handler.maintenance.stats(), "storage": storage}
+
+@app.post("/api/maintenance/run")
+async def run_maintenance():
+    """Run the database maintenance now instead of waiting for the next periodic run"""
+    try:
+        result = await ai_handler.maintenance.run_once()
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    if result is None:
+        return JSONResponse(content={"error": "The database maintenance is already running"}, status_code=409)
+    return {"result": result}
 
 @app.get("/api/sessions")
-async def get_sessions():
+async def get_sessions(limit: Optional[int] = Query(None, ge=1, le=1000), before: Optional[str] = None):
+    """Get chat session summaries, newest first, optionally one page at a time"""
     try:
-        # Remove the await - get_sessions() is not an async function
-        sessions = ai_handler.get_sessions()
-        return JSONResponse(content={"sessions": sessions})
+        sessions = await ai_handler.get_sessions(limit, before)
+        next_cursor = encode_cursor(sessions[-1]) if limit and len(sessions) == limit else None
+        return JSONResponse(content={"sessions": sessions, "next_cursor": next_cursor})
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+async def stream_session_history(session: dict, session_id: str):
+    """
+    Serializes a full session history as JSON one batch of messages at a time,
+    so long histories are never loaded into memory at once.
+    """
+    yield '{"session": ' + json.dumps(session) + ', "messages": ['
+    after = None
+    separator = ''
+    while True:
+        messages = await db_handler.run_async(db_handler.get_chat_messages_after, session_id, after, HISTORY_BATCH_SIZE)
+        if messages:
+            yield separator + ', '.join(json.dumps(message) for message in messages)
+            separator = ', '
+        if len(messages) < HISTORY_BATCH_SIZE:
+            break
+        after = (messages[-1]["created_at"], messages[-1]["id"])
+    yield ']}'
+
 @app.get("/api/sessions/{session_id}")
-async def get_session(session_id: str):
-    """Get a specific chat session"""
+async def get_session(session_id: str, limit: Optional[int] = Query(None, ge=1, le=1000), before: Optional[str] = None):
+    """Get a specific chat session with its messages, optionally one page of the latest messages at a time"""
     try:
-        session = ai_handler.get_session(session_id)
+        session = await ai_handler.get_session(session_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
+
+        if limit is None:
+            return StreamingResponse(stream_session_history(session, session_id), media_type="application/json")
         
-        # Get messages for this session
-        messages = db_handler.get_chat_history(session_id)
+        # Get a page of messages for this session
+        messages, next_cursor = await db_handler.run_async(db_handler.get_chat_messages_page, session_id, limit, before)
         
         return {
             "session": session,
-            "messages": messages
+            "messages": messages,
+            "next_cursor": next_cursor
         }
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/sessions/clear")
-async def clear_session():
-    """Clear the current session"""
+async def clear_session(session_id: Optional[str] = None):
+    """Clear a session and start a new one"""
     try:
-        ai_handler.clear_chat_history()
+        new_session_id = await ai_handler.clear_chat_history(session_id)
         return {
             "status": "success", 
-            "session_id": ai_handler.current_session_id
+            "session_id": new_session_id
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -167,7 +519,7 @@ async def create_session(request: dict):
             raise HTTPException(status_code=400, detail="Session ID and model name are required")
         
         # Add session to database
-        db_handler.add_chat_session(session_id, model_name)
+        await db_handler.run_async(db_handler.add_chat_session, session_id, model_name)
         
         return {"status": "success", "session_id": session_id}
     except Exception as e:
@@ -177,17 +529,35 @@ async def create_session(request: dict):
 async def create_memory(request: MemoryRequest):
     """Create a memory from a chat session"""
     try:
-        db_handler.add_memory(request.session_id, request.name)
-        return {"status": "success", "message": "Memory created"}
+        memory_id = await ai_handler.add_memory(request.session_id, request.name)
+        return {"status": "success", "message": "Memory created", "id": memory_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/memories")
-async def get_memories():
-    """Get all memories"""
+async def get_memories(session_id: Optional[str] = None, limit: Optional[int] = Query(None, ge=1, le=1000), before: Optional[str] = None):
+    """Get memories, optionally for one session and one page at a time"""
+    try:
+        memories = await db_handler.run_async(db_handler.get_memories, session_id, limit, before)
+        next_cursor = encode_cursor(memories[-1]) if limit and len(memories) == limit else None
+        return {"memories": memories, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/search")
+async def search(
+    q: str,
+    scope: str = Query("all", pattern="^(all|messages|memories)$"),
+    session_id: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0)
+):
+    """Search chat history and memories, best matches first"""
     try:
-        memories = db_handler.get_memories()
-        return {"memories": memories}
+        results = await db_handler.run_async(db_handler.search, q, scope, session_id, limit, offset)
+        return {"query": q, "limit": limit, "offset": offset, **results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
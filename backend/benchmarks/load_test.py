@@ -0,0 +1,374 @@
+"""
+module: backend.benchmarks.load_test
+description: This module drives the API with concurrent simulated users against a mock Ollama server and reports
+latency percentiles, throughput, database write rates and database method latencies.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+
+Usage, from the backend directory:
+    python -m benchmarks.load_test --users 32 --duration 30
+    python -m benchmarks.load_test --users 32 --duration 30 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.mock_ollama import start_server
+from benchmarks.mock_redis import start_server as start_redis_server
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, fraction):
+    """
+    Computes a percentile with the nearest-rank method.
+    Args:
+        values (list): The sorted values.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+    Returns:
+        float: The percentile, or 0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def free_port():
+    """
+    Finds a free TCP port on the loopback interface.
+    Returns:
+        int: The port.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_mix(text):
+    """
+    Parses the operation mix, e.g. "chat=6,sessions=2,history=2".
+    Args:
+        text (str): The mix.
+    Returns:
+        dict: A mapping of operation to weight.
+    """
+    mix = {}
+    for pair in text.split(","):
+        name, _, weight = pair.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+class SimulatedUser:
+    """
+    This class plays one user: it chats in its own session and browses sessions and history in between.
+    """
+    def __init__(self, client, model, mix, stream_ratio, results, think_time):
+        """
+        Initializes the SimulatedUser class.
+        Args:
+            client (httpx.AsyncClient): The client connected to the API.
+            model (str): The model to chat with.
+            mix (dict): The operation weights.
+            stream_ratio (float): The share of chat requests that stream.
+            results (list): Shared list the (operation, latency, ok, ttft) tuples are appended to.
+            think_time (float): Seconds to pause between requests.
+        """
+        self.client = client
+        self.model = model
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.stream_ratio = stream_ratio
+        self.results = results
+        self.think_time = think_time
+        self.session_id = None
+        self.turn = 0
+
+    async def run(self, deadline):
+        """
+        Sends requests until the deadline.
+        Args:
+            deadline (float): The monotonic time to stop at.
+        """
+        while time.monotonic() < deadline:
+            operation = random.choices(self.operations, self.weights)[0]
+            if operation != "chat" and self.session_id is None:
+                operation = "chat"
+            if operation == "chat" and random.random() < self.stream_ratio:
+                operation = "chat_stream"
+
+            started_at = time.monotonic()
+            ttft = None
+            try:
+                ttft = await getattr(self, operation)()
+                ok = True
+            except Exception:
+                ok = False
+            self.results.append((operation, time.monotonic() - started_at, ok, ttft))
+            if self.think_time:
+                await asyncio.sleep(random.uniform(0, 2 * self.think_time))
+
+    def chat_payload(self, stream):
+        self.turn += 1
+        return {
+            "prompt": f"Question {self.turn}: explain topic {random.randint(1, 10_000)} in a few sentences.",
+            "session_id": self.session_id,
+            "model": self.model,
+            "stream": stream,
+        }
+
+    async def chat(self):
+        response = await self.client.post("/api/chat", json=self.chat_payload(False))
+        response.raise_for_status()
+        self.session_id = response.json()["session_id"]
+
+    async def chat_stream(self):
+        started_at = time.monotonic()
+        ttft = None
+        async with self.client.stream("POST", "/api/chat", json=self.chat_payload(True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                part = json.loads(line)
+                if ttft is None and "token" in part:
+                    ttft = time.monotonic() - started_at
+                if part.get("done"):
+                    self.session_id = part["session_id"]
+                if part.get("error"):
+                    raise RuntimeError(part["error"])
+        return ttft
+
+    async def sessions(self):
+        response = await self.client.get("/api/sessions", params={"limit": 20})
+        response.raise_for_status()
+
+    async def history(self):
+        response = await self.client.get(f"/api/sessions/{self.session_id}", params={"limit": 50})
+        response.raise_for_status()
+
+def count_rows(db_path):
+    """
+    Counts the sessions and messages written to the benchmark database.
+    Args:
+        db_path (str): The database path.
+    Returns:
+        dict: The row counts, empty if the database cannot be read.
+    """
+    try:
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as connection:
+            return {
+                "sessions": connection.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0],
+                "messages": connection.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0],
+            }
+    except sqlite3.Error:
+        return {}
+
+def parse_db_metrics(text):
+    """
+    Extracts the mean execution time of each DatabaseHandler method from the /metrics exposition.
+    Args:
+        text (str): The Prometheus text exposition.
+    Returns:
+        dict: A mapping of method name to (calls, mean seconds).
+    """
+    sums, counts = {}, {}
+    for name, method, value in re.findall(r'assistant_db_query_seconds_(sum|count)\{method="([^"]+)"\} (\S+)', text):
+        (sums if name == "sum" else counts)[method] = float(value)
+    return {method: (int(counts[method]), sums.get(method, 0.0) / counts[method]) for method in counts if counts[method]}
+
+def summarize(results, elapsed):
+    """
+    Computes latency percentiles and throughput per operation.
+    Args:
+        results (list): The (operation, latency, ok, ttft) tuples.
+        elapsed (float): The duration of the run in seconds.
+    Returns:
+        dict: The statistics per operation and in total.
+    """
+    summary = {}
+    for operation in sorted({result[0] for result in results}) + ["total"]:
+        selected = [result for result in results if operation in ("total", result[0])]
+        latencies = sorted(result[1] for result in selected if result[2])
+        ttfts = sorted(result[3] for result in selected if result[3] is not None)
+        summary[operation] = {
+            "requests": len(selected),
+            "errors": sum(1 for result in selected if not result[2]),
+            "throughput": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "ttft_p50": percentile(ttfts, 0.50) if ttfts else None,
+            "ttft_p95": percentile(ttfts, 0.95) if ttfts else None,
+        }
+    return summary
+
+def print_report(report):
+    """
+    Prints the benchmark report as tables.
+    Args:
+        report (dict): The report built by run_benchmark.
+    """
+    print(f"\n{report['users']} users on {report['workers']} worker(s) for {report['elapsed']:.1f}s\n")
+    print(f"{'operation':<14}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttft p50':>10}")
+    for operation, stats in report["operations"].items():
+        ttft = f"{stats['ttft_p50'] * 1000:.1f}" if stats["ttft_p50"] is not None else "-"
+        print(
+            f"{operation:<14}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>9.1f}"
+            f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{ttft:>10}"
+        )
+
+    writes = report["db_writes"]
+    if writes:
+        print(f"\nDatabase writes: {writes['messages']} messages ({writes['messages_per_second']:.1f}/s), "
+              f"{writes['sessions']} sessions ({writes['sessions_per_second']:.1f}/s)")
+    if report["db_methods"]:
+        print(f"\n{'db method':<30}{'calls':>10}{'mean ms':>10}")
+        for method, (calls, mean) in sorted(report["db_methods"].items(), key=lambda item: -item[1][0]):
+            print(f"{method:<30}{calls:>10}{mean * 1000:>10.2f}")
+
+async def drive(base_url, args):
+    """
+    Waits for the API, then runs the simulated users.
+    Args:
+        base_url (str): The base URL of the API.
+        args (argparse.Namespace): The command line arguments.
+    Returns:
+        tuple: The results, the elapsed time and the /metrics exposition.
+    """
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if (await client.get("/api/models")).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"The API at {base_url} did not start")
+            await asyncio.sleep(0.2)
+
+        results = []
+        mix = parse_mix(args.mix)
+        users = [SimulatedUser(client, args.model, mix, args.stream_ratio, results, args.think_time) for _ in range(args.users)]
+        started_at = time.monotonic()
+        await asyncio.gather(*(user.run(started_at + args.duration) for user in users))
+        elapsed = time.monotonic() - started_at
+
+        metrics_response = await client.get("/metrics")
+        metrics_text = metrics_response.text if metrics_response.status_code == 200 else ""
+        return results, elapsed, metrics_text
+
+def run_benchmark(args):
+    """
+    Starts the mock Ollama server and the API, runs the load and collects the report.
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    Returns:
+        dict: The report.
+    """
+    mock_server = None
+    redis_server = None
+    app_process = None
+    workdir = tempfile.mkdtemp(prefix="assistant-bench-")
+    db_path = os.path.join(workdir, "bench.db")
+    try:
+        if args.app_url:
+            base_url = args.app_url
+        else:
+            mock_server, ollama_url = start_server(
+                models=(args.model,), latency=args.latency, token_rate=args.token_rate, response_tokens=args.response_tokens
+            )
+            port = free_port()
+            env = dict(os.environ, OLLAMA_HOSTS=ollama_url, DB_PATH=db_path, METRICS_ENABLED="true")
+            env.setdefault("MEMORY_RETRIEVAL", "false")
+            if args.workers > 1:
+                # Workers share sessions and slots through the state backend, a stand-in Redis unless one is given
+                if args.state_url:
+                    env["STATE_BACKEND_URL"] = args.state_url
+                else:
+                    redis_server, env["STATE_BACKEND_URL"] = start_redis_server()
+            app_process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+                 "--workers", str(args.workers)],
+                cwd=BACKEND_DIR,
+                env=env,
+                stdout=subprocess.DEVNULL if not args.verbose else None,
+            )
+            base_url = f"http://127.0.0.1:{port}"
+
+        results, elapsed, metrics_text = asyncio.run(drive(base_url, args))
+    finally:
+        if app_process:
+            # SIGINT lets the app run its shutdown hooks, which write any queued messages
+            app_process.send_signal(signal.SIGINT)
+            try:
+                app_process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                app_process.kill()
+        if mock_server:
+            mock_server.shutdown()
+        if redis_server:
+            redis_server.shutdown()
+
+    rows = count_rows(db_path) if not args.app_url else {}
+    db_writes = {}
+    if rows:
+        db_writes = {
+            **rows,
+            "messages_per_second": rows["messages"] / elapsed,
+            "sessions_per_second": rows["sessions"] / elapsed,
+        }
+    return {
+        "users": args.users,
+        "workers": args.workers,
+        "elapsed": elapsed,
+        "operations": summarize(results, elapsed),
+        "db_writes": db_writes,
+        "db_methods": parse_db_metrics(metrics_text),
+    }
+
+def main():
+    """
+    Runs the load test from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Load test the AI Assistant API against a mock Ollama server")
+    parser.add_argument("--users", type=int, default=16, help="Concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run")
+    parser.add_argument("--mix", default="chat=6,sessions=2,history=2", help="Operation weights")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="Share of chat requests that stream")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between requests of a user, in seconds")
+    parser.add_argument("--model", default="mock")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock first-token latency, in seconds")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Mock tokens per second")
+    parser.add_argument("--response-tokens", type=int, default=64, help="Mock tokens per response")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout, in seconds")
+    parser.add_argument("--workers", type=int, default=1, help="Uvicorn worker processes")
+    parser.add_argument("--state-url", help="State backend shared by the workers, a stand-in Redis by default")
+    parser.add_argument("--app-url", help="Benchmark an API that is already running instead of starting one")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, for reproducible request sequences")
+    parser.add_argument("--verbose", action="store_true", help="Show the API output")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
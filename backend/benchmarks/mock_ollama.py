@@ -0,0 +1,229 @@
+"""
+module: backend.benchmarks.mock_ollama
+description: This module contains a fake Ollama HTTP server with a configurable first-token latency and token rate,
+so the API can be load tested without a GPU or a real model.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    This class answers the Ollama endpoints used by the application: chat, generate, embed, tags, ps and show.
+    """
+    # Configured on the subclass created by create_server
+    models = ("mock",)
+    latency = 0.05
+    token_rate = 200.0
+    response_tokens = 64
+    catalog_latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        """
+        Sends a JSON response.
+        Args:
+            payload (dict): The response body.
+            status (int): The HTTP status code.
+        """
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        """
+        Reads the JSON request body.
+        Returns:
+            dict: The request body, empty if there is none.
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def timings(self, prompt_tokens, eval_tokens, eval_seconds):
+        """
+        Builds the timing fields of a final response.
+        Args:
+            prompt_tokens (int): The number of prompt tokens.
+            eval_tokens (int): The number of generated tokens.
+            eval_seconds (float): The time spent generating.
+        Returns:
+            dict: The timing fields, durations in nanoseconds.
+        """
+        return {
+            "total_duration": int((self.latency + eval_seconds) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(self.latency * 1e9),
+            "eval_count": eval_tokens,
+            "eval_duration": int(eval_seconds * 1e9),
+        }
+
+    def do_GET(self):
+        if self.path in ("/api/tags", "/api/ps"):
+            # Simulates a daemon that is slow to answer, e.g. while it starts
+            time.sleep(self.catalog_latency)
+        if self.path == "/api/tags":
+            self.send_json({"models": [
+                {"model": name, "name": name, "size": 1, "digest": name, "details": {"family": "mock"}}
+                for name in self.models
+            ]})
+        elif self.path == "/api/ps":
+            self.send_json({"models": [{"model": name, "name": name} for name in self.models]})
+        elif self.path == "/api/version":
+            self.send_json({"version": "0.0.0-mock"})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        request = self.read_json()
+        if self.path == "/api/chat":
+            self.chat(request)
+        elif self.path == "/api/generate":
+            self.send_json({"model": request.get("model"), "response": "", "done": True, **self.timings(0, 0, 0)})
+        elif self.path == "/api/embed":
+            inputs = request.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            # Vectors derived from a digest of the text, so every run returns the same embeddings
+            embeddings = [[byte / 255 for byte in hashlib.md5(text.encode()).digest()] for text in inputs]
+            self.send_json({"model": request.get("model"), "embeddings": embeddings})
+        elif self.path == "/api/show":
+            self.send_json({"model_info": {"mock.context_length": 8192}, "capabilities": ["completion"]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def chat(self, request):
+        """
+        Answers a chat request, streaming one token at a time at the configured rate when asked to.
+        Args:
+            request (dict): The chat request.
+        """
+        if request.get("model") not in self.models:
+            self.send_json({"error": f"model '{request.get('model')}' not found"}, 404)
+            return
+
+        prompt_tokens = sum(len(message.get("content", "")) // 4 + 4 for message in request.get("messages", []))
+        num_predict = (request.get("options") or {}).get("num_predict") or self.response_tokens
+        tokens = min(self.response_tokens, num_predict)
+        interval = 1 / self.token_rate
+        time.sleep(self.latency)
+
+        if not request.get("stream", True):
+            time.sleep(tokens * interval)
+            self.send_json({
+                "model": request["model"],
+                "message": {"role": "assistant", "content": " ".join(f"tok{i}" for i in range(tokens))},
+                "done": True,
+                **self.timings(prompt_tokens, tokens, tokens * interval),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        started_at = time.monotonic()
+        try:
+            for i in range(tokens):
+                self.write_chunk({"model": request["model"], "message": {"role": "assistant", "content": f"tok{i} "}, "done": False})
+                # Sleep until the token is due, so the rate holds regardless of write time
+                time.sleep(max(0.0, started_at + (i + 1) * interval - time.monotonic()))
+            self.write_chunk({
+                "model": request["model"],
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                **self.timings(prompt_tokens, tokens, time.monotonic() - started_at),
+            })
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the generation
+            pass
+
+    def write_chunk(self, payload):
+        """
+        Writes one NDJSON line as an HTTP chunk.
+        Args:
+            payload (dict): The response part.
+        """
+        line = json.dumps(payload).encode() + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+def create_server(host="127.0.0.1", port=0, models=("mock",), latency=0.05, token_rate=200.0, response_tokens=64, catalog_latency=0.0):
+    """
+    Creates a mock Ollama server.
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+        models (tuple): The model names the server reports.
+        latency (float): Seconds before the first token.
+        token_rate (float): Tokens generated per second.
+        response_tokens (int): Tokens per response.
+        catalog_latency (float): Seconds before the model list and loaded models are returned.
+    Returns:
+        ThreadingHTTPServer: The server, not yet serving.
+    """
+    handler = type("ConfiguredMockOllamaHandler", (MockOllamaHandler,), {
+        "models": tuple(models),
+        "latency": latency,
+        "token_rate": token_rate,
+        "response_tokens": response_tokens,
+        "catalog_latency": catalog_latency,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_server(**kwargs):
+    """
+    Starts a mock Ollama server on a background thread.
+    Args:
+        **kwargs: The arguments of create_server.
+    Returns:
+        tuple: The server and its base URL.
+    """
+    server = create_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="mock-ollama", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+def main():
+    """
+    Runs the mock Ollama server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Fake Ollama server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", default="mock", help="Comma-separated model names")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Tokens per second")
+    parser.add_argument("--response-tokens", type=int, default=64, help="Tokens per response")
+    parser.add_argument("--catalog-latency", type=float, default=0.0, help="Seconds before the model list is returned")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.host, args.port, args.models.split(","), args.latency, args.token_rate, args.response_tokens, args.catalog_latency
+    )
+    print(f"Mock Ollama listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
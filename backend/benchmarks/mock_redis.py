@@ -0,0 +1,188 @@
+"""
+module: backend.benchmarks.mock_redis
+description: This module contains a stand-in Redis server implementing the commands used by the Redis state
+backend, so multi-worker deployments can be tested without installing Redis.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+class MockRedisHandler(socketserver.StreamRequestHandler):
+    """
+    This class answers PING, HELLO, GET, SET with NX, XX, EX and PX, INCR, INCRBY, DEL, PEXPIRE and FLUSHALL over RESP2
+    or RESP3. Other commands, such as the CLIENT SETINFO sent by redis-py on connect, get an error reply.
+    """
+    protocol = 2
+    disable_nagle_algorithm = True
+    # Shared by every connection: key -> (value, expires_at or None)
+    data = {}
+    lock = threading.Lock()
+
+    def read_command(self):
+        """
+        Reads one command, either a RESP array of bulk strings or an inline command.
+        Returns:
+            list: The command and its arguments, or None when the client disconnected.
+        """
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode().split()
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2].decode())
+        return arguments
+
+    def reply(self, value):
+        """
+        Writes a reply.
+        Args:
+            value: None for a null, an int for an integer, an Exception for an error, True for OK, a dict for a map, or a string.
+        """
+        if value is None:
+            payload = b"_\r\n" if self.protocol == 3 else b"$-1\r\n"
+        elif isinstance(value, dict):
+            payload = (b"%%%d\r\n" if self.protocol == 3 else b"*%d\r\n") % (len(value) * (1 if self.protocol == 3 else 2))
+            for key, item in value.items():
+                for element in (key, item):
+                    encoded = str(element).encode()
+                    payload += b"$%d\r\n%s\r\n" % (len(encoded), encoded)
+        elif value is True:
+            payload = b"+OK\r\n"
+        elif isinstance(value, Exception):
+            payload = f"-ERR {value}\r\n".encode()
+        elif isinstance(value, int):
+            payload = f":{value}\r\n".encode()
+        else:
+            encoded = value.encode()
+            payload = b"$%d\r\n%s\r\n" % (len(encoded), encoded)
+        self.wfile.write(payload)
+
+    def lookup(self, key):
+        """
+        Retrieves a live value, dropping it if it expired.
+        Args:
+            key (str): The key.
+        Returns:
+            str: The value, or None.
+        """
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0] if entry else None
+
+    def execute(self, name, arguments):
+        """
+        Runs a command.
+        Args:
+            name (str): The command in upper case.
+            arguments (list): The arguments.
+        Returns:
+            The reply, see reply.
+        """
+        if name == "PING":
+            return "PONG"
+        if name == "HELLO":
+            if arguments and arguments[0] not in ("2", "3"):
+                return ValueError("NOPROTO unsupported protocol version")
+            if arguments:
+                self.protocol = int(arguments[0])
+            return {"server": "mock-redis", "version": "7.0.0", "proto": self.protocol, "mode": "standalone"}
+        if name == "GET":
+            return self.lookup(arguments[0])
+        if name == "SET":
+            key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+            expires_at = None
+            if "PX" in options:
+                expires_at = time.monotonic() + int(arguments[2 + options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires_at = time.monotonic() + int(arguments[2 + options.index("EX") + 1])
+            exists = self.lookup(key) is not None
+            if ("NX" in options and exists) or ("XX" in options and not exists):
+                return None
+            self.data[key] = (value, expires_at)
+            return True
+        if name in ("INCR", "INCRBY"):
+            value = int(self.lookup(arguments[0]) or 0) + (int(arguments[1]) if name == "INCRBY" else 1)
+            expires_at = self.data.get(arguments[0], (None, None))[1]
+            self.data[arguments[0]] = (str(value), expires_at)
+            return value
+        if name == "DEL":
+            return sum(1 for key in arguments if self.lookup(key) is not None and self.data.pop(key))
+        if name == "PEXPIRE":
+            value = self.lookup(arguments[0])
+            if value is None:
+                return 0
+            self.data[arguments[0]] = (value, time.monotonic() + int(arguments[1]) / 1000)
+            return 1
+        if name == "FLUSHALL":
+            self.data.clear()
+            return True
+        return ValueError(f"unknown command '{name}'")
+
+    def handle(self):
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            if not command:
+                continue
+            with self.lock:
+                try:
+                    result = self.execute(command[0].upper(), command[1:])
+                except (IndexError, ValueError) as e:
+                    result = e
+            self.reply(result)
+            self.wfile.flush()
+
+
+class MockRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_server(host="127.0.0.1", port=0):
+    """
+    Starts a stand-in Redis server on a background thread.
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+    Returns:
+        tuple: The server and its redis:// URL.
+    """
+    handler = type("IsolatedMockRedisHandler", (MockRedisHandler,), {"data": {}, "lock": threading.Lock()})
+    server = MockRedisServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-redis", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"redis://{host}:{port}/0"
+
+def main():
+    """
+    Runs the stand-in Redis server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Stand-in Redis server for multi-worker tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+
+    server = MockRedisServer((args.host, args.port), MockRedisHandler)
+    print(f"Mock Redis listening on redis://{args.host}:{args.port}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+module: backend.benchmarks.startup
+description: This module measures how quickly a worker starts: the import time of the application, the time
+until it answers requests and the time until it reports ready, against a fast, slow or unreachable Ollama.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+
+Usage, from the backend directory:
+    python -m benchmarks.startup --runs 5 --catalog-latency 3
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_test import BACKEND_DIR, free_port, percentile
+from benchmarks.mock_ollama import start_server
+
+IMPORT_SNIPPET = "import time; started_at = time.perf_counter(); import app; print(time.perf_counter() - started_at)"
+
+def measure_import(env):
+    """
+    Measures the time to import the application module in a fresh interpreter.
+    Args:
+        env (dict): The environment of the interpreter.
+    Returns:
+        float: The import time in seconds.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+def wait_for(client, path, deadline, statuses=(200,)):
+    """
+    Polls an endpoint until it answers with one of the expected statuses.
+    Args:
+        client (httpx.Client): The client connected to the API.
+        path (str): The endpoint.
+        deadline (float): The monotonic time to give up at.
+        statuses (tuple): The statuses that end the wait.
+    Returns:
+        float: The monotonic time of the first expected answer, or None if the deadline passed.
+    """
+    while time.monotonic() < deadline:
+        try:
+            if client.get(path).status_code in statuses:
+                return time.monotonic()
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    return None
+
+def measure_startup(env, timeout):
+    """
+    Starts the API under uvicorn and measures when it first answers and when it is ready.
+    Args:
+        env (dict): The environment of the server.
+        timeout (float): Seconds to wait for readiness.
+    Returns:
+        dict: The seconds until the first answer of / and of /api/ready, None if it never became ready.
+    """
+    port = free_port()
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            deadline = started_at + timeout
+            live_at = wait_for(client, "/", deadline)
+            ready_at = wait_for(client, "/api/ready", deadline)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return {
+        "live": live_at - started_at if live_at else None,
+        "ready": ready_at - started_at if ready_at else None,
+    }
+
+def summarize(values):
+    """
+    Computes the median, p95 and maximum of the measurements that completed.
+    Args:
+        values (list): The measurements in seconds, None for runs that did not complete.
+    Returns:
+        dict: The statistics, and the number of runs that did not complete.
+    """
+    done = sorted(value for value in values if value is not None)
+    return {
+        "median": statistics.median(done) if done else None,
+        "p95": percentile(done, 0.95) if done else None,
+        "max": done[-1] if done else None,
+        "incomplete": len(values) - len(done),
+    }
+
+def main():
+    """
+    Runs the startup benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Measure the startup time of the AI Assistant API")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--catalog-latency", type=float, default=0.0, help="Seconds the mock Ollama takes to list models")
+    parser.add_argument("--ollama-down", action="store_true", help="Point the API at a port nothing listens on")
+    parser.add_argument("--reuse-db", action="store_true", help="Start every run on the database migrated by the first run")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for readiness")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    mock_server = None
+    if args.ollama_down:
+        ollama_url = f"http://127.0.0.1:{free_port()}"
+    else:
+        mock_server, ollama_url = start_server(catalog_latency=args.catalog_latency)
+
+    workdir = tempfile.mkdtemp(prefix="assistant-startup-")
+    results = {"import": [], "live": [], "ready": []}
+    try:
+        for run in range(args.runs):
+            db_path = os.path.join(workdir, "bench.db" if args.reuse_db else f"bench-{run}.db")
+            env = dict(os.environ, OLLAMA_HOSTS=ollama_url, DB_PATH=db_path)
+            results["import"].append(measure_import(env))
+            startup = measure_startup(env, args.timeout)
+            results["live"].append(startup["live"])
+            results["ready"].append(startup["ready"])
+    finally:
+        if mock_server:
+            mock_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {name: summarize(values) for name, values in results.items()}
+    print(f"\n{args.runs} runs, Ollama {'down' if args.ollama_down else f'listing models in {args.catalog_latency}s'}\n")
+    print(f"{'phase':<10}{'median ms':>12}{'p95 ms':>12}{'max ms':>12}{'incomplete':>12}")
+    for name, stats in report.items():
+        cells = "".join(f"{stats[key] * 1000:>12.1f}" if stats[key] is not None else f"{'-':>12}" for key in ("median", "p95", "max"))
+        print(f"{name:<10}{cells}{stats['incomplete']:>12}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"runs": args.runs, "results": results, "summary": report}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,102 @@ description: This module contains the AIHandler class, which is responsible for
 It includes methods for generating text completions using users selected AI model.
 author: Karim Garba
 date_created: 05-04-25
-date_modified: 08-04-25
+date_modified: 17-10-26
 last_modified_by: Karim Garba
-version: 0.1
+version: 0.15
 """
-import ollama
+import asyncio
+import functools
+import time
 import uuid
 import os
 
+from contextlib import asynccontextmanager, nullcontext
+
+from . import metrics
+from .backend_pool import BackendPool
+from .config import get_model_settings
+from .context_builder import ContextBuilder
 from .db_handler import DatabaseHandler
+from .maintenance import DatabaseMaintenance
+from .memory_index import MemoryIndex
+from .model_registry import ModelRegistry
+from .quotas import ClientQuotas
+from .request_tracker import RequestCancelledError, RequestTracker
+from .response_cache import ResponseCache, build_cache_key
+from .scheduler import InferenceScheduler, QueueFullError
+from .session_manager import ChatHistory, ChatSession, SessionRegistry
+from .single_flight import SingleFlight
+from .state_backend import create_state_backend
+
+# Enhanced code formatting guidance - works better with all models
+CODE_FORMATTING_GUIDANCE = """
+When providing code examples, properly format them using markdown code blocks with appropriate syntax highlighting.
+
+For Python code:
+```python
+def example_function():
+    return "Hello World"
+```
+
+For JavaScript code:
+```javascript
+function exampleFunction() {
+    return "Hello World";
+}
+```
+
+For other languages, use the appropriate language identifier after the triple backticks.
+Make sure to close all code blocks with triple backticks.
+"""
+
+MODEL_SPECIFIC_INSTRUCTIONS = {
+    "deepseek": """You are deepseek, an advanced AI assistant. Greet the user if greeted. Always provide detailed, helpful responses directly addressing the user's query. Don't hullicante and try to communicate how a human would to situations. Do not provide code formatting guidance unless the user requests it. The latest message is the priority task""",
+}
+
+# Ollama response fields reported back to clients, durations are in nanoseconds
+TIMING_FIELDS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+@functools.lru_cache(maxsize=256)
+def build_system_prompt(model, system_prompt=None):
+    """
+    Builds the system prompt from the formatting guidance, model-specific instructions and user instructions.
+    The result is identical byte for byte for the same (model, system_prompt) pair, so Ollama can
+    reuse the KV cache of the prompt prefix between turns and sessions.
+    Args:
+        model (str): The model the prompt is sent to.
+        system_prompt (str, optional): Additional instructions supplied by the user.
+    Returns:
+        str: The system prompt.
+    """
+    # Add the code formatting guidance to all responses, not just when "python" or "code" is mentioned
+    if system_prompt:
+        system_prompt += "\n" + CODE_FORMATTING_GUIDANCE
+    else:
+        system_prompt = CODE_FORMATTING_GUIDANCE
+
+    # Add model-specific instruction if available
+    if model.lower() in MODEL_SPECIFIC_INSTRUCTIONS:
+        system_prompt = MODEL_SPECIFIC_INSTRUCTIONS[model.lower()] + "\n" + system_prompt
+
+    return system_prompt
+
+def extract_timings(response):
+    """
+    Extracts the load and evaluation timings from a final Ollama chat response.
+    Args:
+        response (dict): The final chat response, or the last part of a stream.
+    Returns:
+        dict: The timing fields present in the response.
+    """
+    return {field: response[field] for field in TIMING_FIELDS if response.get(field) is not None}
 
 class AIHandler:
     """
@@ -24,168 +111,837 @@ class AIHandler:
         Args:
             db_handler (DatabaseHandler): An instance of the DatabaseHandler class.
         """
-        self.models = self.get_models()
+        # Ollama calls go through the async client so a long generation never blocks the event loop.
+        # The pool offers the same methods and routes each call to one of the servers in OLLAMA_HOSTS.
+        self.client = BackendPool()
+        self.model_registry = ModelRegistry(self.client)
+        # Model selection, session versions and inference slots, shared with the other workers when STATE_BACKEND_URL is set
+        self.state = create_state_backend()
+        # Default model for requests and sessions that do not name one
         self.current_model = None
-        self.chat_history = []
-        self.current_session_id = str(uuid.uuid4())
+        self.sessions = SessionRegistry()
+        self.scheduler = InferenceScheduler(state=self.state, backend_count=self.client.healthy_count)
+        self.context_builder = ContextBuilder()
+        # Keeps references to fire-and-forget tasks such as summary updates
+        self.background_tasks = set()
+        # Keep models loaded between requests so their KV cache survives idle periods
+        self.keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+        self.model_keep_alive = get_model_settings('OLLAMA_MODEL_KEEP_ALIVE')
+        # Response length unless the client asks otherwise, and the most a client may ask for, 0 for no limit
+        self.default_num_predict = int(os.getenv('DEFAULT_NUM_PREDICT', '4096'))
+        self.max_num_predict = int(os.getenv('MAX_NUM_PREDICT', '0'))
+        self.model_max_num_predict = get_model_settings('MODEL_MAX_NUM_PREDICT', int)
+        # Request and generated token rate limits per API key or IP address
+        self.quotas = ClientQuotas()
 
         if db_handler:
             self.db_handler = db_handler
         else:
             db_path = os.getenv('DB_PATH', 'assistant.db')
             self.db_handler = DatabaseHandler(db_path=db_path)
+        if self.state.shared and self.db_handler.durability == 'group':
+            # Queued messages would be invisible to the other workers until the next flush
+            print("DB_DURABILITY=group is not supported with a shared state backend, committing every message instead")
+            self.db_handler.durability = 'immediate'
 
-    def get_models(self):
+        self.memory_index = MemoryIndex(self.client, self.db_handler)
+        # Retention, archival and compaction of the chat database, deleted sessions are dropped from memory too
+        self.maintenance = DatabaseMaintenance(self.db_handler, state=self.state, on_delete=self.sessions.remove)
+        self.response_cache = ResponseCache(self.db_handler)
+        self.single_flight = SingleFlight()
+        # Requests in progress by ID, with their deadlines
+        self.requests = RequestTracker()
+        # Items of a batch job running at once, unless the job asks for another limit
+        self.batch_concurrency = int(os.getenv('BATCH_CONCURRENCY', '4'))
+        # Monotonic times of the application startup and of the moment it became ready
+        self.started_at = None
+        self.ready_at = None
+
+    def start(self):
         """
-        Retrieves the list of available AI models from the Ollama API.
-        Returns:
-            list: A list of available AI model names.
+        Starts the background services. Nothing here waits for I/O: the database and the model catalog
+        are initialized concurrently in the background, and requests arriving earlier initialize
+        what they need on demand.
+        """
+        self.started_at = time.monotonic()
+        self.client.start()
+        self.model_registry.start()
+        self.run_in_background(self.initialize())
+        self.run_in_background(self.preload_models())
+
+    async def initialize(self):
+        """
+        Opens the database while the model catalog loads, then starts the work that needs the database.
         """
         try:
-            models = ollama.list()
-            return [model.model for model in models.get("models", [])]
+            await self.db_handler.run_async(self.db_handler.initialize)
         except Exception as e:
-            print(f"Error retrieving models: {e}")
-            return []
+            print(f"Error initializing the database: {e}")
+            return
+        self.run_in_background(self.db_handler.run_search_backfill())
+        self.run_in_background(self.memory_index.load())
+        self.maintenance.start()
+
+        await self.model_registry.loaded.wait()
+        self.ready_at = time.monotonic()
+        print(f"AI Assistant ready in {self.ready_at - self.started_at:.3f}s")
+
+    async def stop(self):
+        """
+        Stops the background services.
+        """
+        await self.maintenance.stop()
+        await self.model_registry.stop()
+        await self.client.stop()
+        await self.state.close()
+
+    def readiness(self):
+        """
+        Reports whether the application can serve chat requests.
+        Returns:
+            dict: Whether the database is open and the model catalog loaded, and how long startup took.
+        """
+        database = self.db_handler.initialized
+        models = self.model_registry.loaded.is_set()
+        return {
+            "ready": database and models,
+            "database": database,
+            "models": models,
+            "healthy_backends": sum(1 for backend in self.client.backends if backend.healthy),
+            "startup_seconds": self.ready_at - self.started_at if self.ready_at and self.started_at else None,
+        }
+
+    async def get_models(self):
+        """
+        Retrieves the list of available AI models from the cached model catalog.
+        Returns:
+            list: A list of available AI model names.
+        """
+        return await self.model_registry.get_names()
         
     
-    def set_model(self, model_name):
+    async def set_model(self, model_name):
         """
         Sets the selected AI model.
         Args:
             model_name (str): The name of the model to set.
         """
-        if model_name in self.models:
+        if await self.model_registry.has_model(model_name):
             self.current_model = model_name
+            await self.state.set('current_model', model_name)
+            self.run_in_background(self.warmup_model(model_name))
         else:
             raise ValueError(f"Model {model_name} is not available.")
+
+    async def get_current_model(self):
+        """
+        Retrieves the default model, as last selected on any worker when the state backend is shared.
+        Returns:
+            str: The model name, or None if no model was selected.
+        """
+        if self.state.shared:
+            self.current_model = await self.state.get('current_model') or self.current_model
+        return self.current_model
+
+    def get_keep_alive(self, model):
+        """
+        Retrieves how long Ollama should keep a model loaded after a request.
+        Args:
+            model (str): The model name.
+        Returns:
+            str: A duration understood by Ollama, e.g. "30m" or "-1" to keep it loaded.
+        """
+        return self.model_keep_alive.get(model, self.keep_alive)
+
+    async def warmup_model(self, model):
+        """
+        Loads a model into memory ahead of the first request so users do not pay the cold load.
+        Args:
+            model (str): The model name.
+        Returns:
+            dict: The load timings reported by Ollama, or None if the model could not be loaded.
+        """
+        try:
+            # An empty prompt only loads the model
+            response = await self.client.generate(model=model, keep_alive=self.get_keep_alive(model))
+            timings = extract_timings(response)
+            metrics.observe_timings(model, timings)
+            print(f"Model {model} warmed up: {timings}")
+            return timings
+        except Exception as e:
+            print(f"Error warming up model {model}: {e}")
+            return None
+
+    async def preload_models(self, models=None):
+        """
+        Warms up the models listed in OLLAMA_PRELOAD_MODELS, or the given models.
+        Args:
+            models (list, optional): The model names to load.
+        """
+        if models is None:
+            models = [model.strip() for model in os.getenv('OLLAMA_PRELOAD_MODELS', '').split(',') if model.strip()]
+        await asyncio.gather(*(self.warmup_model(model) for model in models))
+
+    def run_in_background(self, coroutine):
+        """
+        Runs a coroutine as a background task and keeps a reference to it until it finishes.
+        Args:
+            coroutine (coroutine): The coroutine to run.
+        Returns:
+            asyncio.Task: The background task.
+        """
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
         
-    def clear_chat_history(self):
+    async def resolve_model(self, model_name=None, session=None):
+        """
+        Resolves the model for a request: the requested model, then the session's model, then the default model.
+        Args:
+            model_name (str, optional): The model named in the request.
+            session (ChatSession, optional): The chat session the request belongs to.
+        Returns:
+            str: The model to use.
+        """
+        if model_name:
+            if not await self.model_registry.has_model(model_name):
+                raise ValueError(f"Model {model_name} is not available.")
+            return model_name
+
+        if session and session.model:
+            return session.model
+
+        current_model = await self.get_current_model()
+        if not current_model:
+            raise ValueError("No model selected. Please select a model before generating a response.")
+        return current_model
+
+    async def get_chat_session(self, session_id=None):
+        """
+        Retrieves the in-memory state of a chat session, loading its history from the database on first use.
+        Args:
+            session_id (str, optional): The ID of the chat session. A new session is started when omitted.
+        Returns:
+            ChatSession: The chat session.
+        """
+        if not session_id:
+            return self.sessions.put(ChatSession(str(uuid.uuid4())))
+
+        session = self.sessions.lookup(session_id)
+        if session:
+            return session
+
+        session = ChatSession(session_id)
+        await self.load_session(session)
+        return self.sessions.put(session)
+
+    async def load_session(self, session):
+        """
+        Loads the model, history and summary of a session from the database.
+        Args:
+            session (ChatSession): The session to fill in.
+        """
+        # Read before the history, so a write landing in between makes the next sync reload again
+        version = await self.state.get(f"session:{session.session_id}:version") if self.state.shared else None
+        row, turns, summary = await self.db_handler.run_async(self.db_handler.load_chat_session, session.session_id)
+        session.model = row["model"] if row else session.model
+        session.chat_history = ChatHistory(turns)
+        session.persisted = row is not None
+        session.summary = summary["summary"] if summary else None
+        session.summarized_count = summary["summarized_count"] if summary else 0
+        session.version = version
+
+    async def sync_session(self, session):
         """
-        Clears the chat history.
+        Reloads a cached session if another worker changed it since it was loaded.
+        Args:
+            session (ChatSession): The session, with its lock held.
         """
-        self.chat_history = []
+        if self.state.shared and await self.state.get(f"session:{session.session_id}:version") != session.version:
+            await self.load_session(session)
 
-        self.current_session_id = str(uuid.uuid4())
-        if self.current_model:
-            self.db_handler.add_chat_session(self.current_session_id, self.current_model)
+    async def bump_session_version(self, session):
+        """
+        Records that a session changed, so other workers reload it before their next turn.
+        Args:
+            session (ChatSession): The session.
+        """
+        if self.state.shared:
+            session.version = str(await self.state.incr(f"session:{session.session_id}:version"))
 
-    def add_to_chat_history(self, role, content):
+    async def clear_chat_history(self, session_id=None):
         """
-        Adds a message to the chat history.
+        Clears the chat history by dropping the given session from memory and starting a new one.
         Args:
+            session_id (str, optional): The ID of the chat session to clear.
+        Returns:
+            str: The ID of the new chat session.
+        """
+        if session_id:
+            self.sessions.remove(session_id)
+
+        session = await self.get_chat_session()
+        if await self.get_current_model():
+            session.model = self.current_model
+            await self.db_handler.run_async(self.db_handler.add_chat_session, session.session_id, session.model)
+            session.persisted = True
+        return session.session_id
+
+    async def add_to_chat_history(self, session, role, content):
+        """
+        Adds a message to the chat history of a session.
+        Args:
+            session (ChatSession): The chat session.
             role (str): The role of the message sender (e.g., user, assistant).
             content (str): The message to add to the chat history.
         """
-        message = {
-            "role": role,
-            "content": content
-        }
-        self.chat_history.append(message)
+        session.chat_history.append(role, content)
+        # The history grew in place, keep the conversation cache within its memory limit
+        self.sessions.evict()
+        await self.persist_message(session, role, content)
 
-        if self.current_model:
-            self.db_handler.add_chat_session(self.current_session_id, self.current_model)
-            self.db_handler.add_chat_message(self.current_session_id, role, content)
+    async def set_session_model(self, session, model):
+        """
+        Switches a session to the model of its current turn, so a model named in a request overrides the stored one.
+        Args:
+            session (ChatSession): The chat session.
+            model (str): The model used for the turn.
+        """
+        if session.model == model:
+            return
+        if session.persisted:
+            await self.db_handler.run_async(self.db_handler.set_chat_session_model, session.session_id, model)
+        session.model = model
 
+    async def persist_message(self, session, role, content):
+        """
+        Stores a message of a session in the database, creating the session row first if needed.
+        Args:
+            session (ChatSession): The chat session.
+            role (str): The role of the message sender (e.g., user, assistant).
+            content (str): The message to store.
+        """
+        if session.model:
+            if not session.persisted:
+                await self.db_handler.run_async(self.db_handler.add_chat_session, session.session_id, session.model)
+                session.persisted = True
+            await self.db_handler.run_async(self.db_handler.add_chat_message, session.session_id, role, content)
+            await self.bump_session_version(session)
 
-    def set_session_id(self, session_id):
+    def save_partial_response(self, session, content, active_request=None):
         """
-        Sets the session ID for the current chat.
+        Keeps the part of a response generated before the request was cancelled.
+        The message is added to the history at once and stored in the background, since the
+        request may be unwinding from a cancellation that would interrupt the write.
         Args:
-            session_id (str): The session ID to set.
+            session (ChatSession): The chat session, with its lock held.
+            content (str): The partial response.
+            active_request (ActiveRequest, optional): The cancelled request, which reports the partial response.
         """
-        self.current_session_id = session_id
-        self.chat_history = self.db_handler.get_chat_history(session_id)
+        if active_request:
+            active_request.partial = content
+        if content and self.requests.persist_partial:
+            session.chat_history.append("assistant", content)
+            self.run_in_background(self.persist_message(session, "assistant", content))
 
-    
-    def generate_response(self, prompt, system_prompt=None):
+    def cancel_request(self, request_id):
         """
-        Generates a response from the AI model based on the provided prompt and chat history.
+        Cancels a chat request in progress. Its generation is stopped on the Ollama server and its
+        scheduler slot freed, unless identical requests are still reading it.
+        Args:
+            request_id (str): The ID of the request.
+        Returns:
+            bool: False if no such request is in progress.
         """
-        if not self.current_model:
-            raise ValueError("No model selected. Please select a model before generating a response.")
-        
-        self.add_to_chat_history("user", prompt)
-        messages = []
+        return self.requests.cancel(request_id)
 
-        # Enhanced code formatting guidance - works better with all models
-        code_formatting_guidance = """
-        When providing code examples, properly format them using markdown code blocks with appropriate syntax highlighting.
-        
-        For Python code:
-        ```python
-        def example_function():
-            return "Hello World"
-        ```
-        
-        For JavaScript code:
-        ```javascript
-        function exampleFunction() {
-            return "Hello World";
-        }
-        ```
-        
-        For other languages, use the appropriate language identifier after the triple backticks.
-        Make sure to close all code blocks with triple backticks.
+    def build_system_prompt(self, model, system_prompt=None):
         """
-        
-        # Add the code formatting guidance to all responses, not just when "python" or "code" is mentioned
-        if system_prompt:
-            system_prompt += "\n" + code_formatting_guidance
-        else:
-            system_prompt = code_formatting_guidance
-            
-        # Add model-specific instructions
-        model_specific_instructions = {
-            "deepseek": """You are deepseek, an advanced AI assistant. Greet the user if greeted. Always provide detailed, helpful responses directly addressing the user's query. Don't hullicante and try to communicate how a human would to situations. Do not provide code formatting guidance unless the user requests it. The latest message is the priority task""",
-        }
-        
-        # Add model-specific instruction if available
-        if self.current_model.lower() in model_specific_instructions:
-            if system_prompt:
-                system_prompt = model_specific_instructions[self.current_model.lower()] + "\n" + system_prompt
-            else:
-                system_prompt = model_specific_instructions[self.current_model.lower()]
+        Builds the system prompt from the formatting guidance, model-specific instructions and user instructions.
+        Args:
+            model (str): The model the prompt is sent to.
+            system_prompt (str, optional): Additional instructions supplied by the user.
+        Returns:
+            str: The system prompt.
+        """
+        return build_system_prompt(model, system_prompt)
 
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
+    def build_options(self, options=None, model=None):
+        """
+        Builds the generation options sent to Ollama from the defaults and the options of the request.
+        Args:
+            options (dict, optional): Options supplied by the client, e.g. temperature or seed.
+            model (str, optional): The model, whose cap in MODEL_MAX_NUM_PREDICT applies instead of MAX_NUM_PREDICT.
+        Returns:
+            dict: The generation options, with num_predict within the cap of the model.
+        """
+        options = {"num_predict": self.default_num_predict, **(options or {})}
+        cap = self.model_max_num_predict.get(model, self.max_num_predict)
+        num_predict = options["num_predict"]
+        # Negative values ask Ollama to generate until the context is full
+        if cap > 0 and (not isinstance(num_predict, (int, float)) or num_predict < 0 or num_predict > cap):
+            options["num_predict"] = cap
+        return options
 
-        for message in self.chat_history:
-            messages.append({"role": message["role"], "content": message["content"]})
-        
-        # Add model-specific handling and timeout protection
+    def build_messages(self, session, system_prompt=None, memories=None):
+        """
+        Builds the message list sent to the model from the system prompt and chat history,
+        keeping it within the model's token budget. Older turns are replaced by the session's
+        rolling summary, which is updated in the background once enough turns fall out of the window.
+        Args:
+            session (ChatSession): The chat session.
+            system_prompt (str, optional): Additional instructions supplied by the user.
+            memories (str, optional): Stored memories relevant to the latest message.
+        Returns:
+            list: A list of message dictionaries ready to be passed to ollama.chat.
+        """
+        messages, start = self.context_builder.build(
+            session.model,
+            self.build_system_prompt(session.model, system_prompt),
+            session.chat_history,
+            session.summary,
+            session.summarized_count,
+            memories
+        )
+
+        if self.context_builder.needs_summary(start, session.summarized_count) and not session.summarizing:
+            session.summarizing = True
+            self.run_in_background(self.update_summary(session, start))
+
+        return messages
+
+    async def update_summary(self, session, summarize_until):
+        """
+        Folds the messages that fell out of the context window into the session's rolling summary.
+        Args:
+            session (ChatSession): The chat session.
+            summarize_until (int): The index of the first message kept verbatim.
+        """
         try:
-            # Model-specific handling
-            if self.current_model.lower() == "deepseek":
-                return self.generate_deepseek_response(messages)
-            
-            # For all other models, use standard processing with timeout
-            response = ollama.chat(
-                model=self.current_model,
-                messages=messages,
-                options={"num_predict": 4096}  # Limit response length
+            new_messages = session.chat_history[session.summarized_count:summarize_until]
+            request = self.context_builder.build_summary_request(session.summary, new_messages)
+            # Summaries are housekeeping: as batch work they are served after queued chat requests and,
+            # unless the model has a single slot, never take its last one. They queue under their own key,
+            # since the scheduler runs one generation per session at a time and the turn that triggered
+            # the summary would otherwise wait for it
+            async with self.scheduler.slot(session.model, f"summary:{session.session_id}", "batch"):
+                response = await self.client.chat(
+                    model=session.model,
+                    messages=request,
+                    options={"num_predict": self.context_builder.summary_tokens},
+                    keep_alive=self.get_keep_alive(session.model)
+                )
+
+            metrics.observe_timings(session.model, extract_timings(response))
+            summary = response["message"]["content"].strip()
+            await self.db_handler.run_async(self.db_handler.save_session_summary, session.session_id, summary, summarize_until)
+            session.summary = summary
+            session.summarized_count = summarize_until
+            await self.bump_session_version(session)
+        except Exception as e:
+            print(f"Error updating summary for session {session.session_id}: {e}")
+        finally:
+            session.summarizing = False
+
+    @asynccontextmanager
+    async def session_turn(self, session, model):
+        """
+        Holds the session lock for one turn, so two requests cannot interleave their history.
+        With a shared state backend the lock is also leased across workers, and the history
+        is reloaded first if another worker changed it.
+        Args:
+            session (ChatSession): The chat session.
+            model (str): The model the turn is sent to.
+        Raises:
+            QueueFullError: If too many requests are already waiting for the session.
+        """
+        if session.waiting >= self.scheduler.max_session_queue:
+            raise QueueFullError(
+                f"Too many queued requests for session {session.session_id}.",
+                self.scheduler.get_queue(model).retry_after()
             )
-            
-            assistant_response = response["message"]["content"]
-            self.add_to_chat_history("assistant", assistant_response)
-            
+        session.waiting += 1
+        try:
+            await session.lock.acquire()
+        finally:
+            session.waiting -= 1
+        try:
+            async with self.state.lease(f"session:{session.session_id}", 1) if self.state.shared else nullcontext():
+                await self.sync_session(session)
+                yield
+        finally:
+            session.lock.release()
+
+    async def start_generation(self, session, prompt, messages, options, cache_key=None, priority="interactive"):
+        """
+        Attaches a turn to a generation, shared with identical requests already in flight.
+        The prompt, already in the in-memory history, is persisted once the generation has a slot
+        and dropped again if it could not be queued.
+        Args:
+            session (ChatSession): The chat session, with its lock held.
+            prompt (str): The user prompt.
+            messages (list): The message list built for the turn.
+            options (dict): The generation options.
+            cache_key (str, optional): The response cache key, when the response should be cached.
+            priority (str): The scheduler priority class of the generation.
+        Returns:
+            Flight: The generation.
+        Raises:
+            QueueFullError: If the model queue is full.
+        """
+        model = session.model
+        flight = self.single_flight.join(
+            cache_key or build_cache_key(model, options, messages),
+            lambda flight: self.run_generation(flight, model, session.session_id, messages, options, cache_key, priority)
+        )
+        try:
+            await flight.wait_started()
+        except BaseException:
+            session.chat_history.pop()
+            flight.detach()
+            raise
+        await self.persist_message(session, "user", prompt)
+        return flight
+
+    async def run_generation(self, flight, model, session_id, messages, options, cache_key=None, priority="interactive"):
+        """
+        Runs one upstream generation on a scheduler slot and publishes its tokens to the attached requests.
+        Args:
+            flight (Flight): The generation to publish to.
+            model (str): The model name.
+            session_id (str): The ID of the chat session that started the generation.
+            messages (list): The message list.
+            options (dict): The generation options.
+            cache_key (str, optional): The response cache key, when the response should be cached.
+            priority (str): The scheduler priority class of the generation.
+        """
+        started_at = time.monotonic()
+        first_token = True
+        try:
+            async with self.scheduler.slot(model, session_id, priority):
+                flight.start()
+                stream = await self.client.chat(
+                    model=model,
+                    messages=messages,
+                    options=options,
+                    keep_alive=self.get_keep_alive(model),
+                    stream=True
+                )
+                timings = {}
+                try:
+                    async for part in stream:
+                        content = part["message"]["content"]
+                        if content:
+                            if first_token:
+                                first_token = False
+                                metrics.TIME_TO_FIRST_TOKEN.observe(time.monotonic() - started_at, model)
+                                metrics.record_timing("ttft", time.monotonic() - started_at)
+                            flight.publish(content)
+                        if part.get("done"):
+                            timings = extract_timings(part)
+                finally:
+                    # Cancelling the generation closes the HTTP stream to Ollama, which stops it on the server
+                    await stream.aclose()
+        except asyncio.CancelledError:
+            metrics.GENERATIONS.inc(model, "cancelled")
+            flight.finish(error=RuntimeError("The generation was cancelled."))
+            raise
+        except QueueFullError as e:
+            metrics.GENERATIONS.inc(model, "rejected")
+            flight.finish(error=e)
+            return
+        except Exception as e:
+            metrics.GENERATIONS.inc(model, "failed")
+            flight.finish(error=e)
+            return
+
+        metrics.GENERATIONS.inc(model, "completed")
+        metrics.observe_timings(model, timings)
+        flight.finish(timings)
+        if cache_key:
+            self.run_in_background(self.response_cache.put(cache_key, model, "".join(flight.chunks), timings))
+
+    async def generate_response(self, prompt, system_prompt=None, session_id=None, model_name=None, options=None, use_cache=True, active_request=None, priority="interactive"):
+        """
+        Generates a response from the AI model based on the provided prompt and the session's chat history.
+        Deterministic requests (temperature 0 or a fixed seed) are answered from the response cache when possible,
+        and identical requests running at the same time share one generation.
+        Args:
+            prompt (str): The user prompt.
+            system_prompt (str, optional): Additional instructions supplied by the user.
+            session_id (str, optional): The ID of the chat session. A new session is started when omitted.
+            model_name (str, optional): The model to use instead of the session's or default model.
+            options (dict, optional): Generation options supplied by the client.
+            use_cache (bool): False to bypass the response cache.
+            active_request (ActiveRequest, optional): The request, to be run through ActiveRequest.run so it can be cancelled.
+            priority (str): The scheduler priority class, "interactive" or "batch".
+        Returns:
+            str: The assistant response.
+        """
+        session = await self.get_chat_session(session_id)
+        model = await self.resolve_model(model_name, session)
+        options = self.build_options(options, model)
+        # Retrieved before queueing, so the embedding call does not hold a generation slot
+        memories = await self.memory_index.retrieve(prompt, session.session_id)
+        async with self.session_turn(session, model):
+            await self.set_session_model(session, model)
+            session.chat_history.append("user", prompt)
+            messages = self.build_messages(session, system_prompt, memories)
+
+            cache_key = None
+            if self.response_cache.is_cacheable(options, use_cache):
+                cache_key = build_cache_key(session.model, options, messages)
+                cached = await self.response_cache.get(cache_key)
+                if cached:
+                    assistant_response, timings = cached
+                    session.last_timings = dict(timings, cached=True)
+                    await self.persist_message(session, "user", prompt)
+                    await self.add_to_chat_history(session, "assistant", assistant_response)
+                    return assistant_response
+
+            flight = await self.start_generation(session, prompt, messages, options, cache_key, priority)
+            if active_request:
+                active_request.flight = flight
+            try:
+                assistant_response = await flight.result(active_request)
+            except (asyncio.CancelledError, RequestCancelledError):
+                if active_request and active_request.reason:
+                    self.save_partial_response(session, "".join(flight.chunks), active_request)
+                raise
+            except Exception as e:
+                print(f"Error generating response: {e}")
+                return "I'm sorry, but I couldn't generate a response at this time."
+
+            session.last_timings = flight.timings
+            await self.add_to_chat_history(session, "assistant", assistant_response)
             return assistant_response
-        
+
+    async def stream_response(self, prompt, system_prompt=None, session_id=None, model_name=None, options=None, active_request=None, priority="interactive"):
+        """
+        Streams a response from the AI model token by token.
+        The assistant message is persisted once, after the model has finished generating.
+        Identical requests running at the same time share one generation. Closing the generator
+        early (e.g. when the client disconnects) detaches from it, and the upstream Ollama stream
+        is closed once no request is left, which stops the generation on the server.
+        Args:
+            prompt (str): The user prompt.
+            system_prompt (str, optional): Additional instructions supplied by the user.
+            session_id (str, optional): The ID of the chat session. A new session is started when omitted.
+            model_name (str, optional): The model to use instead of the session's or default model.
+            options (dict, optional): Generation options supplied by the client.
+            active_request (ActiveRequest, optional): The request, which stops the stream when cancelled.
+            priority (str): The scheduler priority class, "interactive" or "batch".
+        Yields:
+            str: The next chunk of the assistant response.
+        Raises:
+            RequestCancelledError: If the request was cancelled or timed out.
+        """
+        session = await self.get_chat_session(session_id)
+        model = await self.resolve_model(model_name, session)
+        options = self.build_options(options, model)
+        # Retrieved before queueing, so the embedding call does not hold a generation slot
+        memories = await self.memory_index.retrieve(prompt, session.session_id)
+        async with self.session_turn(session, model):
+            await self.set_session_model(session, model)
+            session.chat_history.append("user", prompt)
+            messages = self.build_messages(session, system_prompt, memories)
+
+            flight = await self.start_generation(session, prompt, messages, options, priority=priority)
+            if active_request:
+                active_request.flight = flight
+            tokens = flight.stream(active_request)
+            chunks = []
+            try:
+                async for content in tokens:
+                    chunks.append(content)
+                    yield content
+            except (GeneratorExit, asyncio.CancelledError, RequestCancelledError):
+                # Cancelled, timed out or the client went away
+                self.save_partial_response(session, "".join(chunks), active_request)
+                raise
+            finally:
+                await tokens.aclose()
+
+            session.last_timings = flight.timings
+            await self.add_to_chat_history(session, "assistant", "".join(chunks))
+
+
+    async def run_batch_item(self, job_id, index, item):
+        """
+        Runs one item of a batch job without a chat session and stores its result.
+        Queue rejections are retried, so batch items wait for capacity instead of failing.
+        Args:
+            job_id (str): The ID of the batch job.
+            index (int): The position of the item in the job.
+            item (dict): The item, with a prompt and optionally id, system_prompt, model, options, cache and timeout.
+        Returns:
+            dict: The result with the response or error, latency and token stats.
+        """
+        started_at = time.monotonic()
+        result = {"index": index, "id": item.get("id") if isinstance(item, dict) else None}
+        try:
+            if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+                raise ValueError("Each line must be a JSON object with a prompt.")
+
+            model = await self.resolve_model(item.get("model"))
+            options = self.build_options(item.get("options"), model)
+            messages = [
+                {"role": "system", "content": self.build_system_prompt(model, item.get("system_prompt"))},
+                {"role": "user", "content": item["prompt"]},
+            ]
+            result["model"] = model
+
+            cache_key = None
+            cached = None
+            if self.response_cache.is_cacheable(options, item.get("cache", True)):
+                cache_key = build_cache_key(model, options, messages)
+                cached = await self.response_cache.get(cache_key)
+
+            if cached:
+                response, timings = cached
+                ttft = time.monotonic() - started_at
+            else:
+                # Each item is its own scheduler session, so items of a job run side by side
+                scheduler_session = f"batch:{job_id}:{index}"
+                active_request = self.requests.open(scheduler_session, model, item.get("timeout"), scheduler_session)
+                try:
+                    response, timings, ttft = await active_request.run(
+                        self.run_batch_generation(scheduler_session, model, messages, options, cache_key, started_at, active_request)
+                    )
+                finally:
+                    active_request.finish()
+
+            eval_duration = timings.get("eval_duration")
+            result.update(
+                status="completed",
+                response=response,
+                ttft=ttft,
+                prompt_eval_count=timings.get("prompt_eval_count"),
+                eval_count=timings.get("eval_count"),
+                tokens_per_second=timings["eval_count"] / (eval_duration / 1e9) if eval_duration and timings.get("eval_count") else None,
+                cached=cached is not None,
+            )
         except Exception as e:
-            print(f"Error generating response: {e}")
-            return "I'm sorry, but I couldn't generate a response at this time."
+            result.update(status="failed", error=str(e))
 
-    
+        result["latency"] = time.monotonic() - started_at
+        try:
+            await self.db_handler.run_async(self.db_handler.save_batch_result, job_id, result)
+        except Exception as e:
+            print(f"Error saving result {index} of batch job {job_id}: {e}")
+        return result
+
+    async def run_batch_generation(self, scheduler_session, model, messages, options, cache_key, started_at, active_request):
+        """
+        Generates the response of a batch item, waiting for queue capacity instead of failing.
+        Args:
+            scheduler_session (str): The scheduler session of the item.
+            model (str): The model name.
+            messages (list): The message list.
+            options (dict): The generation options.
+            cache_key (str): The response cache key, when the response should be cached.
+            started_at (float): The monotonic time the item started at.
+            active_request (ActiveRequest): The request of the item, which carries its deadline.
+        Returns:
+            tuple: The response, its timings and the time to first token.
+        """
+        while True:
+            flight = self.single_flight.join(
+                cache_key or build_cache_key(model, options, messages),
+                lambda flight: self.run_generation(flight, model, scheduler_session, messages, options, cache_key, "batch")
+            )
+            try:
+                await flight.wait_started()
+                break
+            except QueueFullError as e:
+                flight.detach()
+                await asyncio.sleep(e.retry_after)
+            except BaseException:
+                flight.detach()
+                raise
+
+        active_request.flight = flight
+        chunks = []
+        ttft = None
+        async for chunk in flight.stream(active_request):
+            if ttft is None:
+                ttft = time.monotonic() - started_at
+            chunks.append(chunk)
+        return "".join(chunks), flight.timings, ttft
+
+    async def run_batch(self, items, job_id=None, concurrency=None, client=None):
+        """
+        Runs a batch job with bounded concurrency and yields results as they complete, not in input order.
+        Items that completed in an earlier run of the same job are skipped, so an interrupted job resumes
+        by sending the same items with its job ID. Closing the generator cancels the running items.
+        Args:
+            items (list): The batch items, see run_batch_item.
+            job_id (str, optional): The ID of the job to resume, a new job is started when omitted.
+            concurrency (int, optional): The maximum number of items running at once.
+            client (str, optional): The client the generated tokens are counted against, see ClientQuotas.identify.
+        Yields:
+            dict: A header with the job ID, then one result per item, then a summary.
+        """
+        job_id = job_id or str(uuid.uuid4())
+        concurrency = concurrency or self.batch_concurrency
+        completed = await self.db_handler.run_async(self.db_handler.get_completed_batch_items, job_id)
+        pending = [(index, item) for index, item in enumerate(items) if index not in completed]
+        yield {"job_id": job_id, "total": len(items), "skipped": len(items) - len(pending)}
+
+        started_at = time.monotonic()
+        results = asyncio.Queue()
+        pending_iter = iter(pending)
+
+        async def worker():
+            for index, item in pending_iter:
+                # Items wait for the token quota of the client to refill instead of failing
+                while client:
+                    wait_time = self.quotas.wait_time(client)
+                    if not wait_time:
+                        break
+                    await asyncio.sleep(wait_time)
+                result = await self.run_batch_item(job_id, index, item)
+                if client and not result.get("cached"):
+                    self.quotas.record_tokens(client, result.get("eval_count"))
+                await results.put(result)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(pending)))]
+        counts = {"completed": 0, "failed": 0}
+        try:
+            for _ in range(len(pending)):
+                result = await results.get()
+                counts[result["status"]] += 1
+                yield result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-    def get_sessions(self):
+        yield {"job_id": job_id, "done": True, **counts, "skipped": len(items) - len(pending), "elapsed": time.monotonic() - started_at}
+
+    async def get_batch_results(self, job_id):
+        """
+        Retrieves the stored results of a batch job.
+        Args:
+            job_id (str): The ID of the batch job.
+        Returns:
+            list: The results in item order.
         """
-        Retrieves all chat sessions from the database.
+        return await self.db_handler.run_async(self.db_handler.get_batch_results, job_id)
+
+    async def get_sessions(self, limit=None, before=None):
+        """
+        Retrieves chat sessions from the database, newest first.
+        Args:
+            limit (int, optional): The maximum number of sessions to return.
+            before (str, optional): A cursor from a previous page, only older sessions are returned.
         Returns:
             list: A list of chat sessions.
         """
-        return self.db_handler.get_chat_sessions()
+        return await self.db_handler.run_async(self.db_handler.get_chat_sessions, limit, before)
     
-    def get_session(self, session_id):
+    async def get_session(self, session_id):
         """
         Retrieves a specific chat session from the database.
         Args:
@@ -193,11 +949,24 @@ class AIHandler:
         Returns:
             dict: The chat session data.
         """
-        return self.db_handler.get_chat_session(session_id)
+        return await self.db_handler.run_async(self.db_handler.get_chat_session, session_id)
+
+    async def add_memory(self, session_id, memory):
+        """
+        Stores a memory and adds it to the memory index in the background.
+        Args:
+            session_id (str): The ID of the chat session.
+            memory (str): The memory to store.
+        Returns:
+            int: The ID of the new memory.
+        """
+        memory_id = await self.db_handler.run_async(self.db_handler.add_memory, session_id, memory)
+        self.run_in_background(self.memory_index.add(memory_id, session_id, memory))
+        return memory_id
     
 
 
-def test_ai_handler():
+async def test_ai_handler():
     """
     Test function for the AIHandler class.
     """
@@ -205,45 +974,45 @@ def test_ai_handler():
     ai_handler = AIHandler(db_handler=db_handler)
 
     # Test model retrieval
-    models = ai_handler.get_models()
+    models = await ai_handler.get_models()
     assert isinstance(models, list), "Models should be a list."
 
     # Test model selection
     if models:
-        ai_handler.set_model(models[0])
+        await ai_handler.set_model(models[0])
         assert ai_handler.current_model == models[0], "Model selection failed."
 
     # Test chat history management
-    ai_handler.clear_chat_history()
-    assert len(ai_handler.chat_history) == 0, "Chat history should be empty after clearing."
+    session_id = await ai_handler.clear_chat_history()
+    session = await ai_handler.get_chat_session(session_id)
+    assert len(session.chat_history) == 0, "Chat history should be empty after clearing."
 
     # Test adding to chat history
-    ai_handler.add_to_chat_history("user", "Hello!")
-    assert len(ai_handler.chat_history) == 1, "Chat history should contain one message."
+    await ai_handler.add_to_chat_history(session, "user", "Hello!")
+    assert len(session.chat_history) == 1, "Chat history should contain one message."
 
     # Test generating response
-    response = ai_handler.generate_response("Hello!")
+    response = await ai_handler.generate_response("Hello!", session_id=session_id)
     assert isinstance(response, str), "Response should be a string."
 
     # Test session management
-    ai_handler.set_session_id(ai_handler.current_session_id)
-    sessions = ai_handler.get_sessions()
+    sessions = await ai_handler.get_sessions()
     assert isinstance(sessions, list), "Sessions should be a list."
 
     # Test getting a specific session
     if sessions:
-        session = ai_handler.get_session(sessions[0]['session_id'])
+        session = await ai_handler.get_session(sessions[0]['session_id'])
         assert isinstance(session, dict), "Session should be a dictionary."
 
     # Clean up test database
-    db_handler.connection.close()
+    db_handler.close_connection()
     os.remove('test_assistant.db')
 
 def main():
     """
     Main function to test the AIHandler class.
     """
-    test_ai_handler()
+    asyncio.run(test_ai_handler())
     print("All tests passed!")
 
 if __name__ == "__main__":
@@ -0,0 +1,367 @@
+"""
+module: backend.services.backend_pool
+description: This module contains the OllamaBackend and BackendPool classes, which spread requests over several
+Ollama servers, preferring servers that already have the model loaded, and fail over when a server is down.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import asyncio
+import itertools
+import os
+import time
+
+import httpx
+import ollama
+
+# Errors meaning the server could not be reached or did not answer in time
+BACKEND_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, httpx.TransportError)
+
+class OllamaBackend:
+    """
+    This class holds the client and the routing state of a single Ollama server.
+    """
+    def __init__(self, host=None):
+        """
+        Initializes the OllamaBackend class.
+        Args:
+            host (str, optional): The base URL of the server, the ollama default when omitted.
+        """
+        self.host = host
+        self.client = ollama.AsyncClient(host=host)
+        self.healthy = True
+        self.outstanding = 0
+        # Models the server has pulled, and the subset currently loaded in memory
+        self.models = set()
+        self.loaded_models = set()
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+        self.checked_at = None
+
+    def mark_failed(self, e):
+        """
+        Takes the server out of rotation until the next successful health check.
+        Args:
+            e (Exception): The error the server returned.
+        """
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(e)
+        print(f"Ollama backend {self.host or 'default'} failed: {e}")
+
+    def stats(self):
+        """
+        Returns the routing state of the server.
+        Returns:
+            dict: Health, load and model metrics.
+        """
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "models": sorted(self.models),
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+
+class BackendPool:
+    """
+    This class exposes the subset of ollama.AsyncClient used by the application on top of several servers.
+    Each request goes to a healthy server, preferring servers with the model loaded, then servers that
+    have the model, then the server with the fewest requests in progress.
+    """
+    def __init__(self, hosts=None, health_interval=None):
+        """
+        Initializes the BackendPool class.
+        Args:
+            hosts (list, optional): The base URLs of the servers, from OLLAMA_HOSTS when omitted.
+            health_interval (float, optional): Seconds between health checks.
+        """
+        if hosts is None:
+            hosts = [host.strip() for host in os.getenv('OLLAMA_HOSTS', '').split(',') if host.strip()]
+        # Without OLLAMA_HOSTS the pool holds the single server the ollama client would use
+        self.backends = [OllamaBackend(host) for host in hosts] or [OllamaBackend()]
+        self.health_interval = health_interval or float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))
+        self.health_timeout = float(os.getenv('OLLAMA_HEALTH_TIMEOUT', '2'))
+        # Breaks ties between equally loaded servers
+        self.rotation = itertools.count()
+        self.health_task = None
+
+    def select(self, model=None, exclude=()):
+        """
+        Chooses the server for a request.
+        Args:
+            model (str, optional): The model the request uses.
+            exclude (tuple): Servers that already failed for this request.
+        Returns:
+            OllamaBackend: The server, or None if every server was excluded.
+        """
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        # Unhealthy servers are only tried once no healthy server is left
+        candidates = [backend for backend in candidates if backend.healthy] or candidates
+        if not candidates:
+            return None
+
+        if model:
+            loaded = [backend for backend in candidates if model in backend.loaded_models]
+            available = [backend for backend in candidates if model in backend.models]
+            candidates = loaded or available or candidates
+
+        offset = next(self.rotation)
+        return min(
+            (candidates[(offset + i) % len(candidates)] for i in range(len(candidates))),
+            key=lambda backend: backend.outstanding
+        )
+
+    @staticmethod
+    def should_fail_over(e):
+        """
+        Checks whether a failed request should be retried on another server. Only connection errors,
+        timeouts and server errors count against the server, any other error is the request's own
+        (e.g. a response the client cannot parse) and would fail the same way elsewhere.
+        Args:
+            e (Exception): The error of the request.
+        Returns:
+            tuple: Whether to retry elsewhere and whether the server should be marked as failed.
+        """
+        if isinstance(e, ollama.ResponseError):
+            if e.status_code == 404:
+                # The model is missing on this server but may exist on another one
+                return True, False
+            if e.status_code >= 500:
+                return True, True
+            return False, False
+        if isinstance(e, BACKEND_ERRORS):
+            return True, True
+        return False, False
+
+    async def call(self, method, **kwargs):
+        """
+        Runs a client method on the best server for its model, failing over to the next one on errors.
+        Args:
+            method (str): The name of the ollama.AsyncClient method.
+            **kwargs: The arguments of the method.
+        Returns:
+            The response of the method.
+        """
+        model = kwargs.get('model')
+        tried = []
+        last_error = None
+        while True:
+            backend = self.select(model, tried)
+            if backend is None:
+                raise last_error
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            try:
+                response = await getattr(backend.client, method)(**kwargs)
+                if model and method != 'show':
+                    backend.models.add(model)
+                    backend.loaded_models.add(model)
+                return response
+            except Exception as e:
+                fail_over, failed = self.should_fail_over(e)
+                if not fail_over:
+                    raise
+                if failed:
+                    backend.mark_failed(e)
+                last_error = e
+            finally:
+                backend.outstanding -= 1
+
+    async def chat(self, model, messages, stream=False, **kwargs):
+        """
+        Sends a chat request. A stream fails over until its first part has been received.
+        Args:
+            model (str): The model name.
+            messages (list): The message list.
+            stream (bool): Whether to stream the response.
+            **kwargs: Further arguments of ollama.AsyncClient.chat.
+        Returns:
+            The chat response, or an async generator of response parts when streaming.
+        """
+        if not stream:
+            return await self.call('chat', model=model, messages=messages, **kwargs)
+
+        tried = []
+        last_error = None
+        while True:
+            backend = self.select(model, tried)
+            if backend is None:
+                raise last_error
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            parts = None
+            try:
+                parts = await backend.client.chat(model=model, messages=messages, stream=True, **kwargs)
+                first_part = await parts.__anext__()
+            except StopAsyncIteration:
+                first_part = None
+            except Exception as e:
+                backend.outstanding -= 1
+                if parts is not None:
+                    await parts.aclose()
+                fail_over, failed = self.should_fail_over(e)
+                if not fail_over:
+                    raise
+                if failed:
+                    backend.mark_failed(e)
+                last_error = e
+                continue
+            except BaseException:
+                backend.outstanding -= 1
+                if parts is not None:
+                    await parts.aclose()
+                raise
+
+            backend.models.add(model)
+            backend.loaded_models.add(model)
+            return self.relay(backend, first_part, parts)
+
+    async def relay(self, backend, first_part, parts):
+        """
+        Yields the parts of a stream and releases the server once the stream is done or closed.
+        Args:
+            backend (OllamaBackend): The server streaming the response.
+            first_part (dict): The part already received, None for an empty stream.
+            parts (AsyncIterator): The remaining parts.
+        Yields:
+            dict: The next response part.
+        """
+        try:
+            if first_part is not None:
+                yield first_part
+            async for part in parts:
+                yield part
+        finally:
+            backend.outstanding -= 1
+            await parts.aclose()
+
+    async def generate(self, model, **kwargs):
+        """
+        Sends a generate request, used to load models.
+        Args:
+            model (str): The model name.
+            **kwargs: Further arguments of ollama.AsyncClient.generate.
+        Returns:
+            The generate response.
+        """
+        return await self.call('generate', model=model, **kwargs)
+
+    async def embed(self, model, input, **kwargs):
+        """
+        Computes embeddings.
+        Args:
+            model (str): The embedding model.
+            input (list): The texts to embed.
+            **kwargs: Further arguments of ollama.AsyncClient.embed.
+        Returns:
+            The embed response.
+        """
+        return await self.call('embed', model=model, input=input, **kwargs)
+
+    async def show(self, model):
+        """
+        Retrieves the metadata of a model.
+        Args:
+            model (str): The model name.
+        Returns:
+            The show response.
+        """
+        return await self.call('show', model=model)
+
+    async def list(self):
+        """
+        Lists the models available on any healthy server.
+        Returns:
+            dict: The merged model list.
+        Raises:
+            Exception: The error of the last server if no server could be reached.
+        """
+        backends = [backend for backend in self.backends if backend.healthy] or self.backends
+        responses = await asyncio.gather(*(backend.client.list() for backend in backends), return_exceptions=True)
+
+        models = {}
+        errors = []
+        for backend, response in zip(backends, responses):
+            if isinstance(response, Exception):
+                if self.should_fail_over(response)[1]:
+                    backend.mark_failed(response)
+                errors.append(response)
+                continue
+            backend.models = {model.get("model") for model in response.get("models", [])}
+            for model in response.get("models", []):
+                models.setdefault(model.get("model"), model)
+
+        if errors and len(errors) == len(backends):
+            raise errors[-1]
+        return {"models": list(models.values())}
+
+    async def check(self, backend):
+        """
+        Checks whether a server is reachable and which models it has loaded.
+        Args:
+            backend (OllamaBackend): The server to check.
+        """
+        try:
+            response = await asyncio.wait_for(backend.client.ps(), self.health_timeout)
+        except Exception as e:
+            if backend.healthy:
+                backend.mark_failed(e)
+            return
+
+        backend.loaded_models = {model.get("model") for model in response.get("models", [])}
+        backend.checked_at = time.monotonic()
+        if not backend.healthy:
+            print(f"Ollama backend {backend.host or 'default'} recovered")
+        backend.healthy = True
+
+    async def check_periodically(self):
+        """
+        Checks every server every health interval until cancelled.
+        """
+        while True:
+            await asyncio.gather(*(self.check(backend) for backend in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        """
+        Starts the background health checks.
+        """
+        if self.health_task is None or self.health_task.done():
+            self.health_task = asyncio.create_task(self.check_periodically())
+
+    async def stop(self):
+        """
+        Stops the background health checks.
+        """
+        if self.health_task:
+            self.health_task.cancel()
+            try:
+                await self.health_task
+            except asyncio.CancelledError:
+                pass
+            self.health_task = None
+
+    def healthy_count(self):
+        """
+        Returns:
+            int: The number of servers in rotation, at least 1 since unhealthy servers are still tried once no other is left.
+        """
+        return max(1, sum(1 for backend in self.backends if backend.healthy))
+
+    def stats(self):
+        """
+        Returns the routing state of every server.
+        Returns:
+            list: The metrics of each server.
+        """
+        return [backend.stats() for backend in self.backends]
@@ -0,0 +1,31 @@
+"""
+module: backend.services.config
+description: This module contains helpers for reading settings from environment variables.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import os
+
+def get_model_settings(env_name, cast=str):
+    """
+    Reads a per-model setting map from an environment variable.
+    The value is a comma separated list of model=value pairs, e.g. "llama3:8b=4,phi4-mini=1".
+    Args:
+        env_name (str): The name of the environment variable.
+        cast (callable): Converts each value from a string.
+    Returns:
+        dict: A mapping of model name to setting value.
+    """
+    settings = {}
+    for item in os.getenv(env_name, '').split(','):
+        if '=' not in item:
+            continue
+        model, value = item.rsplit('=', 1)
+        try:
+            settings[model.strip()] = cast(value.strip())
+        except ValueError:
+            print(f"Ignoring invalid value for {model.strip()} in {env_name}: {value.strip()}")
+    return settings
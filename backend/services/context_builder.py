@@ -0,0 +1,142 @@
+"""
+module: backend.services.context_builder
+description: This module contains the ContextBuilder class, which keeps the prompt sent to the model within a
+per-model token budget by keeping recent turns verbatim and replacing older turns with a rolling summary.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import os
+
+from .config import get_model_settings
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+Update the existing summary with the new messages. Keep facts, decisions, names, code identifiers and open questions.
+Drop greetings and small talk. Answer with the updated summary only."""
+
+class ContextBuilder:
+    """
+    This class selects which part of a chat history fits in the model context.
+    """
+    def __init__(self, default_budget=None, min_recent_messages=None, summary_batch=None):
+        """
+        Initializes the ContextBuilder class.
+        Args:
+            default_budget (int, optional): Prompt token budget unless overridden in CONTEXT_MODEL_BUDGETS.
+            min_recent_messages (int, optional): Messages always kept verbatim, even over budget.
+            summary_batch (int, optional): Dropped messages to collect before the summary is updated.
+        """
+        self.default_budget = default_budget or int(os.getenv('CONTEXT_TOKEN_BUDGET', '3072'))
+        self.min_recent_messages = min_recent_messages or int(os.getenv('CONTEXT_RECENT_MESSAGES', '2'))
+        self.summary_batch = summary_batch or int(os.getenv('CONTEXT_SUMMARY_BATCH', '6'))
+        self.summary_tokens = int(os.getenv('CONTEXT_SUMMARY_TOKENS', '512'))
+        self.model_budgets = get_model_settings('CONTEXT_MODEL_BUDGETS', int)
+
+    @staticmethod
+    def estimate_tokens(text):
+        """
+        Estimates the number of tokens in a text without running a tokenizer.
+        Args:
+            text (str): The text to measure.
+        Returns:
+            int: The estimated token count.
+        """
+        # Roughly four characters per token for English text and code, plus per-message overhead
+        return len(text) // 4 + 4
+
+    def get_budget(self, model):
+        """
+        Retrieves the prompt token budget of a model.
+        Args:
+            model (str): The model name.
+        Returns:
+            int: The number of prompt tokens the context may use.
+        """
+        return self.model_budgets.get(model, self.default_budget)
+
+    def select_window(self, model, chat_history, reserved_tokens=0):
+        """
+        Finds the oldest message that can still be sent verbatim.
+        Args:
+            model (str): The model name.
+            chat_history (list): The messages exchanged so far.
+            reserved_tokens (int): Tokens already used by the system prompt and summary.
+        Returns:
+            int: The index of the first message kept verbatim.
+        """
+        remaining = self.get_budget(model) - reserved_tokens
+        start = len(chat_history)
+        while start > 0:
+            cost = self.estimate_tokens(chat_history[start - 1]["content"])
+            if cost > remaining and len(chat_history) - start >= self.min_recent_messages:
+                break
+            remaining -= cost
+            start -= 1
+        return start
+
+    def build(self, model, system_prompt, chat_history, summary=None, summarized_count=0, memories=None):
+        """
+        Builds the message list for the model within its token budget.
+        Args:
+            model (str): The model name.
+            system_prompt (str): The system prompt, sent first.
+            chat_history (list): The messages exchanged so far.
+            summary (str, optional): The rolling summary of the oldest messages.
+            summarized_count (int): The number of messages covered by the summary.
+            memories (str, optional): Memories relevant to the latest message, sent just before it.
+        Returns:
+            tuple: The message list and the index of the first message kept verbatim.
+        """
+        messages = []
+        reserved_tokens = 0
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+            reserved_tokens += self.estimate_tokens(system_prompt)
+        if memories:
+            reserved_tokens += self.estimate_tokens(memories)
+
+        start = self.select_window(model, chat_history, reserved_tokens)
+        if start > 0 and summary:
+            summary_message = "Summary of the earlier conversation:\n" + summary
+            start = self.select_window(model, chat_history, reserved_tokens + self.estimate_tokens(summary_message))
+            messages.append({"role": "system", "content": summary_message})
+            # Messages already covered by the summary are not repeated verbatim
+            start = max(start, min(summarized_count, len(chat_history) - self.min_recent_messages))
+
+        for message in chat_history[start:]:
+            messages.append({"role": message["role"], "content": message["content"]})
+
+        if memories:
+            # Memories change with every prompt, placing them last keeps the rest of the prompt a cacheable prefix
+            position = len(messages) - 1 if start < len(chat_history) else len(messages)
+            messages.insert(position, {"role": "system", "content": memories})
+
+        return messages, start
+
+    def needs_summary(self, start, summarized_count):
+        """
+        Checks whether enough messages fell out of the window to update the summary.
+        Args:
+            start (int): The index of the first message kept verbatim.
+            summarized_count (int): The number of messages covered by the summary.
+        Returns:
+            bool: True if the summary should be updated.
+        """
+        return start - summarized_count >= self.summary_batch
+
+    def build_summary_request(self, summary, new_messages):
+        """
+        Builds the messages asking the model to fold new messages into the summary.
+        Args:
+            summary (str, optional): The current summary.
+            new_messages (list): The messages not yet covered by the summary.
+        Returns:
+            list: The message list for the summary request.
+        """
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in new_messages)
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+        ]
@@ -3,15 +3,344 @@ module: backend.services.db_handler
 description: This module contains the DatabaseHandler class, which is responsible for handling database operations.
 author: Karim Garba
 date_created: 07-04-25
-date_modified: 08-04-25
+date_modified: 17-10-26
 last_modified_by: Karim Garba
-version: 0.2
+version: 0.14
 """
+import asyncio
+import base64
+import functools
+import gzip
 import json
 import os
 import sqlite3
+import threading
+import time
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from . import metrics
+
+try:
+    import zstandard
+except ImportError:
+    # Archives are compressed with gzip when zstandard is not installed
+    zstandard = None
+
+def migrate_session_indexes(connection):
+    """
+    Deduplicate chat sessions and index sessions, messages and memories.
+    Every message used to insert its own chat_sessions row, so only the oldest row per session is kept.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        DELETE FROM chat_sessions
+        WHERE id NOT IN (SELECT MIN(id) FROM chat_sessions GROUP BY session_id)
+    ''')
+    connection.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_sessions_session_id ON chat_sessions (session_id)
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_created_at ON chat_sessions (created_at)
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_model ON chat_sessions (model, created_at)
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages (session_id, created_at)
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_memories_session ON memories (session_id, created_at)
+    ''')
+    connection.execute('ANALYZE')
+
+def migrate_session_summaries(connection):
+    """
+    Add title, last message time and message count to chat sessions, maintained by a trigger.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('ALTER TABLE chat_sessions ADD COLUMN title TEXT')
+    connection.execute('ALTER TABLE chat_sessions ADD COLUMN last_message_at TIMESTAMP')
+    connection.execute('ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0')
+    # Backfill from the (session_id, created_at) index, one lookup per session
+    connection.execute('''
+        UPDATE chat_sessions SET
+            message_count = (SELECT COUNT(*) FROM chat_messages m WHERE m.session_id = chat_sessions.session_id),
+            last_message_at = (SELECT MAX(created_at) FROM chat_messages m WHERE m.session_id = chat_sessions.session_id),
+            title = (
+                SELECT substr(content, 1, 80) FROM chat_messages m
+                WHERE m.session_id = chat_sessions.session_id AND m.role = 'user'
+                ORDER BY created_at, id LIMIT 1
+            )
+    ''')
+    connection.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_session_summary AFTER INSERT ON chat_messages
+        BEGIN
+            UPDATE chat_sessions SET
+                message_count = message_count + 1,
+                last_message_at = NEW.created_at,
+                title = COALESCE(title, CASE WHEN NEW.role = 'user' THEN substr(NEW.content, 1, 80) END)
+            WHERE session_id = NEW.session_id;
+        END
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_memories_created_at ON memories (created_at)
+    ''')
+
+def migrate_search_index(connection):
+    """
+    Add FTS5 full-text indexes over chat messages and memories, kept in sync by triggers.
+    Existing rows are indexed afterwards in small batches by backfill_search_index.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS search_backfill (
+            table_name TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL
+        )
+    ''')
+    for table, column in SEARCH_TABLES.items():
+        connection.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {column}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        # Rows up to the current maximum id are indexed by the backfill, newer rows by the triggers
+        connection.execute(f'''
+            INSERT OR REPLACE INTO search_backfill (table_name, next_id, max_id)
+            SELECT '{table}', COALESCE(MIN(id), 1), COALESCE(MAX(id), 0) FROM {table}
+        ''')
+        # Rows still waiting for the backfill are not in the index and must not be deleted from it
+        not_pending = f'''NOT EXISTS (
+            SELECT 1 FROM search_backfill WHERE table_name = '{table}' AND old.id BETWEEN next_id AND max_id
+        )'''
+        connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+        connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} WHEN {not_pending}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END
+        ''')
+        connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF {column} ON {table} WHEN {not_pending}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {table}_fts (rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+    connection.execute('''
+        DELETE FROM search_backfill WHERE next_id > max_id
+    ''')
+
+def migrate_embeddings(connection):
+    """
+    Add a table of embeddings keyed by content hash, so each distinct text is only embedded once per model.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (content_hash, model)
+        ) WITHOUT ROWID
+    ''')
+
+def migrate_response_cache(connection):
+    """
+    Add a table of cached chat responses, expired by time and trimmed to a maximum number of rows.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            timings TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache (created_at)
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at)
+    ''')
+
+def migrate_batch_results(connection):
+    """
+    Add a table of batch job results, so interrupted jobs can resume where they stopped.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS batch_results (
+            job_id TEXT NOT NULL,
+            item_index INTEGER NOT NULL,
+            item_id TEXT,
+            model TEXT,
+            status TEXT NOT NULL,
+            response TEXT,
+            error TEXT,
+            latency REAL,
+            ttft REAL,
+            prompt_eval_count INTEGER,
+            eval_count INTEGER,
+            tokens_per_second REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, item_index)
+        ) WITHOUT ROWID
+    ''')
+
+def migrate_session_archive(connection):
+    """
+    Add a table of archived chat histories, compressed one blob per session, and index sessions by last activity.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('ALTER TABLE chat_sessions ADD COLUMN archived_at TIMESTAMP')
+    connection.execute('ALTER TABLE chat_sessions ADD COLUMN restored_at TIMESTAMP')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS archived_messages (
+            session_id TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Retention and archival look sessions up by their last activity, a restore counts as activity
+    connection.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_activity ON chat_sessions ({SESSION_ACTIVITY})
+    ''')
+
+def migrate_archive_search(connection):
+    """
+    Add a table mapping the full-text entries of archived messages to their session, so search still finds them.
+    The entries are moved to the negated message ID, which no live message uses.
+    Args:
+        connection (sqlite3.Connection): The connection, inside a transaction.
+    """
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS archived_search_index (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TIMESTAMP
+        )
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_archived_search_index_session_id ON archived_search_index (session_id)
+    ''')
+
+def compress_archive(data, codec):
+    """
+    Compresses an archived chat history.
+    Args:
+        data (bytes): The serialized messages.
+        codec (str): "zstd" or "gzip".
+    Returns:
+        bytes: The compressed data.
+    """
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=int(os.getenv('DB_ARCHIVE_LEVEL', '9'))).compress(data)
+    return gzip.compress(data, compresslevel=int(os.getenv('DB_ARCHIVE_LEVEL', '9')), mtime=0)
+
+def decompress_archive(data, codec):
+    """
+    Decompresses an archived chat history.
+    Args:
+        data (bytes): The compressed data.
+        codec (str): The codec the data was compressed with.
+    Returns:
+        bytes: The serialized messages.
+    Raises:
+        RuntimeError: If the archive was written with zstd and zstandard is not installed.
+    """
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This session was archived with zstd but the zstandard package is not installed.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+def build_search_query(text):
+    """
+    Turns free text into an FTS5 query that matches all of its words, the last one as a prefix.
+    Quoting every word keeps FTS5 operators typed by users from causing syntax errors.
+    Args:
+        text (str): The text typed by the user.
+    Returns:
+        str: The FTS5 query, or an empty string if the text has no words.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if not words:
+        return ''
+    words[-1] += '*'
+    return ' '.join(words)
+
+def encode_cursor(row):
+    """
+    Encodes the position of a row as an opaque pagination cursor.
+    Args:
+        row (dict): A row with created_at and id columns.
+    Returns:
+        str: The cursor.
+    """
+    return base64.urlsafe_b64encode(f"{row['created_at']}|{row['id']}".encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decodes a pagination cursor created by encode_cursor.
+    Args:
+        cursor (str): The cursor.
+    Returns:
+        tuple: The created_at and id of the row the cursor points at.
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return created_at, int(row_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+# Tables with a full-text index and the column that is indexed
+SEARCH_TABLES = {
+    'chat_messages': 'content',
+    'memories': 'memory',
+}
+
+# Last activity of a session, as used by retention and archival
+SESSION_ACTIVITY = "MAX(COALESCE(last_message_at, created_at), COALESCE(restored_at, ''))"
+
+# Schema migrations as (version, migration) pairs, applied in order and recorded in PRAGMA user_version
+MIGRATIONS = [
+    (1, migrate_session_indexes),
+    (2, migrate_session_summaries),
+    (3, migrate_search_index),
+    (4, migrate_embeddings),
+    (5, migrate_response_cache),
+    (6, migrate_batch_results),
+    (7, migrate_session_archive),
+    (8, migrate_archive_search),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 class DatabaseHandler:
     """
@@ -24,39 +353,369 @@ class DatabaseHandler:
             db_path (str): The path to the database file.
         """
         self.db_path = os.getenv('DB_PATH', db_path)
-        self.connection = None
-        self.cursor = None
-        self.create_connection()
-        self.create_tables()
+        self.busy_timeout = int(os.getenv('DB_BUSY_TIMEOUT', '5000'))
+        self.synchronous = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+        # Each thread gets its own connection, reads never wait on each other
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # SQLite allows a single writer, serializing writes here avoids spinning on SQLITE_BUSY
+        self.write_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('DB_MAX_WORKERS', '4')),
+            thread_name_prefix='db'
+        )
+
+        # "immediate" commits every message, "group" queues them and commits in batches
+        self.durability = os.getenv('DB_DURABILITY', 'immediate').lower()
+        self.batch_size = int(os.getenv('DB_BATCH_SIZE', '64'))
+        self.flush_interval = float(os.getenv('DB_FLUSH_INTERVAL', '0.05'))
+        self.pending_sessions = []
+        self.pending_messages = []
+        self.pending_condition = threading.Condition()
+        self.writer_thread = None
+        self.stopping = False
+
+        # The database is opened and migrated on first use or by initialize at startup, never at import
+        self.initialized = False
+        self.init_lock = threading.Lock()
+
+        # Archived sessions whose messages were restored because they were read again
+        self.restored_sessions = 0
+
+    def initialize(self):
+        """
+        Opens the database, applies pending migrations and starts the write-behind thread.
+        Runs once, whichever comes first of the application startup and the first query.
+        """
+        if self.initialized:
+            return
+        with self.init_lock:
+            if self.initialized:
+                return
+            started_at = time.perf_counter()
+            if getattr(self.local, 'connection', None) is None:
+                self.create_connection()
+            self.create_tables()
+            if self.durability == 'group' and self.writer_thread is None:
+                self.start_writer()
+            self.initialized = True
+            print(f"Database {self.db_path} ready in {time.perf_counter() - started_at:.3f}s")
+
+    @property
+    def connection(self):
+        """
+        The database connection of the calling thread.
+        """
+        return self.get_connection()
 
     def create_connection(self):
         """
-        Creates a connection to the SQLite database.
-        If the database file does not exist, it will be created.
+        Creates a connection to the SQLite database for the calling thread.
+        If the database file does not exist, it will be created and switched to WAL mode.
+        Returns:
+            sqlite3.Connection: The new connection.
         """
         db_dir = os.path.dirname(self.db_path)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
-        self.connection = sqlite3.connect(self.db_path)
-        self.connection.row_factory = sqlite3.Row
-        self.cursor = self.connection.cursor()
+        # Connections are closed from the thread that shuts the handler down
+        connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        # Only takes effect on a new database, lets maintenance return free pages to the OS a few at a time
+        connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL lets readers run while a write is in progress, NORMAL only syncs at checkpoints
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(f'PRAGMA synchronous={self.synchronous}')
+        connection.execute(f'PRAGMA busy_timeout={self.busy_timeout}')
+
+        self.local.connection = connection
+        with self.connections_lock:
+            self.connections.append(connection)
+        return connection
+
+    def get_connection(self):
+        """
+        Retrieves the database connection of the calling thread, creating it on first use.
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if not self.initialized:
+                self.initialize()
+            connection = getattr(self.local, 'connection', None) or self.create_connection()
+        return connection
 
     def close_connection(self):
         """
-        Closes the database connection.
+        Writes any queued messages and closes the database connections of every thread.
         """
-        if self.connection:
-            self.connection.close()
-        self.connection = None
-        self.cursor = None
+        self.stop_writer()
+        self.executor.shutdown(wait=True)
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
         self.db_path = None
 
+    def fetch_all(self, query, params=()):
+        """
+        Runs a read query on the calling thread's connection.
+        Args:
+            query (str): The SQL query.
+            params (tuple): The query parameters.
+        Returns:
+            list: The rows as dictionaries.
+        """
+        cursor = self.get_connection().execute(query, params)
+        try:
+            return [dict(row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def fetch_one(self, query, params=()):
+        """
+        Runs a read query on the calling thread's connection and returns the first row.
+        Args:
+            query (str): The SQL query.
+            params (tuple): The query parameters.
+        Returns:
+            dict: The first row, or None if there are no rows.
+        """
+        cursor = self.get_connection().execute(query, params)
+        try:
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        finally:
+            cursor.close()
+
+    def execute_write(self, query, params=()):
+        """
+        Runs a write query in its own transaction.
+        Args:
+            query (str): The SQL query.
+            params (tuple): The query parameters.
+        Returns:
+            int: The number of rows changed.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                cursor = connection.execute(query, params)
+            cursor.close()
+            return cursor.rowcount
+
+    def execute_insert(self, query, params=()):
+        """
+        Runs an insert query in its own transaction.
+        Args:
+            query (str): The SQL query.
+            params (tuple): The query parameters.
+        Returns:
+            int: The ID of the inserted row.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                cursor = connection.execute(query, params)
+            cursor.close()
+            return cursor.lastrowid
+
+    def start_writer(self):
+        """
+        Starts the write-behind thread that commits queued sessions and messages in batches.
+        """
+        self.stopping = False
+        self.writer_thread = threading.Thread(target=self.write_behind, name='db-writer', daemon=True)
+        self.writer_thread.start()
+
+    def stop_writer(self):
+        """
+        Stops the write-behind thread after it has written everything still queued.
+        """
+        if self.writer_thread:
+            with self.pending_condition:
+                self.stopping = True
+                self.pending_condition.notify()
+            self.writer_thread.join()
+            self.writer_thread = None
+        self.flush()
+
+    def write_behind(self):
+        """
+        Waits for queued writes and flushes them once a batch is full or the flush interval has passed.
+        """
+        while True:
+            with self.pending_condition:
+                while not self.stopping and not self.pending_count():
+                    self.pending_condition.wait()
+                if self.stopping:
+                    break
+
+                # Give other requests a chance to join the batch
+                deadline = time.monotonic() + self.flush_interval
+                while not self.stopping and self.pending_count() < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.pending_condition.wait(remaining)
+
+            self.flush()
+
+    def pending_count(self):
+        """
+        Returns the number of queued writes.
+        Returns:
+            int: The number of sessions and messages not yet written.
+        """
+        return len(self.pending_sessions) + len(self.pending_messages)
+
+    def enqueue(self, pending, row):
+        """
+        Queues a row for the write-behind thread.
+        Args:
+            pending (list): The queue of the target table.
+            row (tuple): The values to insert.
+        """
+        if not self.initialized:
+            # The write-behind thread starts with the database
+            self.initialize()
+        with self.pending_condition:
+            pending.append(row)
+            if self.pending_count() == 1 or self.pending_count() >= self.batch_size:
+                self.pending_condition.notify()
+
+    def flush(self):
+        """
+        Writes all queued sessions and messages in a single transaction.
+        """
+        if not self.pending_count():
+            return
+
+        # Holding the write lock across the swap keeps batches in the order they were queued
+        with self.write_lock:
+            with self.pending_condition:
+                sessions, self.pending_sessions = self.pending_sessions, []
+                messages, self.pending_messages = self.pending_messages, []
+            if not sessions and not messages:
+                return
+
+            connection = self.get_connection()
+            started_at = time.perf_counter()
+            try:
+                with connection:
+                    connection.executemany('''
+                        INSERT OR IGNORE INTO chat_sessions (session_id, model, created_at) VALUES (?, ?, ?)
+                    ''', sessions)
+                    connection.executemany('''
+                        INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)
+                    ''', messages)
+            except sqlite3.Error as e:
+                print(f"Error flushing {len(sessions) + len(messages)} queued writes, retrying later: {e}")
+                with self.pending_condition:
+                    self.pending_sessions[:0] = sessions
+                    self.pending_messages[:0] = messages
+            else:
+                metrics.DB_DURATION.observe(time.perf_counter() - started_at, 'flush')
+
+    @staticmethod
+    def current_timestamp():
+        """
+        Returns the current time in the format SQLite uses for CURRENT_TIMESTAMP.
+        Returns:
+            str: The UTC timestamp.
+        """
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    async def run_async(self, func, *args, **kwargs):
+        """
+        Runs a blocking database method on the bounded executor so it does not block the event loop.
+        Args:
+            func (callable): The DatabaseHandler method to run.
+            *args: Positional arguments for the method.
+            **kwargs: Keyword arguments for the method.
+        Returns:
+            The return value of the method.
+        """
+        loop = asyncio.get_running_loop()
+        if not metrics.ENABLED and not metrics.SERVER_TIMING:
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+        started_at = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, functools.partial(self.timed, func, *args, **kwargs))
+        finally:
+            # Includes the time spent waiting for a free database thread
+            metrics.record_timing("db", time.perf_counter() - started_at)
+
+    @staticmethod
+    def timed(func, *args, **kwargs):
+        """
+        Runs a DatabaseHandler method and records its execution time.
+        Args:
+            func (callable): The method to run.
+            *args: Positional arguments for the method.
+            **kwargs: Keyword arguments for the method.
+        Returns:
+            The return value of the method.
+        """
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.DB_DURATION.observe(time.perf_counter() - started_at, func.__name__)
+
+    def get_schema_version(self, connection=None):
+        """
+        Retrieves the schema version stored in the database file.
+        Args:
+            connection (sqlite3.Connection, optional): The connection to use.
+        Returns:
+            int: The schema version, 0 for databases created before migrations existed.
+        """
+        connection = connection or self.get_connection()
+        return connection.execute('PRAGMA user_version').fetchone()[0]
+
     def create_tables(self):
         """
-        Creates the necessary tables in the database.
+        Creates the necessary tables in the database and applies pending schema migrations.
+        A database already at the latest version only costs a single PRAGMA read.
+        """
+        connection = self.get_connection()
+        if self.get_schema_version(connection) >= SCHEMA_VERSION:
+            return
+
+        with self.write_lock:
+            # Manage the transaction explicitly so the DDL and version bump commit together
+            connection.isolation_level = None
+            try:
+                # IMMEDIATE takes the write lock up front, so concurrent processes migrate one at a time
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    self.create_base_tables(connection)
+                    version = self.get_schema_version(connection)
+                    for target_version, migration in MIGRATIONS:
+                        if target_version > version:
+                            print(f"Migrating database to schema version {target_version}: {migration.__doc__.strip().splitlines()[0]}")
+                            migration(connection)
+                            connection.execute(f'PRAGMA user_version = {target_version}')
+                    connection.execute('COMMIT')
+                except BaseException:
+                    connection.execute('ROLLBACK')
+                    raise
+            finally:
+                connection.isolation_level = ''
+
+    def create_base_tables(self, connection):
+        """
+        Creates the tables of the original schema if they do not exist.
+        Args:
+            connection (sqlite3.Connection): The connection, inside a transaction.
         """
-        self.cursor.execute('''
+        connection.execute('''
             CREATE TABLE IF NOT EXISTS chat_sessions (
                 id INTEGER PRIMARY KEY,
                 session_id TEXT NOT NULL,
@@ -65,7 +724,7 @@ class DatabaseHandler:
             )
         ''')
         
-        self.cursor.execute('''
+        connection.execute('''
             CREATE TABLE IF NOT EXISTS chat_messages (
                 id INTEGER PRIMARY KEY,
                 session_id TEXT NOT NULL,
@@ -76,7 +735,7 @@ class DatabaseHandler:
             )
         ''')
 
-        self.cursor.execute('''
+        connection.execute('''
             CREATE TABLE IF NOT EXISTS memories (
                 id INTEGER PRIMARY KEY,
                 session_id TEXT NOT NULL,
@@ -85,7 +744,15 @@ class DatabaseHandler:
                 FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id)
             )
         ''')
-        self.connection.commit()
+
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                summarized_count INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
 
     def add_chat_session(self, session_id, model):
         """
@@ -94,17 +761,31 @@ class DatabaseHandler:
             session_id (str): The ID of the chat session.
             model (str): The AI model used for the chat.
         """
+        if self.durability == 'group':
+            self.enqueue(self.pending_sessions, (session_id, model, self.current_timestamp()))
+            return True
+
         try:
-            self.cursor.execute('''
+            self.execute_write('''
                 INSERT INTO chat_sessions (session_id, model) VALUES (?, ?)
             ''', (session_id, model))
-            self.connection.commit()
             return True
         except sqlite3.IntegrityError:
             # Session ID already exists, handle as needed
             return False
 
-   
+    def set_chat_session_model(self, session_id, model):
+        """
+        Changes the model stored for a chat session.
+        Args:
+            session_id (str): The ID of the chat session.
+            model (str): The AI model now used for the chat.
+        """
+        # A queued insert of the session row must land before it can be updated
+        self.flush()
+        self.execute_write('''
+            UPDATE chat_sessions SET model = ? WHERE session_id = ?
+        ''', (model, session_id))
 
     def add_chat_message(self, session_id, role, content):
         """
@@ -114,10 +795,13 @@ class DatabaseHandler:
             role (str): The role of the message sender (e.g., user, assistant).
             content (str): The content of the message.
         """
-        self.cursor.execute('''
+        if self.durability == 'group':
+            self.enqueue(self.pending_messages, (session_id, role, content, self.current_timestamp()))
+            return
+
+        self.execute_write('''
             INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)
         ''', (session_id, role, content))
-        self.connection.commit()
 
     def add_memory(self, session_id, memory):
         """
@@ -125,11 +809,163 @@ class DatabaseHandler:
         Args:
             session_id (str): The ID of the chat session.
             memory (str): The memory to be stored.
+        Returns:
+            int: The ID of the new memory.
         """
-        self.cursor.execute('''
+        return self.execute_insert('''
             INSERT INTO memories (session_id, memory) VALUES (?, ?)
         ''', (session_id, memory))
-        self.connection.commit()
+
+    def get_embeddings(self, model, content_hashes):
+        """
+        Retrieves stored embeddings by content hash.
+        Args:
+            model (str): The embedding model.
+            content_hashes (list): The content hashes to look up.
+        Returns:
+            dict: A mapping of content hash to the float32 vector bytes, for the hashes that were found.
+        """
+        embeddings = {}
+        # Stay well below SQLite's limit on the number of query parameters
+        for offset in range(0, len(content_hashes), 500):
+            batch = content_hashes[offset:offset + 500]
+            placeholders = ', '.join('?' * len(batch))
+            for row in self.fetch_all(f'''
+                SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({placeholders})
+            ''', (model, *batch)):
+                embeddings[row['content_hash']] = row['vector']
+        return embeddings
+
+    def save_embeddings(self, model, embeddings):
+        """
+        Stores embeddings in a single transaction.
+        Args:
+            model (str): The embedding model.
+            embeddings (list): (content_hash, dim, vector bytes) tuples.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                connection.executemany('''
+                    INSERT OR IGNORE INTO embeddings (content_hash, model, dim, vector) VALUES (?, ?, ?, ?)
+                ''', [(content_hash, model, dim, vector) for content_hash, dim, vector in embeddings])
+
+    def save_session_summary(self, session_id, summary, summarized_count):
+        """
+        Stores the rolling summary of a chat session, replacing the previous one.
+        Args:
+            session_id (str): The ID of the chat session.
+            summary (str): The summary of the oldest messages.
+            summarized_count (int): The number of messages covered by the summary.
+        """
+        self.execute_write('''
+            INSERT INTO session_summaries (session_id, summary, summarized_count) VALUES (?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_count = excluded.summarized_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (session_id, summary, summarized_count))
+
+    def get_cached_response(self, cache_key, now):
+        """
+        Retrieves a cached chat response that has not expired.
+        Args:
+            cache_key (str): The cache key.
+            now (float): The current UNIX time.
+        Returns:
+            dict: The response, its timings as JSON and its expiry time, or None if there is no valid entry.
+        """
+        return self.fetch_one('''
+            SELECT response, timings, expires_at FROM response_cache WHERE cache_key = ? AND expires_at > ?
+        ''', (cache_key, now))
+
+    def save_cached_response(self, cache_key, model, response, timings, expires_at):
+        """
+        Stores a chat response in the cache, replacing an older entry with the same key.
+        Args:
+            cache_key (str): The cache key.
+            model (str): The model that generated the response.
+            response (str): The assistant response.
+            timings (str): The timings of the generation as JSON.
+            expires_at (float): The UNIX time the response expires at.
+        """
+        self.execute_write('''
+            INSERT OR REPLACE INTO response_cache (cache_key, model, response, timings, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (cache_key, model, response, timings, time.time(), expires_at))
+
+    def prune_response_cache(self, now, max_rows):
+        """
+        Deletes expired cached responses, then the oldest ones past the row limit.
+        Args:
+            now (float): The current UNIX time.
+            max_rows (int): The maximum number of cached responses to keep.
+        Returns:
+            int: The number of deleted responses.
+        """
+        deleted = self.execute_write('''
+            DELETE FROM response_cache WHERE expires_at <= ?
+        ''', (now,))
+        deleted += self.execute_write('''
+            DELETE FROM response_cache WHERE created_at <= (
+                SELECT created_at FROM response_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+            )
+        ''', (max_rows,))
+        return deleted
+
+    def save_batch_result(self, job_id, result):
+        """
+        Stores the result of a batch item, replacing an earlier attempt.
+        Args:
+            job_id (str): The ID of the batch job.
+            result (dict): The result, as produced by AIHandler.run_batch_item.
+        """
+        self.execute_write('''
+            INSERT OR REPLACE INTO batch_results (
+                job_id, item_index, item_id, model, status, response, error,
+                latency, ttft, prompt_eval_count, eval_count, tokens_per_second
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            job_id, result["index"], result.get("id"), result.get("model"), result["status"], result.get("response"),
+            result.get("error"), result.get("latency"), result.get("ttft"), result.get("prompt_eval_count"),
+            result.get("eval_count"), result.get("tokens_per_second")
+        ))
+
+    def get_completed_batch_items(self, job_id):
+        """
+        Retrieves the items of a batch job that already completed.
+        Args:
+            job_id (str): The ID of the batch job.
+        Returns:
+            set: The indexes of the completed items.
+        """
+        return {row["item_index"] for row in self.fetch_all('''
+            SELECT item_index FROM batch_results WHERE job_id = ? AND status = 'completed'
+        ''', (job_id,))}
+
+    def get_batch_results(self, job_id):
+        """
+        Retrieves the results of a batch job in item order.
+        Args:
+            job_id (str): The ID of the batch job.
+        Returns:
+            list: The results.
+        """
+        return self.fetch_all('''
+            SELECT * FROM batch_results WHERE job_id = ? ORDER BY item_index
+        ''', (job_id,))
+
+    def get_session_summary(self, session_id):
+        """
+        Retrieves the rolling summary of a chat session.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            dict: The summary and the number of messages it covers, or None if there is no summary yet.
+        """
+        return self.fetch_one('''
+            SELECT summary, summarized_count FROM session_summaries WHERE session_id = ?
+        ''', (session_id,))
 
     def get_chat_history(self, session_id):
         """
@@ -139,41 +975,253 @@ class DatabaseHandler:
         Returns:
             list: A list of chat messages for the session.
         """
-        self.cursor.execute('''
-            SELECT * FROM chat_messages WHERE session_id = ? ORDER BY created_at
+        # Queued writes must be visible before reading
+        self.flush()
+        self.restore_chat_session(session_id)
+        return self.fetch_all('''
+            SELECT * FROM chat_messages WHERE session_id = ? ORDER BY created_at, id
         ''', (session_id,))
-        return [dict(row) for row in self.cursor.fetchall()]
         
     
-    def get_memories(self, session_id=None):
+    def load_chat_session(self, session_id):
+        """
+        Retrieves everything needed to resume a chat session in one call: the session row,
+        its messages as compact (role, content) tuples and its rolling summary.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            tuple: The session row or None, the list of (role, content) tuples and the summary or None.
+        """
+        # Queued writes must be visible before reading
+        self.flush()
+        self.restore_chat_session(session_id)
+        cursor = self.get_connection().cursor()
+        # Plain tuples, the history is only read by role and content
+        cursor.row_factory = None
+        try:
+            turns = cursor.execute('''
+                SELECT role, content FROM chat_messages WHERE session_id = ? ORDER BY created_at, id
+            ''', (session_id,)).fetchall()
+        finally:
+            cursor.close()
+        return self.get_chat_session(session_id), turns, self.get_session_summary(session_id)
+
+    def get_chat_messages_page(self, session_id, limit, before=None):
+        """
+        Retrieves a page of chat messages, newest first, using keyset pagination.
+        Args:
+            session_id (str): The ID of the chat session.
+            limit (int): The maximum number of messages to return.
+            before (str, optional): A cursor from a previous page, only older messages are returned.
+        Returns:
+            tuple: The messages in chronological order and the cursor of the next (older) page, or None.
+        """
+        self.flush()
+        if before:
+            rows = self.fetch_all('''
+                SELECT * FROM chat_messages WHERE session_id = ? AND (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            ''', (session_id, *decode_cursor(before), limit + 1))
+        else:
+            # Only the first page can find the session archived, later pages follow a restored one
+            self.restore_chat_session(session_id)
+            rows = self.fetch_all('''
+                SELECT * FROM chat_messages WHERE session_id = ?
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            ''', (session_id, limit + 1))
+
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, next_cursor
+
+    def get_chat_messages_after(self, session_id, after=None, limit=500):
+        """
+        Retrieves the chat messages following a row, in chronological order. Used to stream long histories in batches.
+        Args:
+            session_id (str): The ID of the chat session.
+            after (tuple, optional): The (created_at, id) of the last message already read.
+            limit (int): The maximum number of messages to return.
+        Returns:
+            list: The chat messages.
+        """
+        self.flush()
+        if after:
+            return self.fetch_all('''
+                SELECT * FROM chat_messages WHERE session_id = ? AND (created_at, id) > (?, ?)
+                ORDER BY created_at, id LIMIT ?
+            ''', (session_id, *after, limit))
+        self.restore_chat_session(session_id)
+        return self.fetch_all('''
+            SELECT * FROM chat_messages WHERE session_id = ? ORDER BY created_at, id LIMIT ?
+        ''', (session_id, limit))
+
+    def get_memories(self, session_id=None, limit=None, before=None):
         """
         Retrieves the memories, optionally filtered by session ID.
+        Without a limit all memories are returned oldest first. With a limit a page of
+        the newest memories is returned, newest first, using keyset pagination.
         Args:
             session_id (str, optional): The ID of the chat session.
+            limit (int, optional): The maximum number of memories to return.
+            before (str, optional): A cursor from a previous page, only older memories are returned.
         Returns:
             list: A list of memories for the session.
         """
-        if session_id:
-            self.cursor.execute('''
-                SELECT * FROM memories WHERE session_id = ? ORDER BY created_at
-            ''', (session_id,))
-        else:
-            self.cursor.execute('''
+        if limit is None:
+            if session_id:
+                return self.fetch_all('''
+                    SELECT * FROM memories WHERE session_id = ? ORDER BY created_at
+                ''', (session_id,))
+            return self.fetch_all('''
                 SELECT * FROM memories ORDER BY created_at
             ''')
-        return [dict(row) for row in self.cursor.fetchall()]
-    
-    def get_chat_sessions(self):
+
+        conditions, params = [], []
+        if session_id:
+            conditions.append('session_id = ?')
+            params.append(session_id)
+        if before:
+            conditions.append('(created_at, id) < (?, ?)')
+            params.extend(decode_cursor(before))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.fetch_all(f'''
+            SELECT * FROM memories {where} ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (*params, limit))
+
+    def get_chat_sessions(self, limit=None, before=None):
         """
-        Retrieves all chat sessions from the database.
+        Retrieves chat sessions from the database, newest first, as a lightweight summary projection.
+        Args:
+            limit (int, optional): The maximum number of sessions to return.
+            before (str, optional): A cursor from a previous page, only older sessions are returned.
         Returns:
             list: A list of chat sessions.
         """
-        self.cursor.execute('''
-            SELECT * FROM chat_sessions ORDER BY created_at DESC
-        ''')
-        return [dict(row) for row in self.cursor.fetchall()]
+        self.flush()
+        conditions, params = '', ()
+        if before:
+            conditions, params = 'WHERE (created_at, id) < (?, ?)', decode_cursor(before)
+        limit_clause = 'LIMIT ?' if limit is not None else ''
+        if limit is not None:
+            params = (*params, limit)
+        return self.fetch_all(f'''
+            SELECT id, session_id, model, created_at, title, last_message_at, message_count, archived_at
+            FROM chat_sessions {conditions} ORDER BY created_at DESC, id DESC {limit_clause}
+        ''', params)
     
+    def backfill_search_index(self, batch_size=500):
+        """
+        Indexes one batch of rows that existed before the full-text index was created.
+        Each batch is a short transaction, so live traffic is never blocked for long. The progress
+        is re-read inside the transaction, so several worker processes never index the same rows twice.
+        Args:
+            batch_size (int): The maximum number of rows indexed per table.
+        Returns:
+            bool: True if rows remain to be indexed.
+        """
+        remaining = False
+        for row in self.fetch_all('SELECT table_name FROM search_backfill'):
+            table, column = row['table_name'], SEARCH_TABLES[row['table_name']]
+            connection = self.get_connection()
+            with self.write_lock:
+                with connection:
+                    # IMMEDIATE takes the write lock before reading, so the progress cannot change underneath
+                    connection.execute('BEGIN IMMEDIATE')
+                    row = connection.execute(
+                        'SELECT next_id, max_id FROM search_backfill WHERE table_name = ?', (table,)
+                    ).fetchone()
+                    if row is None:
+                        # Another worker finished this table
+                        continue
+                    last_id = connection.execute(f'''
+                        SELECT MAX(id) FROM (
+                            SELECT id FROM {table} WHERE id BETWEEN ? AND ? ORDER BY id LIMIT ?
+                        )
+                    ''', (row['next_id'], row['max_id'], batch_size)).fetchone()[0]
+                    if last_id is None:
+                        connection.execute('DELETE FROM search_backfill WHERE table_name = ?', (table,))
+                        continue
+                    connection.execute(f'''
+                        INSERT INTO {table}_fts (rowid, {column})
+                        SELECT id, {column} FROM {table} WHERE id BETWEEN ? AND ?
+                    ''', (row['next_id'], last_id))
+                    if last_id >= row['max_id']:
+                        connection.execute('DELETE FROM search_backfill WHERE table_name = ?', (table,))
+                    else:
+                        connection.execute('''
+                            UPDATE search_backfill SET next_id = ? WHERE table_name = ?
+                        ''', (last_id + 1, table))
+                        remaining = True
+        return remaining
+
+    async def run_search_backfill(self, pause=0.05):
+        """
+        Indexes all rows that existed before the full-text index was created, one batch at a time.
+        Args:
+            pause (float): Seconds to wait between batches so queued requests can use the database.
+        """
+        try:
+            while await self.run_async(self.backfill_search_index):
+                await asyncio.sleep(pause)
+        except Exception as e:
+            print(f"Error backfilling the search index: {e}")
+
+    def search(self, text, scope='all', session_id=None, limit=20, offset=0):
+        """
+        Searches chat messages and memories with the full-text index, best matches first.
+        Args:
+            text (str): The text to search for.
+            scope (str): "messages", "memories" or "all".
+            session_id (str, optional): Only search this chat session.
+            limit (int): The maximum number of results per scope.
+            offset (int): The number of results to skip per scope.
+        Returns:
+            dict: The matching messages and memories with highlighted snippets. Messages of archived
+            sessions are marked archived and have no ID or snippet.
+        """
+        self.flush()
+        query = build_search_query(text)
+        results = {}
+        if not query:
+            return results
+
+        scopes = {'messages': ('chat_messages', 'content'), 'memories': ('memories', 'memory')}
+        for name, (table, column) in scopes.items():
+            if scope not in ('all', name):
+                continue
+            params = (query, session_id) if session_id else (query,)
+            if table == 'chat_messages':
+                # Messages of archived sessions only have their index entries, so they come without ID or snippet
+                # and are marked archived; reading the session restores them
+                session_filter = 'AND COALESCE(t.session_id, a.session_id) = ?' if session_id else ''
+                results[name] = self.fetch_all(f'''
+                    SELECT t.id, COALESCE(t.session_id, a.session_id) AS session_id, COALESCE(t.role, a.role) AS role,
+                        COALESCE(t.created_at, a.created_at) AS created_at, a.id IS NOT NULL AS archived,
+                        CASE WHEN t.id IS NOT NULL THEN snippet(chat_messages_fts, 0, '<mark>', '</mark>', '…', 24) END AS snippet,
+                        bm25(chat_messages_fts) AS rank
+                    FROM chat_messages_fts
+                    LEFT JOIN chat_messages t ON t.id = chat_messages_fts.rowid
+                    LEFT JOIN archived_search_index a ON a.id = chat_messages_fts.rowid
+                    WHERE chat_messages_fts MATCH ? AND (t.id IS NOT NULL OR a.id IS NOT NULL) {session_filter}
+                    ORDER BY rank LIMIT ? OFFSET ?
+                ''', (*params, limit, offset))
+                for row in results[name]:
+                    row['archived'] = bool(row['archived'])
+                continue
+
+            session_filter = 'AND t.session_id = ?' if session_id else ''
+            results[name] = self.fetch_all(f'''
+                SELECT t.*, snippet({table}_fts, 0, '<mark>', '</mark>', '…', 24) AS snippet, bm25({table}_fts) AS rank
+                FROM {table}_fts JOIN {table} t ON t.id = {table}_fts.rowid
+                WHERE {table}_fts MATCH ? {session_filter}
+                ORDER BY rank LIMIT ? OFFSET ?
+            ''', (*params, limit, offset))
+            for row in results[name]:
+                # Full content is available through the session endpoints, the snippet is enough here
+                row.pop(column, None)
+        return results
+
     def get_chat_session(self, session_id):
         """
         Retrieves a specific chat session from the database.
@@ -182,10 +1230,10 @@ class DatabaseHandler:
         Returns:
             dict: The chat session data.
         """
-        self.cursor.execute('''
+        self.flush()
+        return self.fetch_one('''
             SELECT * FROM chat_sessions WHERE session_id = ?
         ''', (session_id,))
-        return dict(self.cursor.fetchone()) if self.cursor.fetchone() else None
        
     
     def get_model_chat_sessions(self, model):
@@ -196,9 +1244,223 @@ class DatabaseHandler:
         Returns:
             list: A list of chat sessions for the model.
         """
-        self.cursor.execute('''
-            SELECT * FROM chat_sessions WHERE model = ?
+        self.flush()
+        return self.fetch_all('''
+            SELECT * FROM chat_sessions WHERE model = ? ORDER BY created_at DESC
         ''', (model,))
-        return [dict(row) for row in self.cursor.fetchall()]
     
 
+    def get_sessions_inactive_since(self, cutoff, models=None, exclude_models=(), archived=None, limit=100, with_messages=False):
+        """
+        Retrieves the IDs of the sessions without activity since a given time, least recently active first.
+        Args:
+            cutoff (str): The UTC timestamp, in the format of current_timestamp.
+            models (list, optional): Only consider sessions of these models.
+            exclude_models (iterable): Skip the sessions of these models.
+            archived (bool, optional): Only consider archived (True) or live (False) sessions.
+            limit (int): The maximum number of IDs to return.
+            with_messages (bool): Only consider sessions with messages, e.g. to skip sessions that were created or cleared and left empty.
+        Returns:
+            list: The session IDs.
+        """
+        self.flush()
+        conditions, params = [f'{SESSION_ACTIVITY} < ?'], [cutoff]
+        if models is not None:
+            conditions.append(f"model IN ({', '.join('?' * len(models))})")
+            params.extend(models)
+        if exclude_models:
+            conditions.append(f"model NOT IN ({', '.join('?' * len(exclude_models))})")
+            params.extend(exclude_models)
+        if archived is not None:
+            conditions.append('archived_at IS NOT NULL' if archived else 'archived_at IS NULL')
+        if with_messages:
+            # message_count is not lowered when a session is cleared, the messages themselves are checked
+            conditions.append('EXISTS (SELECT 1 FROM chat_messages m WHERE m.session_id = chat_sessions.session_id)')
+        return [row['session_id'] for row in self.fetch_all(f'''
+            SELECT session_id FROM chat_sessions WHERE {' AND '.join(conditions)}
+            ORDER BY {SESSION_ACTIVITY} LIMIT ?
+        ''', (*params, limit))]
+
+    def delete_chat_session(self, session_id):
+        """
+        Deletes a chat session with its messages, archived messages and summary in one transaction.
+        Memories are kept, they outlive the conversation they were taken from.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            int: The number of deleted messages, archived ones included.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                archived = connection.execute('''
+                    SELECT codec, message_count, data FROM archived_messages WHERE session_id = ?
+                ''', (session_id,)).fetchone()
+                if archived:
+                    self.unindex_archive(connection, session_id, archived)
+                deleted = connection.execute('''
+                    DELETE FROM chat_messages WHERE session_id = ?
+                ''', (session_id,)).rowcount
+                connection.execute('DELETE FROM archived_messages WHERE session_id = ?', (session_id,))
+                connection.execute('DELETE FROM session_summaries WHERE session_id = ?', (session_id,))
+                connection.execute('DELETE FROM chat_sessions WHERE session_id = ?', (session_id,))
+        return deleted + (archived['message_count'] if archived else 0)
+
+    def archive_chat_session(self, session_id, codec='gzip'):
+        """
+        Moves the messages of a chat session into a single compressed blob. The session row stays,
+        so the session is still listed, and its messages are restored the next time they are read.
+        Their full-text entries are kept under the negated message IDs, so search still finds them.
+        Args:
+            session_id (str): The ID of the chat session.
+            codec (str): "zstd" or "gzip".
+        Returns:
+            tuple: The number of archived messages, their size and the compressed size in bytes, or None if nothing was archived.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                if connection.execute('''
+                    SELECT 1 FROM archived_messages WHERE session_id = ?
+                ''', (session_id,)).fetchone():
+                    # Messages written after an earlier archival wait for the session to be restored
+                    return None
+                # The ID is kept to find the full-text entries of the message again on restore
+                messages = [tuple(row) for row in connection.execute('''
+                    SELECT role, content, created_at, id FROM chat_messages WHERE session_id = ? ORDER BY created_at, id
+                ''', (session_id,))]
+                if not messages:
+                    return None
+                raw = json.dumps(messages, separators=(',', ':')).encode()
+                data = compress_archive(raw, codec)
+                connection.execute('''
+                    INSERT INTO archived_messages (session_id, codec, message_count, raw_bytes, data) VALUES (?, ?, ?, ?, ?)
+                ''', (session_id, codec, len(messages), len(raw), data))
+                connection.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+                # The delete trigger removed the entries under the message IDs, which new messages may reuse
+                connection.executemany('''
+                    INSERT INTO chat_messages_fts (rowid, content) VALUES (?, ?)
+                ''', [(-message_id, content) for role, content, created_at, message_id in messages])
+                connection.executemany('''
+                    INSERT INTO archived_search_index (id, session_id, role, created_at) VALUES (?, ?, ?, ?)
+                ''', [(-message_id, session_id, role, created_at) for role, content, created_at, message_id in messages])
+                connection.execute('''
+                    UPDATE chat_sessions SET archived_at = CURRENT_TIMESTAMP WHERE session_id = ?
+                ''', (session_id,))
+        return len(messages), len(raw), len(data)
+
+    def restore_chat_session(self, session_id):
+        """
+        Moves the archived messages of a chat session back into the messages table, if it was archived.
+        Messages written since the archival are kept, the restored ones are older and sort before them.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            int: The number of restored messages.
+        """
+        # A primary key lookup, the common case of a live session costs nothing more
+        if not self.fetch_one('SELECT 1 FROM archived_messages WHERE session_id = ?', (session_id,)):
+            return 0
+
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                archive = connection.execute('''
+                    SELECT codec, data FROM archived_messages WHERE session_id = ?
+                ''', (session_id,)).fetchone()
+                if archive is None:
+                    # Another thread or worker restored it first
+                    return 0
+                messages = self.unindex_archive(connection, session_id, archive)
+                summary = connection.execute('''
+                    SELECT message_count, last_message_at FROM chat_sessions WHERE session_id = ?
+                ''', (session_id,)).fetchone()
+                # Restored messages get new IDs, the insert trigger indexes them again
+                connection.executemany('''
+                    INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)
+                ''', [(session_id, role, content, created_at) for role, content, created_at, *_ in messages])
+                # The insert trigger counted the messages again, they were never uncounted
+                connection.execute('''
+                    UPDATE chat_sessions SET message_count = ?, last_message_at = ?, archived_at = NULL,
+                        restored_at = CURRENT_TIMESTAMP
+                    WHERE session_id = ?
+                ''', (summary['message_count'], summary['last_message_at'], session_id) if summary else (
+                    len(messages), None, session_id))
+                connection.execute('DELETE FROM archived_messages WHERE session_id = ?', (session_id,))
+        self.restored_sessions += 1
+        return len(messages)
+
+    @staticmethod
+    def unindex_archive(connection, session_id, archive):
+        """
+        Removes the full-text entries of the messages of an archived session.
+        Sessions archived before their entries were kept have none to remove.
+        Args:
+            connection (sqlite3.Connection): The connection, inside a transaction.
+            session_id (str): The ID of the chat session.
+            archive (sqlite3.Row): The codec and data of the archive.
+        Returns:
+            list: The archived messages.
+        """
+        messages = json.loads(decompress_archive(archive['data'], archive['codec']))
+        connection.executemany('''
+            INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content) VALUES ('delete', ?, ?)
+        ''', [(-message[3], message[1]) for message in messages if len(message) > 3])
+        connection.execute('DELETE FROM archived_search_index WHERE session_id = ?', (session_id,))
+        return messages
+
+    def incremental_vacuum(self, max_pages):
+        """
+        Returns up to a number of free pages to the file system, in a short write transaction.
+        Only databases created with auto_vacuum=INCREMENTAL support it.
+        Args:
+            max_pages (int): The maximum number of pages to free.
+        Returns:
+            int: The number of free pages left.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            with connection:
+                connection.execute(f'PRAGMA incremental_vacuum({int(max_pages)})').fetchall()
+            return connection.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def analyze(self, analysis_limit=1000):
+        """
+        Refreshes the statistics the query planner uses, reading at most a number of rows per index.
+        Args:
+            analysis_limit (int): The approximate number of rows examined per index, 0 for all of them.
+        """
+        connection = self.get_connection()
+        with self.write_lock:
+            connection.execute(f'PRAGMA analysis_limit={int(analysis_limit)}')
+            with connection:
+                connection.execute('ANALYZE')
+            # Passive checkpoints never wait for readers, they keep the WAL from growing after large deletions
+            connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+
+    def get_storage_stats(self):
+        """
+        Retrieves the size of the database file and of the archive.
+        Returns:
+            dict: Page, free page and archive metrics.
+        """
+        connection = self.get_connection()
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        archive = self.fetch_one('''
+            SELECT COUNT(*) AS sessions, COALESCE(SUM(message_count), 0) AS messages,
+                COALESCE(SUM(raw_bytes), 0) AS raw_bytes, COALESCE(SUM(LENGTH(data)), 0) AS bytes
+            FROM archived_messages
+        ''')
+        return {
+            "bytes": page_size * page_count,
+            "free_bytes": page_size * connection.execute('PRAGMA freelist_count').fetchone()[0],
+            "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}[connection.execute('PRAGMA auto_vacuum').fetchone()[0]],
+            "archived_sessions": archive["sessions"],
+            "archived_messages": archive["messages"],
+            "archive_raw_bytes": archive["raw_bytes"],
+            "archive_bytes": archive["bytes"],
+            "restored_sessions": self.restored_sessions,
+        }
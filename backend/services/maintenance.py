@@ -0,0 +1,268 @@
+"""
+module: backend.services.maintenance
+description: This module contains the DatabaseMaintenance class, which keeps the chat database small in the
+background: it deletes sessions past their retention period, archives cold sessions into compressed blobs,
+returns free pages to the file system and refreshes the query planner statistics.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import asyncio
+import os
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from .config import get_model_settings
+from .db_handler import zstandard
+
+class DatabaseMaintenance:
+    """
+    This class runs the database maintenance periodically. Every step works one session or a few
+    pages at a time in short transactions, with pauses in between, so live requests are never blocked for long.
+    """
+    def __init__(self, db_handler, state=None, on_delete=None, interval=None):
+        """
+        Initializes the DatabaseMaintenance class.
+        Args:
+            db_handler (DatabaseHandler): The database to maintain.
+            state (StateBackend, optional): The state shared with other workers, so only one of them runs the maintenance at a time.
+            on_delete (callable, optional): Called with the ID of every deleted session, to drop it from memory.
+            interval (float, optional): Seconds between runs, 0 disables the periodic runs.
+        """
+        self.db_handler = db_handler
+        self.state = state
+        self.on_delete = on_delete
+        self.interval = interval if interval is not None else float(os.getenv('DB_MAINTENANCE_INTERVAL', '3600'))
+        # Days without activity before a session is deleted, 0 keeps sessions forever
+        self.retention_days = float(os.getenv('DB_RETENTION_DAYS', '0'))
+        self.model_retention_days = get_model_settings('DB_MODEL_RETENTION_DAYS', float)
+        # Days without activity before the messages of a session are archived, 0 keeps them uncompressed
+        self.archive_after_days = float(os.getenv('DB_ARCHIVE_AFTER_DAYS', '0'))
+        self.codec = os.getenv('DB_ARCHIVE_CODEC', 'zstd' if zstandard else 'gzip').lower()
+        if self.codec == 'zstd' and zstandard is None:
+            print("DB_ARCHIVE_CODEC=zstd needs the zstandard package, archiving with gzip instead")
+            self.codec = 'gzip'
+        self.batch_size = int(os.getenv('DB_MAINTENANCE_BATCH', '100'))
+        # Pause between two sessions or two vacuum steps, so queued requests can use the database
+        self.pause = float(os.getenv('DB_MAINTENANCE_PAUSE', '0.05'))
+        self.vacuum_pages = int(os.getenv('DB_VACUUM_PAGES', '256'))
+        self.analyze_interval = float(os.getenv('DB_ANALYZE_INTERVAL', '86400'))
+        self.task = None
+        self.running = False
+        self.analyzed_at = None
+        self.vacuum_hint_shown = False
+
+        self.runs = 0
+        self.last_run = {}
+        self.deleted_sessions = 0
+        self.deleted_messages = 0
+        self.archived_sessions = 0
+        self.archived_messages = 0
+
+    @staticmethod
+    def cutoff(days):
+        """
+        Computes the time sessions must have been active since to be kept.
+        Args:
+            days (float): The number of days.
+        Returns:
+            str: The UTC timestamp, in the format SQLite uses for CURRENT_TIMESTAMP.
+        """
+        return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    async def delete_expired(self):
+        """
+        Deletes the sessions past the retention period of their model.
+        Returns:
+            tuple: The number of deleted sessions and messages.
+        """
+        # Models with their own retention first, then every other model with the default one
+        rules = [([model], days) for model, days in self.model_retention_days.items() if days > 0]
+        if self.retention_days > 0:
+            rules.append((None, self.retention_days))
+
+        sessions = messages = 0
+        for models, days in rules:
+            exclude = list(self.model_retention_days) if models is None else ()
+            while True:
+                session_ids = await self.db_handler.run_async(
+                    self.db_handler.get_sessions_inactive_since, self.cutoff(days), models, exclude, None, self.batch_size
+                )
+                for session_id in session_ids:
+                    messages += await self.db_handler.run_async(self.db_handler.delete_chat_session, session_id)
+                    sessions += 1
+                    if self.on_delete:
+                        self.on_delete(session_id)
+                    await asyncio.sleep(self.pause)
+                if len(session_ids) < self.batch_size:
+                    break
+        return sessions, messages
+
+    async def archive_cold(self):
+        """
+        Archives the messages of the sessions without activity for longer than the archival period.
+        Returns:
+            tuple: The number of archived sessions and messages, their size and the compressed size in bytes.
+        """
+        sessions = messages = raw_bytes = archive_bytes = 0
+        if self.archive_after_days <= 0:
+            return sessions, messages, raw_bytes, archive_bytes
+
+        cutoff = self.cutoff(self.archive_after_days)
+        while True:
+            # Empty sessions have nothing to archive and would be returned again on every pass
+            session_ids = await self.db_handler.run_async(
+                self.db_handler.get_sessions_inactive_since, cutoff, None, (), False, self.batch_size, True
+            )
+            batch_sessions = 0
+            for session_id in session_ids:
+                archived = await self.db_handler.run_async(self.db_handler.archive_chat_session, session_id, self.codec)
+                if archived:
+                    batch_sessions += 1
+                    messages += archived[0]
+                    raw_bytes += archived[1]
+                    archive_bytes += archived[2]
+                await asyncio.sleep(self.pause)
+            sessions += batch_sessions
+            # A batch that archived nothing would be returned again as it is, the next run retries it
+            if len(session_ids) < self.batch_size or not batch_sessions:
+                break
+        return sessions, messages, raw_bytes, archive_bytes
+
+    async def vacuum(self):
+        """
+        Returns the free pages to the file system a few at a time.
+        Returns:
+            int: The number of free pages left, or None if the database was created without incremental vacuum.
+        """
+        storage = await self.db_handler.run_async(self.db_handler.get_storage_stats)
+        if storage["auto_vacuum"] != "incremental":
+            # Databases created before incremental vacuum was enabled keep their free pages for reuse
+            if storage["free_bytes"] and not self.vacuum_hint_shown:
+                print(
+                    f"{storage['free_bytes']} bytes of {self.db_handler.db_path} are free but only reused, run "
+                    "'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;' once while the API is stopped to return them to the file system"
+                )
+                self.vacuum_hint_shown = True
+            return None
+        while True:
+            free_pages = await self.db_handler.run_async(self.db_handler.incremental_vacuum, self.vacuum_pages)
+            if not free_pages:
+                return free_pages
+            await asyncio.sleep(self.pause)
+
+    async def run_once(self):
+        """
+        Runs every maintenance step once. With a shared state backend the run is skipped
+        while another worker is running it.
+        Returns:
+            dict: What the run did, or None if it was skipped.
+        """
+        if self.running:
+            return None
+        lease = self.state.lease("maintenance", 1, wait=False) if self.state and self.state.shared else None
+        if lease:
+            async with lease as token:
+                if token is None:
+                    return None
+                return await self.run_steps()
+        return await self.run_steps()
+
+    async def run_steps(self):
+        """
+        Deletes expired sessions, archives cold ones, frees pages and refreshes the statistics if the data changed.
+        Returns:
+            dict: What the run did.
+        """
+        self.running = True
+        started_at = time.perf_counter()
+        try:
+            deleted_sessions, deleted_messages = await self.delete_expired()
+            archived_sessions, archived_messages, raw_bytes, archive_bytes = await self.archive_cold()
+            free_pages = await self.vacuum()
+
+            analyzed = False
+            changed = deleted_sessions or archived_sessions
+            if changed or self.analyzed_at is None or time.monotonic() - self.analyzed_at > self.analyze_interval:
+                await self.db_handler.run_async(self.db_handler.analyze)
+                self.analyzed_at = time.monotonic()
+                analyzed = True
+        finally:
+            self.running = False
+
+        self.runs += 1
+        self.deleted_sessions += deleted_sessions
+        self.deleted_messages += deleted_messages
+        self.archived_sessions += archived_sessions
+        self.archived_messages += archived_messages
+        self.last_run = {
+            "finished_at": time.time(),
+            "seconds": time.perf_counter() - started_at,
+            "deleted_sessions": deleted_sessions,
+            "deleted_messages": deleted_messages,
+            "archived_sessions": archived_sessions,
+            "archived_messages": archived_messages,
+            "compression_ratio": raw_bytes / archive_bytes if archive_bytes else None,
+            "free_pages": free_pages,
+            "analyzed": analyzed,
+        }
+        if changed:
+            print(
+                f"Database maintenance deleted {deleted_sessions} sessions ({deleted_messages} messages) "
+                f"and archived {archived_sessions} sessions ({archived_messages} messages) in {self.last_run['seconds']:.2f}s"
+            )
+        return self.last_run
+
+    async def run_periodically(self):
+        """
+        Runs the maintenance every interval until cancelled.
+        """
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error running the database maintenance: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """
+        Starts the periodic maintenance task.
+        """
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run_periodically())
+
+    async def stop(self):
+        """
+        Stops the periodic maintenance task.
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        """
+        Returns the maintenance settings and totals.
+        Returns:
+            dict: Retention and archival settings, totals since startup and the last run.
+        """
+        return {
+            "interval": self.interval,
+            "retention_days": self.retention_days,
+            "model_retention_days": self.model_retention_days,
+            "archive_after_days": self.archive_after_days,
+            "codec": self.codec,
+            "running": self.running,
+            "runs": self.runs,
+            "deleted_sessions": self.deleted_sessions,
+            "deleted_messages": self.deleted_messages,
+            "archived_sessions": self.archived_sessions,
+            "archived_messages": self.archived_messages,
+            "last_run": self.last_run,
+        }
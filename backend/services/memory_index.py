@@ -0,0 +1,297 @@
+"""
+module: backend.services.memory_index
+description: This module contains the MemoryIndex class, which embeds the stored memories with Ollama and
+retrieves the ones most relevant to a prompt with an in-memory cosine similarity index. Retrieval is
+limited to the memories of the prompt's session unless MEMORY_SCOPE is global.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import asyncio
+import hashlib
+import os
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from .context_builder import ContextBuilder
+
+MEMORY_HEADER = "Relevant memories from earlier conversations:"
+
+class MemoryIndex:
+    """
+    This class keeps the embeddings of all memories in a single normalized float32 matrix,
+    so a lookup is one matrix-vector product.
+    """
+    def __init__(self, client, db_handler, model=None, top_k=None, min_score=None, token_budget=None):
+        """
+        Initializes the MemoryIndex class.
+        Args:
+            client (ollama.AsyncClient): The client used to compute embeddings.
+            db_handler (DatabaseHandler): The database holding the memories and their embeddings.
+            model (str, optional): The embedding model.
+            top_k (int, optional): The maximum number of memories added to a prompt.
+            min_score (float, optional): The minimum cosine similarity of a memory added to a prompt.
+            token_budget (int, optional): The maximum number of prompt tokens used by memories.
+        """
+        self.client = client
+        self.db_handler = db_handler
+        self.enabled = os.getenv('MEMORY_RETRIEVAL', 'true').lower() in ('1', 'true', 'yes')
+        # "session" only retrieves memories of the prompt's own session, "global" those of every session
+        self.scope = os.getenv('MEMORY_SCOPE', 'session').lower()
+        self.model = model or os.getenv('EMBEDDING_MODEL', 'nomic-embed-text')
+        self.top_k = top_k or int(os.getenv('MEMORY_TOP_K', '5'))
+        self.min_score = min_score if min_score is not None else float(os.getenv('MEMORY_MIN_SCORE', '0.3'))
+        self.token_budget = token_budget or int(os.getenv('MEMORY_TOKEN_BUDGET', '512'))
+        self.batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))
+        # Embeddings of recent prompts and memories, keyed by content hash
+        self.cache = OrderedDict()
+        self.cache_size = int(os.getenv('EMBEDDING_CACHE_SIZE', '1024'))
+        # Seconds to wait before calling the embedding model again after it failed, e.g. because it is not pulled
+        self.error_backoff = float(os.getenv('MEMORY_ERROR_BACKOFF', '60'))
+        self.retry_at = 0.0
+
+        # Row i of vectors is the embedding of memories[i], rows past count are spare capacity
+        self.vectors = None
+        self.memories = []
+        self.positions = {}
+        # Rows of the memories of each session
+        self.session_positions = {}
+        self.count = 0
+        self.loaded = False
+        self.load_lock = asyncio.Lock()
+
+    @staticmethod
+    def content_hash(text):
+        """
+        Hashes a text to key its embedding.
+        Args:
+            text (str): The embedded text.
+        Returns:
+            str: The hex digest of the text.
+        """
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    @staticmethod
+    def normalize(vectors):
+        """
+        Scales vectors to unit length, so their dot product is the cosine similarity.
+        Args:
+            vectors (numpy.ndarray): The vectors, one per row.
+        Returns:
+            numpy.ndarray: The normalized float32 vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def cache_put(self, key, vector):
+        """
+        Adds an embedding to the LRU cache.
+        Args:
+            key (str): The content hash.
+            vector (numpy.ndarray): The normalized embedding.
+        """
+        self.cache[key] = vector
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def embed(self, texts, persist=False):
+        """
+        Computes the normalized embeddings of texts. Cached embeddings are reused, and the
+        rest are requested from Ollama in batches, each distinct text only once.
+        Args:
+            texts (list): The texts to embed.
+            persist (bool): Whether to look up and store the embeddings in the database.
+        Returns:
+            numpy.ndarray: The embeddings, one row per text.
+        """
+        keys = [self.content_hash(text) for text in texts]
+        found = {}
+        for key in keys:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                found[key] = self.cache[key]
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing and persist:
+            stored = await self.db_handler.run_async(self.db_handler.get_embeddings, self.model, list(missing))
+            for key, blob in stored.items():
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+                del missing[key]
+
+        computed = []
+        pending = list(missing.items())
+        for offset in range(0, len(pending), self.batch_size):
+            batch = pending[offset:offset + self.batch_size]
+            response = await self.client.embed(model=self.model, input=[text for _, text in batch])
+            for (key, _), vector in zip(batch, self.normalize(response["embeddings"])):
+                found[key] = vector
+                computed.append((key, vector.shape[0], vector.tobytes()))
+
+        if computed and persist:
+            await self.db_handler.run_async(self.db_handler.save_embeddings, self.model, computed)
+
+        for key in set(keys):
+            self.cache_put(key, found[key])
+        return np.stack([found[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+
+    def append(self, memories, vectors):
+        """
+        Adds memories to the index, growing the matrix geometrically so appends stay cheap.
+        Args:
+            memories (list): The memory rows with id, session_id and memory.
+            vectors (numpy.ndarray): Their normalized embeddings.
+        """
+        if not memories:
+            return
+        if self.vectors is None:
+            self.vectors = np.empty((max(64, len(memories)), vectors.shape[1]), dtype=np.float32)
+        elif self.count + len(memories) > self.vectors.shape[0]:
+            grown = np.empty((max(self.vectors.shape[0] * 2, self.count + len(memories)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+
+        self.vectors[self.count:self.count + len(memories)] = vectors
+        for memory in memories:
+            self.positions[memory["id"]] = self.count
+            self.session_positions.setdefault(memory["session_id"], []).append(self.count)
+            self.memories.append(memory)
+            self.count += 1
+
+    def is_available(self):
+        """
+        Checks whether retrieval is enabled and the embedding model is not backing off after an error.
+        Returns:
+            bool: True if the index can be used.
+        """
+        return self.enabled and time.monotonic() >= self.retry_at
+
+    def backoff(self, e):
+        """
+        Stops calling the embedding model for a while after an error.
+        Args:
+            e (Exception): The error.
+        """
+        print(f"Error embedding with model {self.model}, retrying in {self.error_backoff:.0f}s: {e}")
+        self.retry_at = time.monotonic() + self.error_backoff
+
+    async def load(self):
+        """
+        Loads the embeddings of all memories, embedding the memories that have none yet.
+        Returns:
+            bool: True if the index is loaded.
+        """
+        if self.loaded or not self.is_available():
+            return self.loaded
+
+        async with self.load_lock:
+            if self.loaded:
+                return True
+            try:
+                memories = await self.db_handler.run_async(self.db_handler.get_memories)
+                memories = [{"id": row["id"], "session_id": row["session_id"], "memory": row["memory"]} for row in memories]
+                vectors = await self.embed([memory["memory"] for memory in memories], persist=True)
+                self.append(memories, vectors)
+                self.loaded = True
+                print(f"Memory index loaded: {self.count} memories")
+            except Exception as e:
+                self.backoff(e)
+        return self.loaded
+
+    async def add(self, memory_id, session_id, memory):
+        """
+        Embeds a new memory and adds it to the index. Before the index is loaded this
+        is left to load, which reads every memory from the database.
+        Args:
+            memory_id (int): The ID of the memory row.
+            session_id (str): The ID of the chat session.
+            memory (str): The memory.
+        """
+        if not self.enabled:
+            return
+        async with self.load_lock:
+            if not self.loaded or memory_id in self.positions:
+                return
+            try:
+                vectors = await self.embed([memory], persist=True)
+                self.append([{"id": memory_id, "session_id": session_id, "memory": memory}], vectors)
+            except Exception as e:
+                print(f"Error indexing memory {memory_id}: {e}")
+
+    async def search(self, text, top_k=None, session_id=None):
+        """
+        Finds the memories most similar to a text. The text is only embedded if there are memories to compare.
+        Args:
+            text (str): The text to compare against, usually the user prompt.
+            top_k (int, optional): The maximum number of memories to return.
+            session_id (str, optional): Only searches the memories of this session.
+        Returns:
+            list: The memories with their similarity score, most similar first.
+        """
+        if not await self.load() or not self.count:
+            return []
+
+        if session_id is None:
+            positions = np.arange(self.count)
+            vectors = self.vectors[:self.count]
+        else:
+            positions = np.asarray(self.session_positions.get(session_id, ()), dtype=np.intp)
+            if not len(positions):
+                return []
+            vectors = self.vectors[positions]
+
+        query = (await self.embed([text]))[0]
+        scores = vectors @ query
+        top_k = min(top_k or self.top_k, len(positions))
+        # argpartition finds the top k in linear time, only those k are sorted
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            dict(self.memories[positions[index]], score=float(scores[index]))
+            for index in best if scores[index] >= self.min_score
+        ]
+
+    def format_memories(self, memories):
+        """
+        Formats memories as a system message, dropping the least relevant ones past the token budget.
+        Args:
+            memories (list): The memories, most relevant first.
+        Returns:
+            str: The message content, or None if no memory fits.
+        """
+        lines = [MEMORY_HEADER]
+        used = ContextBuilder.estimate_tokens(MEMORY_HEADER)
+        for memory in memories:
+            line = "- " + memory["memory"]
+            cost = ContextBuilder.estimate_tokens(line)
+            if used + cost > self.token_budget:
+                break
+            lines.append(line)
+            used += cost
+        return "\n".join(lines) if len(lines) > 1 else None
+
+    async def retrieve(self, prompt, session_id=None):
+        """
+        Retrieves the memories relevant to a prompt, formatted for the model.
+        Retrieval never fails a request, errors only disable it for a while.
+        Args:
+            prompt (str): The user prompt.
+            session_id (str, optional): The session of the prompt, whose memories are searched unless the scope is global.
+        Returns:
+            str: The memories as message content, or None if there are none.
+        """
+        if not self.is_available():
+            return None
+        try:
+            scope = None if self.scope == 'global' else session_id
+            return self.format_memories(await self.search(prompt, session_id=scope))
+        except Exception as e:
+            self.backoff(e)
+            return None
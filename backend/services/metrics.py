@@ -0,0 +1,227 @@
+"""
+module: backend.services.metrics
+description: This module contains lightweight Prometheus counters and histograms for the request path,
+their text exposition for /metrics, and the per-request timings reported in Server-Timing headers.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import bisect
+import contextvars
+import os
+import threading
+
+ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+
+# Timings of the current request, a dict while Server-Timing is enabled and the request is in progress
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+REGISTRY = []
+
+def escape_label(value):
+    """
+    Escapes a label value for the Prometheus text format.
+    Args:
+        value (str): The label value.
+    Returns:
+        str: The escaped value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """
+    This class holds the labelled series of a metric. Series are updated from the event loop and
+    from database threads, so updates take a lock.
+    """
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        """
+        Initializes the Metric class.
+        Args:
+            name (str): The metric name.
+            description (str): The help text.
+            labelnames (tuple): The label names, in the order label values are passed.
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, labels, extra=None):
+        """
+        Formats label values as a Prometheus label set.
+        Args:
+            labels (tuple): The label values.
+            extra (tuple, optional): An additional (name, value) pair, e.g. the bucket bound.
+        Returns:
+            str: The label set, empty if there are no labels.
+        """
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(f'{extra[0]}="{extra[1]}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        """
+        Renders the metric in the Prometheus text format.
+        Returns:
+            list: The lines of the metric.
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            series = list(self.series.items())
+        for labels, value in series:
+            lines.extend(self.render_series(labels, value))
+        return lines
+
+
+class Counter(Metric):
+    """
+    This class counts events.
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, value=1):
+        """
+        Increments the series of the label values.
+        Args:
+            *labels: The label values.
+            value (float): The amount to add.
+        """
+        if not ENABLED:
+            return
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render_series(self, labels, value):
+        return [f'{self.name}{self.format_labels(labels)} {value}']
+
+
+class Histogram(Metric):
+    """
+    This class counts observations in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Initializes the Histogram class.
+        Args:
+            name (str): The metric name.
+            description (str): The help text.
+            labelnames (tuple): The label names.
+            buckets (tuple): The upper bounds of the buckets, in increasing order.
+        """
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        """
+        Records an observation.
+        Args:
+            value (float): The observed value.
+            *labels: The label values.
+        """
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # Per-bucket counts plus the +Inf bucket, the sum and the count
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render_series(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{self.format_labels(labels, ("le", bound))} {cumulative}')
+        lines.append(f'{self.name}_sum{self.format_labels(labels)} {total}')
+        lines.append(f'{self.name}_count{self.format_labels(labels)} {count}')
+        return lines
+
+
+HTTP_REQUESTS = Counter('assistant_http_requests_total', 'HTTP requests by route and status.', ('method', 'route', 'status'))
+HTTP_DURATION = Histogram('assistant_http_request_duration_seconds', 'Time until the response headers are sent.', ('method', 'route'))
+QUEUE_WAIT = Histogram('assistant_queue_wait_seconds', 'Time spent waiting for a generation slot.', ('model',))
+TIME_TO_FIRST_TOKEN = Histogram('assistant_time_to_first_token_seconds', 'Time from the start of a generation to its first token, including queueing.', ('model',))
+GENERATIONS = Counter('assistant_generations_total', 'Generations by outcome.', ('model', 'status'))
+QUOTA_REJECTIONS = Counter('assistant_quota_rejections_total', 'Requests rejected because a client exceeded its quota.', ('limit',))
+CANCELLATIONS = Counter('assistant_request_cancellations_total', 'Requests cancelled, timed out or abandoned by the client.', ('reason',))
+LOAD_DURATION = Histogram('assistant_model_load_seconds', 'Model load time reported by Ollama.', ('model',))
+PROMPT_EVAL_DURATION = Histogram('assistant_prompt_eval_seconds', 'Prompt evaluation time reported by Ollama.', ('model',))
+EVAL_DURATION = Histogram('assistant_eval_seconds', 'Token generation time reported by Ollama.', ('model',))
+PROMPT_TOKENS = Counter('assistant_prompt_tokens_total', 'Prompt tokens evaluated.', ('model',))
+GENERATED_TOKENS = Counter('assistant_generated_tokens_total', 'Tokens generated.', ('model',))
+TOKENS_PER_SECOND = Histogram('assistant_tokens_per_second', 'Generation throughput per request.', ('model',), THROUGHPUT_BUCKETS)
+DB_DURATION = Histogram('assistant_db_query_seconds', 'Execution time of DatabaseHandler methods.', ('method',))
+
+def observe_timings(model, timings):
+    """
+    Records the load and evaluation timings of an Ollama response.
+    Args:
+        model (str): The model name.
+        timings (dict): The timing fields of the response, durations in nanoseconds.
+    """
+    if not ENABLED:
+        return
+    if timings.get("load_duration") is not None:
+        LOAD_DURATION.observe(timings["load_duration"] / 1e9, model)
+    if timings.get("prompt_eval_duration") is not None:
+        PROMPT_EVAL_DURATION.observe(timings["prompt_eval_duration"] / 1e9, model)
+    if timings.get("prompt_eval_count"):
+        PROMPT_TOKENS.inc(model, value=timings["prompt_eval_count"])
+    if timings.get("eval_count"):
+        GENERATED_TOKENS.inc(model, value=timings["eval_count"])
+        if timings.get("eval_duration"):
+            EVAL_DURATION.observe(timings["eval_duration"] / 1e9, model)
+            TOKENS_PER_SECOND.observe(timings["eval_count"] / (timings["eval_duration"] / 1e9), model)
+
+def record_timing(name, seconds):
+    """
+    Adds a duration to the Server-Timing entries of the current request.
+    Args:
+        name (str): The entry name, e.g. "queue" or "db".
+        seconds (float): The duration.
+    """
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+def format_server_timing(timings, total):
+    """
+    Formats request timings as a Server-Timing header value.
+    Args:
+        timings (dict): The durations by entry name, in seconds.
+        total (float): The total request time, in seconds.
+    Returns:
+        str: The header value.
+    """
+    entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items()]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+def render():
+    """
+    Renders every metric in the Prometheus text format.
+    Returns:
+        str: The exposition.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,183 @@
+"""
+module: backend.services.model_registry
+description: This module contains the ModelRegistry class, which caches the model catalog of the Ollama
+daemon, refreshes it in the background and lazily fetches per-model metadata.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import asyncio
+import hashlib
+import os
+import time
+
+class ModelRegistry:
+    """
+    This class keeps a TTL-cached list of the models available on Ollama.
+    """
+    def __init__(self, client, ttl=None, refresh_interval=None):
+        """
+        Initializes the ModelRegistry class.
+        Args:
+            client (ollama.AsyncClient): The client used to reach Ollama.
+            ttl (float, optional): Seconds after which the cached list is considered stale.
+            refresh_interval (float, optional): Seconds between background refreshes.
+        """
+        self.client = client
+        self.ttl = ttl or float(os.getenv('MODEL_LIST_TTL', '30'))
+        self.refresh_interval = refresh_interval or float(os.getenv('MODEL_REFRESH_INTERVAL', str(self.ttl)))
+        # Unknown models trigger a refresh at most this often, so typos cannot hammer the daemon
+        self.miss_refresh_interval = float(os.getenv('MODEL_MISS_REFRESH_INTERVAL', '2'))
+        self.models = {}
+        self.etag = None
+        self.fetched_at = None
+        self.details = {}
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_task = None
+        # Set once the catalog has been fetched successfully
+        self.loaded = asyncio.Event()
+
+    def is_stale(self):
+        """
+        Checks whether the cached model list has expired.
+        Returns:
+            bool: True if the list was never fetched or is older than the TTL.
+        """
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl
+
+    async def refresh(self):
+        """
+        Fetches the model list from Ollama. The previous list is kept if Ollama cannot be reached.
+        Returns:
+            dict: A mapping of model name to its summary.
+        """
+        started_at = time.monotonic()
+        async with self.refresh_lock:
+            if self.fetched_at is not None and self.fetched_at >= started_at:
+                # Another request refreshed the list while this one was waiting
+                return self.models
+
+            try:
+                response = await self.client.list()
+            except Exception as e:
+                print(f"Error retrieving models: {e}")
+                # Keep serving the last known list and retry shortly
+                self.fetched_at = time.monotonic() - self.ttl + self.miss_refresh_interval
+                return self.models
+
+            models = {}
+            for model in response.get("models", []):
+                details = model.get("details") or {}
+                models[model.model] = {
+                    "name": model.model,
+                    "size": model.get("size"),
+                    "digest": model.get("digest"),
+                    "modified_at": str(model.get("modified_at")) if model.get("modified_at") else None,
+                    "family": details.get("family"),
+                    "parameter_size": details.get("parameter_size"),
+                    "quantization_level": details.get("quantization_level"),
+                }
+
+            fingerprint = "\n".join(f"{name}@{models[name]['digest']}" for name in sorted(models))
+            self.etag = hashlib.sha1(fingerprint.encode()).hexdigest()
+            self.models = models
+            self.fetched_at = time.monotonic()
+            self.loaded.set()
+            return models
+
+    async def list_models(self):
+        """
+        Retrieves the cached model list, refreshing it first if it has expired.
+        Returns:
+            list: The model summaries.
+        """
+        if self.is_stale():
+            await self.refresh()
+        return list(self.models.values())
+
+    async def get_names(self):
+        """
+        Retrieves the names of the available models.
+        Returns:
+            list: The model names.
+        """
+        return [model["name"] for model in await self.list_models()]
+
+    async def has_model(self, model_name):
+        """
+        Checks whether a model is available. A model missing from the cache triggers a
+        refresh, so newly pulled models are accepted without a restart.
+        Args:
+            model_name (str): The model name.
+        Returns:
+            bool: True if the model is available.
+        """
+        if self.is_stale():
+            await self.refresh()
+        if model_name in self.models:
+            return True
+
+        if time.monotonic() - (self.fetched_at or 0) > self.miss_refresh_interval:
+            await self.refresh()
+        return model_name in self.models
+
+    async def get_details(self, model_name):
+        """
+        Retrieves the metadata of a model from ollama.show. The result is memoized per model digest.
+        Args:
+            model_name (str): The model name.
+        Returns:
+            dict: The model summary with its context length and capabilities, or None if the model is unknown.
+        """
+        if not await self.has_model(model_name):
+            return None
+
+        summary = self.models[model_name]
+        cached = self.details.get(model_name)
+        if cached and cached["digest"] == summary["digest"]:
+            return cached
+
+        try:
+            response = await self.client.show(model_name)
+        except Exception as e:
+            print(f"Error retrieving details for model {model_name}: {e}")
+            return summary
+
+        model_info = response.get("modelinfo") or {}
+        details = dict(summary)
+        details["context_length"] = next(
+            (value for key, value in model_info.items() if key.endswith(".context_length")),
+            None
+        )
+        details["capabilities"] = list(response.get("capabilities") or [])
+        self.details[model_name] = details
+        return details
+
+    async def refresh_periodically(self):
+        """
+        Refreshes the model list every refresh interval until cancelled.
+        """
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """
+        Starts the background refresh task.
+        """
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.refresh_periodically())
+
+    async def stop(self):
+        """
+        Stops the background refresh task.
+        """
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
@@ -0,0 +1,269 @@
+"""
+module: backend.services.quotas
+description: This module contains the ClientQuotas class, which rate limits each client, identified by its
+API key or IP address, with token buckets on both requests and generated tokens.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import hashlib
+import math
+import os
+import time
+
+from collections import OrderedDict
+
+from . import metrics
+
+class QuotaExceededError(Exception):
+    """
+    Raised when a client has used up its request or token quota.
+    """
+    def __init__(self, message, retry_after=1, headers=None):
+        """
+        Initializes the QuotaExceededError class.
+        Args:
+            message (str): The error message.
+            retry_after (int): Seconds the client should wait before retrying.
+            headers (dict, optional): The quota headers of the client.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+
+class TokenBucket:
+    """
+    This class refills at a constant rate up to a capacity. Requests take one token up front, generated
+    tokens are taken once known, which may leave the bucket in debt until it refills.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity):
+        """
+        Initializes the TokenBucket class.
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): The maximum number of tokens, i.e. the allowed burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        """
+        Adds the tokens accumulated since the last update.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, amount):
+        """
+        Takes tokens, going into debt if there are not enough.
+        Args:
+            amount (float): The number of tokens.
+        """
+        self.refill()
+        self.tokens -= amount
+
+    def wait_time(self, amount=1):
+        """
+        Computes how long until the bucket holds a number of tokens.
+        Args:
+            amount (float): The number of tokens.
+        Returns:
+            float: Seconds to wait, 0 if they are available now.
+        """
+        self.refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def reset_time(self):
+        """
+        Returns:
+            float: Seconds until the bucket is full again.
+        """
+        self.refill()
+        return (self.capacity - self.tokens) / self.rate
+
+    def is_full(self):
+        """
+        Returns:
+            bool: True if the bucket has refilled completely, i.e. the client used none of its quota lately.
+        """
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class ClientQuotas:
+    """
+    This class keeps a request bucket and a generated token bucket per client. A limit of 0 disables that bucket.
+    Buckets live in the memory of the worker, so with several workers each enforces its own share.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        Initializes the ClientQuotas class.
+        Args:
+            requests_per_minute (float, optional): Requests each client may send per minute.
+            tokens_per_minute (float, optional): Tokens each client may have generated per minute.
+        """
+        self.requests_per_minute = (
+            requests_per_minute if requests_per_minute is not None else float(os.getenv('QUOTA_REQUESTS_PER_MINUTE', '0'))
+        )
+        self.tokens_per_minute = (
+            tokens_per_minute if tokens_per_minute is not None else float(os.getenv('QUOTA_TOKENS_PER_MINUTE', '0'))
+        )
+        # Bursts default to one minute worth of quota
+        self.request_burst = float(os.getenv('QUOTA_REQUEST_BURST', str(self.requests_per_minute)))
+        self.token_burst = float(os.getenv('QUOTA_TOKEN_BURST', str(self.tokens_per_minute)))
+        # When set, only these API keys identify a client, other requests are limited by IP address
+        self.api_keys = {key.strip() for key in os.getenv('QUOTA_API_KEYS', '').split(',') if key.strip()}
+        # Behind a reverse proxy the client address is the first X-Forwarded-For entry
+        self.trust_forwarded = os.getenv('QUOTA_TRUST_FORWARDED', 'false').lower() in ('1', 'true', 'yes')
+        self.max_clients = int(os.getenv('QUOTA_MAX_CLIENTS', '10000'))
+        # client -> (request bucket, token bucket), least recently seen first
+        self.clients = OrderedDict()
+
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    def identify(self, headers, host=None):
+        """
+        Identifies the client of a request by its API key, or by its IP address.
+        Keys are hashed, so they never appear in memory dumps, logs or headers.
+        Args:
+            headers (Mapping): The request headers.
+            host (str, optional): The address of the peer.
+        Returns:
+            str: The client identifier.
+        """
+        api_key = headers.get('x-api-key')
+        authorization = headers.get('authorization', '')
+        if not api_key and authorization.lower().startswith('bearer '):
+            api_key = authorization[7:].strip()
+        if api_key and (not self.api_keys or api_key in self.api_keys):
+            return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+        forwarded = headers.get('x-forwarded-for') if self.trust_forwarded else None
+        return "ip:" + (forwarded.split(',')[0].strip() if forwarded else host or "unknown")
+
+    def get_buckets(self, client):
+        """
+        Retrieves the buckets of a client, creating them on first use and forgetting idle clients with full buckets.
+        Args:
+            client (str): The client identifier.
+        Returns:
+            tuple: The request bucket and the token bucket, None for a disabled limit.
+        """
+        buckets = self.clients.get(client)
+        if buckets:
+            self.clients.move_to_end(client)
+            return buckets
+
+        buckets = self.clients[client] = (
+            TokenBucket(self.requests_per_minute / 60, self.request_burst) if self.requests_per_minute > 0 else None,
+            TokenBucket(self.tokens_per_minute / 60, self.token_burst) if self.tokens_per_minute > 0 else None,
+        )
+        while len(self.clients) > self.max_clients:
+            oldest, oldest_buckets = next(iter(self.clients.items()))
+            if not all(bucket is None or bucket.is_full() for bucket in oldest_buckets):
+                # A client still paying off its quota must not get a fresh one
+                self.clients.move_to_end(oldest)
+                break
+            del self.clients[oldest]
+        return buckets
+
+    def headers(self, client):
+        """
+        Builds the headers telling a client its current quota, so it can throttle itself.
+        Args:
+            client (str): The client identifier.
+        Returns:
+            dict: The X-RateLimit headers of the enabled limits.
+        """
+        headers = {}
+        if not self.enabled:
+            return headers
+        for name, bucket in zip(('Requests', 'Tokens'), self.get_buckets(client)):
+            if bucket:
+                reset_time = bucket.reset_time()
+                headers[f"X-RateLimit-Limit-{name}"] = str(int(bucket.capacity))
+                headers[f"X-RateLimit-Remaining-{name}"] = str(max(0, math.floor(bucket.tokens)))
+                headers[f"X-RateLimit-Reset-{name}"] = str(math.ceil(reset_time))
+        return headers
+
+    def acquire(self, client):
+        """
+        Admits a request of a client, taking one request from its quota.
+        Args:
+            client (str): The client identifier.
+        Returns:
+            dict: The quota headers after the request was counted.
+        Raises:
+            QuotaExceededError: If the client sent too many requests or generated too many tokens recently.
+        """
+        if not self.enabled:
+            return {}
+        requests, tokens = self.get_buckets(client)
+        for limit, bucket in (('requests', requests), ('tokens', tokens)):
+            if bucket is None:
+                continue
+            wait_time = bucket.wait_time(1)
+            if wait_time > 0:
+                self.rejected += 1
+                metrics.QUOTA_REJECTIONS.inc(limit)
+                raise QuotaExceededError(
+                    f"The {limit} quota is used up, retry in {math.ceil(wait_time)}s.",
+                    max(1, math.ceil(wait_time)),
+                    self.headers(client)
+                )
+        if requests:
+            requests.take(1)
+        return self.headers(client)
+
+    def wait_time(self, client):
+        """
+        Computes how long a client has to wait until its token quota allows another generation.
+        Args:
+            client (str): The client identifier.
+        Returns:
+            float: Seconds to wait, 0 if it can generate now.
+        """
+        if not self.enabled:
+            return 0.0
+        tokens = self.get_buckets(client)[1]
+        return tokens.wait_time(1) if tokens else 0.0
+
+    def record_tokens(self, client, count):
+        """
+        Takes the tokens generated for a client from its quota.
+        Args:
+            client (str): The client identifier.
+            count (int): The number of generated tokens.
+        """
+        if not self.enabled or not count:
+            return
+        tokens = self.get_buckets(client)[1]
+        if tokens:
+            tokens.take(count)
+
+    def stats(self):
+        """
+        Returns the quota settings and usage.
+        Returns:
+            dict: The limits, the number of tracked clients and the number of rejected requests.
+        """
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "request_burst": self.request_burst,
+            "token_burst": self.token_burst,
+            "clients": len(self.clients),
+            "rejected": self.rejected,
+        }
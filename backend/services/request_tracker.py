@@ -0,0 +1,216 @@
+"""
+module: backend.services.request_tracker
+description: This module contains the ActiveRequest and RequestTracker classes, which give every chat request
+an ID and a deadline so it can be cancelled explicitly, on timeout or when the client disconnects.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+import os
+import time
+import uuid
+
+from . import metrics
+from .config import get_model_settings
+
+class RequestCancelledError(Exception):
+    """
+    Raised when a request is cancelled before its response is complete.
+    """
+    def __init__(self, reason, partial=""):
+        """
+        Initializes the RequestCancelledError class.
+        Args:
+            reason (str): Why the request was cancelled: "cancelled", "timeout" or "disconnected".
+            partial (str): The part of the response generated before the cancellation.
+        """
+        super().__init__(f"The request was {'timed out' if reason == 'timeout' else reason}.")
+        self.reason = reason
+        self.partial = partial
+
+
+class ActiveRequest:
+    """
+    This class holds a request in progress: its deadline, the task waiting on its behalf
+    and the generation it reads from, which are interrupted when the request is cancelled.
+    """
+    def __init__(self, tracker, request_id, session_id, model, timeout=None):
+        """
+        Initializes the ActiveRequest class.
+        Args:
+            tracker (RequestTracker): The tracker the request is registered with.
+            request_id (str): The ID of the request.
+            session_id (str): The ID of the chat session.
+            model (str): The model the request is sent to.
+            timeout (float, optional): Seconds until the request is cancelled, no deadline when omitted.
+        """
+        self.tracker = tracker
+        self.request_id = request_id
+        self.session_id = session_id
+        self.model = model
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.reason = None
+        self.partial = ""
+        # The task awaited through run, and the generation read from once the request has a slot
+        self.task = None
+        self.flight = None
+        self.deadline = asyncio.get_running_loop().call_later(timeout, self.cancel, "timeout") if timeout else None
+
+    def cancel(self, reason="cancelled"):
+        """
+        Cancels the request. A wait for the session or a scheduler slot is interrupted at once,
+        and a request reading a generation stops at its next token.
+        Args:
+            reason (str): Why the request is cancelled.
+        Returns:
+            bool: False if the request was already cancelled.
+        """
+        if self.reason:
+            return False
+        self.reason = reason
+        self.tracker.cancelled[reason] = self.tracker.cancelled.get(reason, 0) + 1
+        metrics.CANCELLATIONS.inc(reason)
+        if self.task and not self.task.done():
+            self.task.cancel()
+        if self.flight:
+            self.flight.notify()
+        return True
+
+    def raise_if_cancelled(self):
+        """
+        Raises:
+            RequestCancelledError: If the request was cancelled.
+        """
+        if self.reason:
+            raise RequestCancelledError(self.reason, self.partial)
+
+    async def run(self, awaitable):
+        """
+        Awaits on a separate task that cancel can interrupt.
+        Args:
+            awaitable (Awaitable): The coroutine to run on behalf of the request.
+        Returns:
+            The result of the awaitable.
+        Raises:
+            RequestCancelledError: If the request was cancelled while waiting.
+        """
+        self.raise_if_cancelled()
+        self.task = asyncio.ensure_future(awaitable)
+        try:
+            return await self.task
+        except asyncio.CancelledError:
+            # Only cancellations of the request are converted, a cancelled caller stays cancelled
+            if self.reason and self.task.cancelled():
+                raise RequestCancelledError(self.reason, self.partial) from None
+            raise
+        finally:
+            self.task = None
+
+    def finish(self):
+        """
+        Stops the deadline and unregisters the request.
+        """
+        if self.deadline:
+            self.deadline.cancel()
+        self.flight = None
+        if self.tracker.requests.get(self.request_id) is self:
+            del self.tracker.requests[self.request_id]
+
+    def stats(self):
+        """
+        Returns the state of the request.
+        Returns:
+            dict: The request ID, session, model, age and deadline.
+        """
+        return {
+            "request_id": self.request_id,
+            "session_id": self.session_id,
+            "model": self.model,
+            "elapsed": time.monotonic() - self.started_at,
+            "timeout": self.timeout,
+            "cancelled": self.reason,
+        }
+
+
+class RequestTracker:
+    """
+    This class registers the requests in progress by ID and computes their deadlines
+    from the request, the model and the default generation timeout.
+    """
+    def __init__(self, default_timeout=None):
+        """
+        Initializes the RequestTracker class.
+        Args:
+            default_timeout (float, optional): Seconds a request may take unless overridden in GENERATION_MODEL_TIMEOUT, 0 for no limit.
+        """
+        self.default_timeout = default_timeout if default_timeout is not None else float(os.getenv('GENERATION_TIMEOUT', '600'))
+        self.model_timeouts = get_model_settings('GENERATION_MODEL_TIMEOUT', float)
+        # Whether the part of a response generated before a cancellation is kept in the chat history
+        self.persist_partial = os.getenv('PERSIST_PARTIAL_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+        self.requests = {}
+        self.cancelled = {}
+
+    def get_timeout(self, model, requested=None):
+        """
+        Computes the timeout of a request. A request may shorten the limit of its model but not extend it.
+        Args:
+            model (str): The model the request is sent to.
+            requested (float, optional): The timeout asked for by the client.
+        Returns:
+            float: The timeout in seconds, or None for no limit.
+        """
+        limit = self.model_timeouts.get(model, self.default_timeout) or None
+        if requested and requested > 0:
+            return min(requested, limit) if limit else requested
+        return limit
+
+    def open(self, session_id, model, timeout=None, request_id=None):
+        """
+        Registers a new request.
+        Args:
+            session_id (str): The ID of the chat session.
+            model (str): The model the request is sent to.
+            timeout (float, optional): The timeout asked for by the client.
+            request_id (str, optional): An ID chosen by the client, so it can cancel a request before any response arrives.
+        Returns:
+            ActiveRequest: The request, to be closed with ActiveRequest.finish.
+        Raises:
+            ValueError: If a request with the same ID is in progress.
+        """
+        request_id = request_id or str(uuid.uuid4())
+        if request_id in self.requests:
+            raise ValueError(f"Request {request_id} is already in progress.")
+        request = ActiveRequest(self, request_id, session_id, model, self.get_timeout(model, timeout))
+        self.requests[request_id] = request
+        return request
+
+    def cancel(self, request_id, reason="cancelled"):
+        """
+        Cancels a request in progress.
+        Args:
+            request_id (str): The ID of the request.
+            reason (str): Why the request is cancelled.
+        Returns:
+            bool: False if no such request is in progress.
+        """
+        request = self.requests.get(request_id)
+        if request is None:
+            return False
+        request.cancel(reason)
+        return True
+
+    def stats(self):
+        """
+        Returns the requests in progress and the cancellation counts.
+        Returns:
+            dict: The active requests and the number of cancellations by reason.
+        """
+        return {
+            "active": [request.stats() for request in self.requests.values()],
+            "cancelled": dict(self.cancelled),
+            "default_timeout": self.default_timeout or None,
+        }
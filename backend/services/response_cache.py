@@ -0,0 +1,174 @@
+"""
+module: backend.services.response_cache
+description: This module contains the ResponseCache class, which stores the responses of deterministic chat
+requests in memory and in SQLite so repeated requests are answered without a generation.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import hashlib
+import json
+import os
+import time
+
+from collections import OrderedDict
+
+def build_cache_key(model, options, messages):
+    """
+    Hashes everything that determines the response of a chat request.
+    Args:
+        model (str): The model name.
+        options (dict): The generation options.
+        messages (list): The full message list.
+    Returns:
+        str: The cache key.
+    """
+    payload = json.dumps([model, options, messages], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def is_deterministic(options):
+    """
+    Checks whether the options make the model return the same response for the same messages.
+    Args:
+        options (dict): The generation options.
+    Returns:
+        bool: True for greedy decoding or a fixed seed.
+    """
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+class ResponseCache:
+    """
+    This class keeps chat responses in an in-memory LRU backed by a persistent SQLite table,
+    both with a TTL and a size limit.
+    """
+    def __init__(self, db_handler, max_entries=None, ttl=None, max_rows=None):
+        """
+        Initializes the ResponseCache class.
+        Args:
+            db_handler (DatabaseHandler): The database holding the persistent tier.
+            max_entries (int, optional): The maximum number of responses kept in memory.
+            ttl (float, optional): Seconds a response stays valid.
+            max_rows (int, optional): The maximum number of responses kept in the database.
+        """
+        self.db_handler = db_handler
+        self.enabled = os.getenv('RESPONSE_CACHE', 'true').lower() in ('1', 'true', 'yes')
+        self.max_entries = max_entries or int(os.getenv('RESPONSE_CACHE_SIZE', '256'))
+        self.ttl = ttl or float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+        self.max_rows = max_rows or int(os.getenv('RESPONSE_CACHE_DB_ROWS', '10000'))
+        # The database tier is trimmed after this many stores rather than on every write
+        self.prune_every = int(os.getenv('RESPONSE_CACHE_PRUNE_EVERY', '100'))
+        # cache key -> (expires_at, response, timings)
+        self.entries = OrderedDict()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def is_cacheable(self, options, use_cache=True):
+        """
+        Checks whether a request may be answered from the cache.
+        Args:
+            options (dict): The generation options.
+            use_cache (bool): False when the client asked to bypass the cache.
+        Returns:
+            bool: True if the cache is enabled and the request is deterministic.
+        """
+        if not self.enabled:
+            return False
+        if not use_cache:
+            self.bypassed += 1
+            return False
+        return is_deterministic(options)
+
+    async def get(self, key):
+        """
+        Looks up a response, first in memory and then in the database.
+        Args:
+            key (str): The cache key.
+        Returns:
+            tuple: The response and its timings, or None on a miss.
+        """
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1], entry[2]
+            del self.entries[key]
+
+        try:
+            row = await self.db_handler.run_async(self.db_handler.get_cached_response, key, now)
+        except Exception as e:
+            print(f"Error reading cached response: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+
+        timings = json.loads(row["timings"]) if row["timings"] else {}
+        self.remember(key, row["expires_at"], row["response"], timings)
+        self.db_hits += 1
+        return row["response"], timings
+
+    def remember(self, key, expires_at, response, timings):
+        """
+        Adds a response to the in-memory tier, evicting the least recently used ones past the size limit.
+        Args:
+            key (str): The cache key.
+            expires_at (float): The UNIX time the response expires at.
+            response (str): The assistant response.
+            timings (dict): The timings of the generation that produced it.
+        """
+        self.entries[key] = (expires_at, response, timings)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def put(self, key, model, response, timings):
+        """
+        Stores a response in both tiers.
+        Args:
+            key (str): The cache key.
+            model (str): The model that generated the response.
+            response (str): The assistant response.
+            timings (dict): The timings of the generation.
+        """
+        expires_at = time.time() + self.ttl
+        self.remember(key, expires_at, response, timings)
+        self.stores += 1
+        try:
+            await self.db_handler.run_async(
+                self.db_handler.save_cached_response, key, model, response, json.dumps(timings), expires_at
+            )
+            if self.stores % self.prune_every == 0:
+                await self.db_handler.run_async(self.db_handler.prune_response_cache, time.time(), self.max_rows)
+        except Exception as e:
+            print(f"Error storing cached response: {e}")
+
+    def stats(self):
+        """
+        Returns the cache metrics.
+        Returns:
+            dict: Hit, miss and size metrics.
+        """
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+        }
@@ -0,0 +1,369 @@
+"""
+module: backend.services.scheduler
+description: This module contains the InferenceScheduler class, which limits how many generations run
+against each model at once and queues the rest by priority class, then fairly across sessions.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.5
+"""
+import asyncio
+import math
+import os
+import time
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+
+from . import metrics
+from .config import get_model_settings
+
+# Priority classes, served in this order: chat requests are interactive, batch items and summaries are batch
+PRIORITIES = ('interactive', 'batch')
+
+class QueueFullError(Exception):
+    """
+    Raised when a request cannot be queued because the model or session queue is full.
+    """
+    def __init__(self, message, retry_after=1):
+        """
+        Initializes the QueueFullError class.
+        Args:
+            message (str): The error message.
+            retry_after (int): Seconds the client should wait before retrying.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelQueue:
+    """
+    This class holds the concurrency slots and the waiting requests of a single model.
+    """
+    def __init__(self, model, slots, batch_slots=None):
+        """
+        Initializes the ModelQueue class.
+        Args:
+            model (str): The model name.
+            slots (int): The number of generations allowed to run at once.
+            batch_slots (int, optional): The number of those slots batch generations may take, all of them when omitted.
+        """
+        self.model = model
+        self.resize(slots, batch_slots)
+        self.active = 0
+        self.active_by_priority = dict.fromkeys(PRIORITIES, 0)
+        self.active_sessions = {}
+        # priority -> session_id -> waiting futures, priorities served in order and sessions round-robin
+        self.waiters = {priority: OrderedDict() for priority in PRIORITIES}
+        self.depth = 0
+        self.depth_by_priority = dict.fromkeys(PRIORITIES, 0)
+
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.waited = 0
+        # Exponentially weighted average of generation time, used for Retry-After estimates
+        self.service_time_avg = None
+
+    def resize(self, slots, batch_slots=None):
+        """
+        Changes the number of slots. Generations above a smaller limit run to completion, new ones wait until enough finished.
+        Args:
+            slots (int): The number of generations allowed to run at once.
+            batch_slots (int, optional): The number of those slots batch generations may take, all of them when omitted.
+        """
+        self.slots = slots
+        self.limits = {'batch': min(slots, batch_slots or slots)}
+
+    def has_room(self, priority):
+        """
+        Checks whether a slot is free for a priority class.
+        Args:
+            priority (str): The priority class.
+        Returns:
+            bool: True if a slot is free and the class is below its own limit.
+        """
+        return self.active < self.slots and self.active_by_priority[priority] < self.limits.get(priority, self.slots)
+
+    def can_start(self, session_id, priority='interactive'):
+        """
+        Checks whether a request for the session can start without queueing.
+        Args:
+            session_id (str): The ID of the chat session.
+            priority (str): The priority class of the request.
+        Returns:
+            bool: True if a slot is free and nobody of the same or a higher priority is waiting.
+        """
+        ahead = sum(self.depth_by_priority[other] for other in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        return ahead == 0 and self.has_room(priority) and session_id not in self.active_sessions
+
+    def start(self, session_id, priority='interactive'):
+        """
+        Marks a slot as taken by the session.
+        Args:
+            session_id (str): The ID of the chat session.
+            priority (str): The priority class of the request.
+        """
+        self.active += 1
+        self.active_by_priority[priority] += 1
+        self.active_sessions[session_id] = self.active_sessions.get(session_id, 0) + 1
+
+    def finish(self, session_id, priority='interactive', service_time=None):
+        """
+        Frees the slot taken by the session.
+        Args:
+            session_id (str): The ID of the chat session.
+            priority (str): The priority class of the request.
+            service_time (float, optional): How long the generation held the slot, in seconds.
+        """
+        self.active -= 1
+        self.active_by_priority[priority] -= 1
+        remaining = self.active_sessions.get(session_id, 1) - 1
+        if remaining:
+            self.active_sessions[session_id] = remaining
+        else:
+            self.active_sessions.pop(session_id, None)
+
+        if service_time is not None:
+            self.completed += 1
+            if self.service_time_avg is None:
+                self.service_time_avg = service_time
+            else:
+                self.service_time_avg = 0.8 * self.service_time_avg + 0.2 * service_time
+
+    def next_waiter(self):
+        """
+        Finds the session to hand the next free slot to: the highest priority class with room, then
+        the session waiting longest since its last turn. A session that already has a generation
+        running is skipped, since its turns run in order anyway.
+        Returns:
+            tuple: The priority class and the session ID, or None if no waiting request can start.
+        """
+        for priority in PRIORITIES:
+            if not self.depth_by_priority[priority] or not self.has_room(priority):
+                continue
+            for session_id in self.waiters[priority]:
+                if session_id not in self.active_sessions:
+                    return priority, session_id
+        return None
+
+    def dispatch(self):
+        """
+        Hands free slots to waiting requests, by priority class and then one session at a time.
+        """
+        while self.active < self.slots and self.depth:
+            waiter = self.next_waiter()
+            if waiter is None:
+                return
+            priority, session_id = waiter
+            waiters = self.waiters[priority]
+            queue = waiters[session_id]
+
+            future = queue.popleft()
+            self.depth -= 1
+            self.depth_by_priority[priority] -= 1
+            if queue:
+                waiters.move_to_end(session_id)
+            else:
+                del waiters[session_id]
+
+            if future.done():
+                # The waiter was cancelled and is cleaning up after itself
+                continue
+            self.start(session_id, priority)
+            future.set_result(None)
+
+    def remove(self, session_id, future, priority='interactive'):
+        """
+        Removes a waiting request from the queue.
+        Args:
+            session_id (str): The ID of the chat session.
+            future (asyncio.Future): The future the request is waiting on.
+            priority (str): The priority class of the request.
+        """
+        waiters = self.waiters[priority]
+        queue = waiters.get(session_id)
+        if queue and future in queue:
+            queue.remove(future)
+            self.depth -= 1
+            self.depth_by_priority[priority] -= 1
+            if not queue:
+                del waiters[session_id]
+
+    def retry_after(self):
+        """
+        Estimates how long until the queue has room again.
+        Returns:
+            int: The number of seconds to wait.
+        """
+        service_time = self.service_time_avg or 5.0
+        return max(1, min(60, math.ceil((self.depth + 1) / self.slots * service_time)))
+
+    def stats(self):
+        """
+        Returns the queue metrics of the model.
+        Returns:
+            dict: Slot usage, queue depth and wait time metrics.
+        """
+        return {
+            "slots": self.slots,
+            "batch_slots": self.limits['batch'],
+            "active": self.active,
+            "active_by_priority": dict(self.active_by_priority),
+            "queue_depth": self.depth,
+            "queue_depth_by_priority": dict(self.depth_by_priority),
+            "queued_sessions": sum(len(waiters) for waiters in self.waiters.values()),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "waited": self.waited,
+            "wait_time_avg": self.wait_time_total / self.waited if self.waited else 0.0,
+            "wait_time_max": self.wait_time_max,
+            "service_time_avg": self.service_time_avg or 0.0,
+        }
+
+
+class InferenceScheduler:
+    """
+    This class schedules generations per model with a number of concurrency slots per Ollama server,
+    bounded fair queues and backpressure once the queues are full.
+    """
+    def __init__(self, default_slots=None, max_queue=None, max_session_queue=None, state=None, backend_count=None):
+        """
+        Initializes the InferenceScheduler class.
+        Args:
+            default_slots (int, optional): Concurrent generations per model and Ollama server unless overridden in SCHEDULER_MODEL_SLOTS.
+            max_queue (int, optional): The maximum number of waiting requests per model.
+            max_session_queue (int, optional): The maximum number of waiting requests per session.
+            state (StateBackend, optional): The state shared with other workers. With a shared backend the
+                slots of a model are leased across all workers, so they never run more generations than it allows.
+            backend_count (callable, optional): Returns the number of healthy Ollama servers. Slot settings are
+                per server, so adding servers adds concurrency and losing one takes its slots away.
+        """
+        self.default_slots = default_slots or int(os.getenv('SCHEDULER_SLOTS', '2'))
+        self.max_queue = max_queue or int(os.getenv('SCHEDULER_MAX_QUEUE', '32'))
+        self.max_session_queue = max_session_queue or int(os.getenv('SCHEDULER_SESSION_QUEUE', '4'))
+        self.model_slots = get_model_settings('SCHEDULER_MODEL_SLOTS', int)
+        # Slots of each model batch generations may take, by default all but one so chat requests never wait behind a batch
+        self.batch_slots = int(os.getenv('SCHEDULER_BATCH_SLOTS', '0'))
+        self.queues = {}
+        self.state = state
+        self.backend_count = backend_count or (lambda: 1)
+
+    def get_queue(self, model):
+        """
+        Retrieves the queue of a model, creating it on first use and resizing it when the number of healthy servers changed.
+        Args:
+            model (str): The model name.
+        Returns:
+            ModelQueue: The queue of the model.
+        """
+        backends = max(1, self.backend_count())
+        slots = max(1, self.model_slots.get(model, self.default_slots)) * backends
+        batch_slots = self.batch_slots * backends or max(1, slots - 1)
+        queue = self.queues.get(model)
+        if queue is None:
+            queue = self.queues[model] = ModelQueue(model, slots, batch_slots)
+        elif queue.slots != slots:
+            queue.resize(slots, batch_slots)
+            # Slots of a server that came back go to the requests already waiting
+            queue.dispatch()
+        return queue
+
+    async def acquire(self, model, session_id, priority='interactive'):
+        """
+        Waits for a free slot on the model.
+        Args:
+            model (str): The model name.
+            session_id (str): The ID of the chat session.
+            priority (str): The priority class of the request.
+        Raises:
+            QueueFullError: If the model or session queue is full.
+            ValueError: If the priority class is unknown.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}, expected one of {', '.join(PRIORITIES)}.")
+        queue = self.get_queue(model)
+        if queue.can_start(session_id, priority):
+            queue.start(session_id, priority)
+            metrics.QUEUE_WAIT.observe(0.0, model)
+            return
+
+        session_waiters = queue.waiters[priority].get(session_id)
+        if queue.depth >= self.max_queue or (session_waiters and len(session_waiters) >= self.max_session_queue):
+            queue.rejected += 1
+            raise QueueFullError(f"Too many queued requests for model {model}.", queue.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        queue.waiters[priority].setdefault(session_id, deque()).append(future)
+        queue.depth += 1
+        queue.depth_by_priority[priority] += 1
+        queued_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the request was cancelled
+                self.release(model, session_id, priority=priority)
+            else:
+                queue.remove(session_id, future, priority)
+            raise
+        finally:
+            waited = time.monotonic() - queued_at
+            queue.waited += 1
+            queue.wait_time_total += waited
+            queue.wait_time_max = max(queue.wait_time_max, waited)
+            metrics.QUEUE_WAIT.observe(waited, model)
+            metrics.record_timing("queue", waited)
+
+    def release(self, model, session_id, service_time=None, priority='interactive'):
+        """
+        Frees a slot on the model and hands it to the next waiting request.
+        Args:
+            model (str): The model name.
+            session_id (str): The ID of the chat session.
+            service_time (float, optional): How long the generation held the slot, in seconds.
+            priority (str): The priority class of the request.
+        """
+        queue = self.get_queue(model)
+        queue.finish(session_id, priority, service_time)
+        queue.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, model, session_id, priority='interactive'):
+        """
+        Holds a slot on the model for the duration of the block.
+        Args:
+            model (str): The model name.
+            session_id (str): The ID of the chat session.
+            priority (str): The priority class of the request.
+        """
+        await self.acquire(model, session_id, priority)
+        started_at = None
+        try:
+            async with self.shared_slot(model):
+                started_at = time.monotonic()
+                yield
+        finally:
+            self.release(model, session_id, time.monotonic() - started_at if started_at else None, priority)
+
+    def shared_slot(self, model):
+        """
+        Leases one of the slots of a model across all workers, once a local slot is held.
+        Args:
+            model (str): The model name.
+        Returns:
+            The context manager holding the lease, a no-op without a shared state backend.
+        """
+        if self.state is None or not self.state.shared:
+            return nullcontext()
+        return self.state.lease(f"slots:{model}", self.get_queue(model).slots)
+
+    def stats(self):
+        """
+        Returns the queue metrics of every model.
+        Returns:
+            dict: A mapping of model name to its queue metrics.
+        """
+        return {model: queue.stats() for model, queue in self.queues.items()}
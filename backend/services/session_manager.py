@@ -0,0 +1,265 @@
+"""
+module: backend.services.session_manager
+description: This module contains the ChatSession and SessionRegistry classes, which keep the per-session
+chat state (model and history) so concurrent conversations never share mutable state, and the compact
+Message and ChatHistory records the cached conversations are held in.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import asyncio
+import os
+import sys
+import time
+
+from collections import OrderedDict
+
+class Message:
+    """
+    This class holds one message of a cached conversation. Slots keep it far smaller than a dict,
+    and dict-style access keeps it usable wherever a message dict is expected.
+    """
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        """
+        Initializes the Message class.
+        Args:
+            role (str): The role of the message sender (e.g., user, assistant).
+            content (str): The message.
+        """
+        # Roles repeat on every message, interning keeps a single copy of each
+        self.role = sys.intern(role)
+        self.content = content
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: The message in the format of the Ollama chat API.
+        """
+        return {"role": self.role, "content": self.content}
+
+
+# Size of a message record and its slot in the history list, excluding the content
+MESSAGE_OVERHEAD = sys.getsizeof(Message('user', '')) + 8
+
+class ChatHistory:
+    """
+    This class holds the messages of a conversation and keeps a running estimate of their size in bytes.
+    """
+    __slots__ = ('messages', 'nbytes')
+
+    def __init__(self, turns=()):
+        """
+        Initializes the ChatHistory class.
+        Args:
+            turns (iterable): (role, content) pairs or message dicts, oldest first.
+        """
+        self.messages = []
+        self.nbytes = 0
+        for turn in turns:
+            if isinstance(turn, dict):
+                self.append(turn["role"], turn["content"])
+            else:
+                self.append(*turn)
+
+    def append(self, role, content):
+        """
+        Adds a message at the end of the conversation.
+        Args:
+            role (str): The role of the message sender.
+            content (str): The message.
+        """
+        self.messages.append(Message(role, content))
+        self.nbytes += MESSAGE_OVERHEAD + sys.getsizeof(content)
+
+    def pop(self):
+        """
+        Removes the latest message.
+        Returns:
+            Message: The removed message.
+        """
+        message = self.messages.pop()
+        self.nbytes -= MESSAGE_OVERHEAD + sys.getsizeof(message.content)
+        return message
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+
+class ChatSession:
+    """
+    This class holds the state of a single conversation.
+    """
+    def __init__(self, session_id, model=None, chat_history=None, persisted=False, summary=None, summarized_count=0):
+        """
+        Initializes the ChatSession class.
+        Args:
+            session_id (str): The ID of the chat session.
+            model (str, optional): The AI model used for the chat.
+            chat_history (ChatHistory, optional): The messages exchanged so far.
+            persisted (bool): Whether the session row already exists in the database.
+            summary (str, optional): The rolling summary of the oldest messages.
+            summarized_count (int): The number of messages covered by the summary.
+        """
+        self.session_id = session_id
+        self.model = model
+        self.chat_history = chat_history if chat_history is not None else ChatHistory()
+        self.persisted = persisted
+        self.summary = summary
+        self.summarized_count = summarized_count
+        self.summarizing = False
+        # Ollama load and evaluation timings of the last generation
+        self.last_timings = {}
+        # Serializes turns within a session so two requests cannot interleave their history
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.last_used = time.monotonic()
+        # Version of the history in the shared state backend, a newer version means another worker wrote to it
+        self.version = None
+
+    def touch(self):
+        """
+        Marks the session as recently used.
+        """
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    """
+    This class keeps the active chat sessions in memory, keyed by session ID, with LRU eviction of idle sessions.
+    The registry is the conversation cache: histories are updated in place as messages are written,
+    so a cached session is served without reading the database.
+    """
+    def __init__(self, max_sessions=None, idle_timeout=None, max_bytes=None):
+        """
+        Initializes the SessionRegistry class.
+        Args:
+            max_sessions (int, optional): The maximum number of sessions kept in memory.
+            idle_timeout (float, optional): Seconds after which an unused session is evicted.
+            max_bytes (int, optional): The maximum estimated size of the cached histories.
+        """
+        self.max_sessions = max_sessions or int(os.getenv('SESSION_CACHE_SIZE', '512'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SESSION_IDLE_TIMEOUT', '1800'))
+        self.max_bytes = max_bytes or int(os.getenv('SESSION_CACHE_BYTES', str(64 * 1024 * 1024)))
+        self.sessions = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id):
+        """
+        Retrieves a session from the registry and marks it as recently used.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            ChatSession: The session, or None if it is not in memory.
+        """
+        session = self.sessions.get(session_id)
+        if session:
+            self.sessions.move_to_end(session_id)
+            session.touch()
+        return session
+
+    def lookup(self, session_id):
+        """
+        Retrieves a session for a request, counting cache hits and misses.
+        Args:
+            session_id (str): The ID of the chat session.
+        Returns:
+            ChatSession: The session, or None if it has to be loaded from the database.
+        """
+        session = self.get(session_id)
+        if session:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return session
+
+    def put(self, session):
+        """
+        Adds a session to the registry, evicting idle sessions if the registry is full.
+        Args:
+            session (ChatSession): The session to add.
+        Returns:
+            ChatSession: The session held by the registry for this ID.
+        """
+        existing = self.sessions.get(session.session_id)
+        if existing:
+            # Another request loaded the same session first, keep a single copy
+            return self.get(session.session_id)
+
+        self.sessions[session.session_id] = session
+        session.touch()
+        self.evict()
+        return session
+
+    def remove(self, session_id):
+        """
+        Removes a session from the registry.
+        Args:
+            session_id (str): The ID of the chat session.
+        """
+        self.sessions.pop(session_id, None)
+
+    def nbytes(self):
+        """
+        Returns:
+            int: The estimated size of the cached histories in bytes.
+        """
+        return sum(session.chat_history.nbytes for session in self.sessions.values())
+
+    def evict(self):
+        """
+        Evicts sessions that have been idle for too long, then the least recently used
+        sessions until the registry is within its size and memory limits. Sessions with a
+        turn in progress and the most recently used session are never evicted.
+        """
+        now = time.monotonic()
+        nbytes = self.nbytes()
+        for session_id in list(self.sessions)[:-1]:
+            session = self.sessions[session_id]
+            if (len(self.sessions) <= self.max_sessions and nbytes <= self.max_bytes
+                    and now - session.last_used < self.idle_timeout):
+                # Sessions are ordered by last use, so the remaining ones are newer
+                break
+            if not session.lock.locked():
+                del self.sessions[session_id]
+                nbytes -= session.chat_history.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the conversation cache metrics.
+        Returns:
+            dict: Hit, miss, eviction and size metrics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_sessions,
+            "bytes": self.nbytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
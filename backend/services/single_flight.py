@@ -0,0 +1,201 @@
+"""
+module: backend.services.single_flight
+description: This module contains the Flight and SingleFlight classes, which let concurrent identical requests
+share a single upstream generation and receive its tokens as they are produced.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import asyncio
+import os
+
+class Flight:
+    """
+    This class holds one upstream generation and fans its tokens out to every attached request.
+    """
+    def __init__(self, key, registry=None):
+        """
+        Initializes the Flight class.
+        Args:
+            key (str): The key of the generation, a hash of model, options and messages.
+            registry (SingleFlight, optional): The registry the generation is listed in for identical requests to join.
+        """
+        self.key = key
+        self.registry = registry
+        self.cancelled = False
+        self.chunks = []
+        self.timings = {}
+        self.error = None
+        self.finished = False
+        self.running = False
+        self.started = asyncio.Event()
+        self.subscribers = 0
+        self.task = None
+        # Replaced after every notification, so waiters only wake up for news
+        self.changed = asyncio.Event()
+
+    def start(self):
+        """
+        Marks the generation as running, once it holds a scheduler slot.
+        """
+        self.running = True
+        self.started.set()
+
+    async def wait_started(self):
+        """
+        Waits until the generation holds a scheduler slot.
+        Raises:
+            Exception: The error that ended the generation before it started, e.g. QueueFullError.
+        """
+        await self.started.wait()
+        if not self.running and self.error:
+            raise self.error
+
+    def detach(self):
+        """
+        Detaches a request from the generation, cancelling it when no request is left.
+        """
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.finished and self.task:
+            self.cancelled = True
+            self.task.cancel()
+            # Unlisted right away, a request joining before the task has ended starts a new generation
+            if self.registry:
+                self.registry.remove(self)
+
+    def notify(self):
+        """
+        Wakes up the requests waiting for new tokens.
+        """
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def publish(self, chunk):
+        """
+        Adds a token to the generation.
+        Args:
+            chunk (str): The next chunk of the response.
+        """
+        self.chunks.append(chunk)
+        self.notify()
+
+    def finish(self, timings=None, error=None):
+        """
+        Marks the generation as complete.
+        Args:
+            timings (dict, optional): The Ollama timings of the generation.
+            error (Exception, optional): The error that ended the generation.
+        """
+        self.timings = timings or {}
+        self.error = error
+        self.finished = True
+        self.started.set()
+        self.notify()
+
+    async def stream(self, request=None):
+        """
+        Yields every token of the generation, starting with the ones produced before the request attached.
+        Closing the last attached stream cancels the generation.
+        Args:
+            request (ActiveRequest, optional): The request reading the stream, checked for cancellation before every token.
+        Yields:
+            str: The next chunk of the response.
+        Raises:
+            RequestCancelledError: If the request was cancelled.
+            Exception: The error that ended the generation.
+        """
+        position = 0
+        try:
+            while True:
+                while position < len(self.chunks):
+                    if request:
+                        request.raise_if_cancelled()
+                    position += 1
+                    yield self.chunks[position - 1]
+                if self.finished:
+                    if self.error:
+                        raise self.error
+                    return
+                if request:
+                    # Cancelling a request notifies its generation, which wakes this wait up
+                    request.raise_if_cancelled()
+                await self.changed.wait()
+        finally:
+            self.detach()
+
+    async def result(self, request=None):
+        """
+        Waits for the whole response.
+        Args:
+            request (ActiveRequest, optional): The request waiting for the response.
+        Returns:
+            str: The response.
+        """
+        return "".join([chunk async for chunk in self.stream(request)])
+
+
+class SingleFlight:
+    """
+    This class tracks the generations in progress by key, so identical requests attach to the
+    running generation instead of starting their own.
+    """
+    def __init__(self, enabled=None):
+        """
+        Initializes the SingleFlight class.
+        Args:
+            enabled (bool, optional): Whether identical requests are coalesced.
+        """
+        if enabled is None:
+            enabled = os.getenv('COALESCE_REQUESTS', 'true').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def join(self, key, generate):
+        """
+        Attaches to the generation running for a key, or starts a new one.
+        Args:
+            key (str): The key of the generation.
+            generate (callable): Called with the new Flight, returns the coroutine that runs the generation.
+        Returns:
+            Flight: The generation to read from with Flight.stream or Flight.result.
+        """
+        flight = self.flights.get(key) if self.enabled else None
+        if flight and not flight.finished and not flight.cancelled and flight.subscribers > 0:
+            flight.subscribers += 1
+            self.coalesced += 1
+            return flight
+
+        flight = Flight(key, self if self.enabled else None)
+        flight.subscribers += 1
+        flight.task = asyncio.create_task(generate(flight))
+        self.started += 1
+        if self.enabled:
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.remove(flight))
+        return flight
+
+    def remove(self, flight):
+        """
+        Stops listing a generation, unless another one already replaced it under the same key.
+        Args:
+            flight (Flight): The generation.
+        """
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def stats(self):
+        """
+        Returns the coalescing metrics.
+        Returns:
+            dict: The number of generations started, requests coalesced and generations in progress.
+        """
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,363 @@
+"""
+module: backend.services.state_backend
+description: This module contains the state backends shared by the workers serving the API: an in-process
+backend used by a single worker, and a Redis backend that lets several workers and hosts share model selection,
+session versions, session locks and inference slots.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import asyncio
+import os
+import socket
+import uuid
+
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+
+class StateBackend(ABC):
+    """
+    This class defines the operations of a state backend and the leases built on top of them.
+    A lease is one of a fixed number of slots under a name, held by a single owner until it is
+    released or its TTL expires, so a crashed worker cannot hold a slot forever.
+    """
+    # Whether the state is visible to other processes
+    shared = False
+
+    def __init__(self):
+        """
+        Initializes the StateBackend class.
+        """
+        self.lease_ttl = float(os.getenv('STATE_LEASE_TTL', '30'))
+        self.poll_interval = float(os.getenv('STATE_POLL_INTERVAL', '0.02'))
+        self.max_poll_interval = float(os.getenv('STATE_MAX_POLL_INTERVAL', '0.5'))
+        # Tokens identify the owner of a lease, the host and process help when debugging a stuck slot
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.background_tasks = set()
+        self.held = 0
+        self.lease_waits = 0
+
+    @abstractmethod
+    async def get(self, key):
+        """
+        Retrieves a value.
+        Args:
+            key (str): The key.
+        Returns:
+            str: The value, or None if it is not set.
+        """
+
+    @abstractmethod
+    async def set(self, key, value, ttl=None):
+        """
+        Stores a value.
+        Args:
+            key (str): The key.
+            value (str): The value.
+            ttl (float, optional): Seconds the value lives, None keeps it.
+        """
+
+    @abstractmethod
+    async def incr(self, key):
+        """
+        Increments a counter.
+        Args:
+            key (str): The key.
+        Returns:
+            int: The new value.
+        """
+
+    @abstractmethod
+    async def acquire_lease(self, name, limit, ttl):
+        """
+        Takes a free slot of a name.
+        Args:
+            name (str): The name of the lease.
+            limit (int): The number of slots under the name.
+            ttl (float): Seconds the lease survives without renewal.
+        Returns:
+            str: The token of the lease, or None if every slot is taken.
+        """
+
+    @abstractmethod
+    async def renew_lease(self, name, token, ttl):
+        """
+        Extends a lease.
+        Args:
+            name (str): The name of the lease.
+            token (str): The token of the lease.
+            ttl (float): Seconds the lease is extended by.
+        Returns:
+            bool: False if the lease already expired.
+        """
+
+    @abstractmethod
+    async def release_lease(self, name, token):
+        """
+        Frees the slot of a lease.
+        Args:
+            name (str): The name of the lease.
+            token (str): The token of the lease.
+        """
+
+    async def close(self):
+        """
+        Releases the resources of the backend.
+        """
+
+    def new_token(self):
+        """
+        Returns:
+            str: A token identifying a new lease of this process.
+        """
+        return f"{self.owner}:{uuid.uuid4().hex}"
+
+    async def keep_lease(self, name, token, ttl):
+        """
+        Renews a lease until cancelled, so long generations keep their slot.
+        Args:
+            name (str): The name of the lease.
+            token (str): The token of the lease.
+            ttl (float): Seconds the lease is extended by on every renewal.
+        """
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self.renew_lease(name, token, ttl):
+                    print(f"Lease {name} expired before it could be renewed")
+                    return
+            except Exception as e:
+                print(f"Error renewing lease {name}: {e}")
+
+    def release_in_background(self, name, token):
+        """
+        Releases a lease on a separate task, so the release completes even while the holder is being cancelled.
+        Args:
+            name (str): The name of the lease.
+            token (str): The token of the lease.
+        """
+        async def release():
+            try:
+                await self.release_lease(name, token)
+            except Exception as e:
+                print(f"Error releasing lease {name}: {e}")
+
+        task = asyncio.create_task(release())
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    @asynccontextmanager
+    async def lease(self, name, limit, ttl=None, wait=True):
+        """
+        Holds one of the slots of a name for the duration of the block, waiting with exponential backoff until one is free.
+        Args:
+            name (str): The name of the lease, e.g. "slots:llama3".
+            limit (int): The number of slots under the name.
+            ttl (float, optional): Seconds the lease survives without renewal.
+            wait (bool): Whether to wait for a free slot. Otherwise the block runs with a None token when every slot is taken.
+        """
+        ttl = ttl or self.lease_ttl
+        delay = self.poll_interval
+        while True:
+            token = await self.acquire_lease(name, limit, ttl)
+            if token:
+                break
+            if not wait:
+                yield None
+                return
+            self.lease_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+        self.held += 1
+        renewal = asyncio.create_task(self.keep_lease(name, token, ttl))
+        try:
+            yield token
+        finally:
+            self.held -= 1
+            renewal.cancel()
+            self.release_in_background(name, token)
+
+    def stats(self):
+        """
+        Returns the lease metrics of this process.
+        Returns:
+            dict: The backend type, whether it is shared, the leases held and how often acquiring one had to wait.
+        """
+        return {
+            "backend": type(self).__name__,
+            "shared": self.shared,
+            "owner": self.owner,
+            "leases_held": self.held,
+            "lease_waits": self.lease_waits,
+        }
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    This class keeps the state in the memory of the process, for deployments with a single worker.
+    """
+    def __init__(self):
+        """
+        Initializes the MemoryStateBackend class.
+        """
+        super().__init__()
+        self.values = {}
+        # lease name -> tokens of the slots taken
+        self.leases = {}
+
+    async def get(self, key):
+        """
+        Retrieves a value.
+        Args:
+            key (str): The key.
+        Returns:
+            str: The value, or None if it is not set.
+        """
+        return self.values.get(key)
+
+    async def set(self, key, value, ttl=None):
+        """
+        Stores a value. Values of the in-process backend live as long as the process.
+        Args:
+            key (str): The key.
+            value (str): The value.
+            ttl (float, optional): Ignored.
+        """
+        self.values[key] = str(value)
+
+    async def incr(self, key):
+        """
+        Increments a counter.
+        Args:
+            key (str): The key.
+        Returns:
+            int: The new value.
+        """
+        value = int(self.values.get(key) or 0) + 1
+        self.values[key] = str(value)
+        return value
+
+    async def acquire_lease(self, name, limit, ttl):
+        """
+        Takes a free slot of a name.
+        Args:
+            name (str): The name of the lease.
+            limit (int): The number of slots under the name.
+            ttl (float): Ignored, leases of the process end with it.
+        Returns:
+            str: The token of the lease, or None if every slot is taken.
+        """
+        tokens = self.leases.setdefault(name, set())
+        if len(tokens) >= limit:
+            return None
+        token = self.new_token()
+        tokens.add(token)
+        return token
+
+    async def renew_lease(self, name, token, ttl):
+        return token in self.leases.get(name, ())
+
+    async def release_lease(self, name, token):
+        tokens = self.leases.get(name)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self.leases[name]
+
+
+class RedisStateBackend(StateBackend):
+    """
+    This class keeps the state in Redis, or any server speaking its protocol, so every worker
+    and host sees the same state. Each slot of a lease is a key set with NX and a TTL.
+    """
+    shared = True
+
+    def __init__(self, url, prefix=None):
+        """
+        Initializes the RedisStateBackend class.
+        Args:
+            url (str): The URL of the server, e.g. redis://localhost:6379/0.
+            prefix (str, optional): Prepended to every key, so several deployments can share a server.
+        """
+        super().__init__()
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("STATE_BACKEND_URL points to Redis but the redis package is not installed.") from e
+        self.url = url
+        self.prefix = prefix if prefix is not None else os.getenv('STATE_KEY_PREFIX', 'assistant:')
+        self.client = redis.from_url(url, decode_responses=True)
+
+    def slot_key(self, name, token):
+        """
+        Builds the key of the slot a lease token holds.
+        Args:
+            name (str): The name of the lease.
+            token (str): The token, prefixed with the slot index.
+        Returns:
+            str: The key of the slot.
+        """
+        return f"{self.prefix}lease:{name}:{token.split('/', 1)[0]}"
+
+    async def get(self, key):
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def incr(self, key):
+        return await self.client.incr(self.prefix + key)
+
+    async def acquire_lease(self, name, limit, ttl):
+        """
+        Takes the first free slot of a name. Slots are tried from a random offset so
+        workers do not all contend for the first one.
+        Args:
+            name (str): The name of the lease.
+            limit (int): The number of slots under the name.
+            ttl (float): Seconds the slot stays taken without renewal.
+        Returns:
+            str: The token of the lease, or None if every slot is taken.
+        """
+        offset = uuid.uuid4().int % limit
+        for i in range(limit):
+            token = f"{(offset + i) % limit}/{self.new_token()}"
+            if await self.client.set(self.slot_key(name, token), token, nx=True, px=int(ttl * 1000)):
+                return token
+        return None
+
+    async def renew_lease(self, name, token, ttl):
+        key = self.slot_key(name, token)
+        if await self.client.get(key) != token:
+            return False
+        return bool(await self.client.pexpire(key, int(ttl * 1000)))
+
+    async def release_lease(self, name, token):
+        key = self.slot_key(name, token)
+        # Only delete the slot if it was not taken over after the lease expired
+        if await self.client.get(key) == token:
+            await self.client.delete(key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_state_backend(url=None):
+    """
+    Creates the state backend configured in STATE_BACKEND_URL, the in-process backend when it is empty.
+    Args:
+        url (str, optional): The URL of the backend.
+    Returns:
+        StateBackend: The backend.
+    Raises:
+        ValueError: If the URL scheme is not supported.
+    """
+    url = url if url is not None else os.getenv('STATE_BACKEND_URL', '')
+    if not url or url == 'memory://':
+        return MemoryStateBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported state backend: {url}")
@@ -0,0 +1,43 @@
+"""
+module: backend.tests.conftest
+description: This module contains the pytest fixtures shared by the backend tests.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import os
+import sys
+
+import pytest
+
+# The services are imported the way app.py imports them, relative to the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.db_handler import DatabaseHandler
+
+@pytest.fixture
+def db_handler(tmp_path, monkeypatch):
+    """
+    A migrated database in a temporary directory, committing every message.
+    """
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setenv('DB_DURABILITY', 'immediate')
+    handler = DatabaseHandler()
+    handler.initialize()
+    yield handler
+    handler.close_connection()
+
+def age_session(db_handler, session_id, timestamp='2000-01-01 00:00:00'):
+    """
+    Moves the creation and last activity of a session into the past.
+    Args:
+        db_handler (DatabaseHandler): The database.
+        session_id (str): The ID of the chat session.
+        timestamp (str): The new creation and last message time.
+    """
+    db_handler.execute_write('''
+        UPDATE chat_sessions SET created_at = ?, last_message_at = CASE WHEN last_message_at IS NULL THEN NULL ELSE ? END
+        WHERE session_id = ?
+    ''', (timestamp, timestamp, session_id))
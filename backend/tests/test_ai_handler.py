@@ -0,0 +1,104 @@
+"""
+module: backend.tests.test_ai_handler
+description: This module contains the tests of the AIHandler class with a fake Ollama client: generation,
+rolling summaries running next to chat turns and response length caps.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.2
+"""
+import asyncio
+
+import pytest
+
+from services.ai_handler import AIHandler
+
+class FakeClient:
+    """
+    Stands in for the backend pool. Chat turns stream one part at once, summaries wait until released.
+    """
+    def __init__(self):
+        self.summary_started = asyncio.Event()
+        self.release_summary = asyncio.Event()
+        self.requests = []
+
+    async def chat(self, model, messages, stream=False, **kwargs):
+        self.requests.append({"model": model, "messages": messages, "stream": stream, **kwargs})
+        if not stream:
+            self.summary_started.set()
+            await self.release_summary.wait()
+            return {"message": {"content": "The user said hello."}}
+
+        async def parts():
+            yield {"message": {"content": "Hi there"}, "done": True, "eval_count": 2}
+        return parts()
+
+@pytest.fixture
+def ai_handler(db_handler, monkeypatch):
+    for name in ('STATE_BACKEND_URL', 'OLLAMA_HOSTS', 'MAX_NUM_PREDICT', 'MODEL_MAX_NUM_PREDICT', 'SCHEDULER_SLOTS'):
+        monkeypatch.delenv(name, raising=False)
+    handler = AIHandler(db_handler)
+    handler.client = FakeClient()
+
+    async def no_memories(prompt, session_id=None):
+        return None
+    monkeypatch.setattr(handler.memory_index, "retrieve", no_memories)
+    return handler
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+def test_generate_response_persists_the_turn(ai_handler, db_handler):
+    async def scenario():
+        session = await ai_handler.get_chat_session()
+        session.model = "llama3"
+        response = await ai_handler.generate_response("Hello", session_id=session.session_id)
+        return session, response
+
+    session, response = run(scenario())
+
+    assert response == "Hi there"
+    history = db_handler.get_chat_history(session.session_id)
+    assert [(row["role"], row["content"]) for row in history] == [("user", "Hello"), ("assistant", "Hi there")]
+
+def test_deepseek_models_use_the_normal_generation_path(ai_handler):
+    async def scenario():
+        session = await ai_handler.get_chat_session()
+        session.model = "deepseek"
+        return await ai_handler.generate_response("Hello", session_id=session.session_id)
+
+    assert run(scenario()) == "Hi there"
+    assert ai_handler.client.requests[0]["messages"][0]["content"].startswith("You are deepseek")
+
+def test_a_running_summary_does_not_hold_up_the_next_turn(ai_handler):
+    async def scenario():
+        session = await ai_handler.get_chat_session()
+        session.model = "llama3"
+        for index in range(4):
+            session.chat_history.append("user" if index % 2 == 0 else "assistant", f"message {index}")
+        session.summarizing = True
+        summary = ai_handler.run_in_background(ai_handler.update_summary(session, 2))
+        await ai_handler.client.summary_started.wait()
+
+        response = await asyncio.wait_for(ai_handler.generate_response("Hello", session_id=session.session_id), 1)
+
+        assert response == "Hi there"
+        assert not summary.done()
+        ai_handler.client.release_summary.set()
+        await summary
+        assert session.summary == "The user said hello."
+        assert session.summarized_count == 2
+        assert not session.summarizing
+
+    run(scenario())
+
+def test_num_predict_is_capped(ai_handler):
+    ai_handler.default_num_predict = 512
+    ai_handler.max_num_predict = 1024
+    ai_handler.model_max_num_predict = {"small": 64}
+
+    assert ai_handler.build_options(None, "llama3") == {"num_predict": 512}
+    assert ai_handler.build_options({"num_predict": 4096, "temperature": 0}, "llama3") == {"num_predict": 1024, "temperature": 0}
+    assert ai_handler.build_options({"num_predict": -1}, "llama3")["num_predict"] == 1024
+    assert ai_handler.build_options({"num_predict": 100}, "small")["num_predict"] == 64
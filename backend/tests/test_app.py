@@ -0,0 +1,73 @@
+"""
+module: backend.tests.test_app
+description: This module contains the tests of the FastAPI endpoints, driven with a fake Ollama client.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.3
+"""
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+from test_ai_handler import FakeClient
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setenv('DB_DURABILITY', 'immediate')
+    for name in ('STATE_BACKEND_URL', 'OLLAMA_HOSTS', 'MAX_NUM_PREDICT', 'MODEL_MAX_NUM_PREDICT', 'SCHEDULER_SLOTS'):
+        monkeypatch.delenv(name, raising=False)
+    # The handlers are created at import time, reloaded so they use the temporary database
+    module = importlib.reload(importlib.import_module('app'))
+    handler = module.ai_handler
+    handler.client = FakeClient()
+
+    async def has_model(model_name):
+        return model_name in ("llama3", "mistral")
+
+    async def no_memories(prompt, session_id=None):
+        return None
+    monkeypatch.setattr(handler.model_registry, "has_model", has_model)
+    monkeypatch.setattr(handler.memory_index, "retrieve", no_memories)
+    yield module
+    module.db_handler.close_connection()
+
+def test_chat_model_name_switches_an_existing_session(app_module):
+    client = TestClient(app_module.app)
+
+    first = client.post("/api/chat", json={"prompt": "Hello", "model_name": "llama3"})
+    assert first.status_code == 200
+    session_id = first.json()["session_id"]
+
+    second = client.post("/api/chat", json={"prompt": "Hello again", "model_name": "mistral", "session_id": session_id})
+    assert second.status_code == 200
+
+    assert [request["model"] for request in app_module.ai_handler.client.requests] == ["llama3", "mistral"]
+    row = app_module.db_handler.fetch_one('SELECT model FROM chat_sessions WHERE session_id = ?', (session_id,))
+    assert row["model"] == "mistral"
+
+def test_model_details_etag_follows_the_fetched_details(app_module, monkeypatch):
+    registry = app_module.ai_handler.model_registry
+    summary = {"name": "llama3", "digest": "abc"}
+    shown = []
+
+    async def list_models():
+        return [summary]
+
+    async def get_details(model_name):
+        # ollama.show fails the first time, so only the summary is known
+        return dict(summary, context_length=8192) if shown else summary
+    monkeypatch.setattr(registry, "list_models", list_models)
+    monkeypatch.setattr(registry, "get_details", get_details)
+    client = TestClient(app_module.app)
+
+    first = client.get("/api/models", params={"details": True})
+    assert client.get("/api/models", params={"details": True}, headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    shown.append(True)
+    second = client.get("/api/models", params={"details": True}, headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert second.json()["models"][0]["context_length"] == 8192
@@ -0,0 +1,91 @@
+"""
+module: backend.tests.test_backend_pool
+description: This module contains the tests of the BackendPool class: routing, fail over and health.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import httpx
+import ollama
+import pytest
+
+from services.backend_pool import BackendPool
+
+class FakeClient:
+    """
+    Stands in for ollama.AsyncClient, answering or failing every call the same way.
+    """
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    async def chat(self, **kwargs):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return {"message": {"content": "hi"}}
+
+def make_pool(*errors):
+    pool = BackendPool(hosts=[f"http://backend-{index}:11434" for index in range(len(errors))])
+    for backend, error in zip(pool.backends, errors):
+        backend.client = FakeClient(error)
+    return pool
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+@pytest.mark.parametrize("error, expected", [
+    (ConnectionError("refused"), (True, True)),
+    (httpx.ReadTimeout("slow"), (True, True)),
+    (asyncio.TimeoutError(), (True, True)),
+    (ollama.ResponseError("overloaded", 503), (True, True)),
+    (ollama.ResponseError("model not found", 404), (True, False)),
+    (ollama.ResponseError("bad request", 400), (False, False)),
+    (ValueError("invalid response"), (False, False)),
+])
+def test_only_server_errors_fail_over(error, expected):
+    assert BackendPool.should_fail_over(error) == expected
+
+def test_connection_errors_fail_over_to_the_next_server():
+    pool = make_pool(ConnectionError("refused"), None)
+    # The least busy server is tried first
+    pool.backends[1].outstanding = 1
+
+    response = run(pool.chat(model="llama3", messages=[]))
+
+    assert response["message"]["content"] == "hi"
+    assert not pool.backends[0].healthy
+    assert pool.backends[1].healthy
+    assert pool.healthy_count() == 1
+    assert "llama3" in pool.backends[1].loaded_models
+
+def test_client_errors_are_raised_without_marking_the_server():
+    pool = make_pool(ValueError("invalid response"), None)
+    # The least busy server is tried first
+    pool.backends[1].outstanding = 1
+
+    with pytest.raises(ValueError):
+        run(pool.chat(model="llama3", messages=[]))
+
+    assert pool.backends[0].healthy
+    assert pool.backends[1].client.calls == 0
+
+def test_the_last_error_is_raised_when_every_server_failed():
+    pool = make_pool(ConnectionError("first"), ConnectionError("second"))
+
+    with pytest.raises(ConnectionError):
+        run(pool.chat(model="llama3", messages=[]))
+    assert pool.healthy_count() == 1
+    assert [backend.failures for backend in pool.backends] == [1, 1]
+
+def test_servers_with_the_model_loaded_are_preferred():
+    pool = make_pool(None, None, None)
+    pool.backends[2].loaded_models.add("llama3")
+    pool.backends[2].outstanding = 5
+
+    assert pool.select("llama3") is pool.backends[2]
+    assert pool.select("phi4") is not pool.backends[2]
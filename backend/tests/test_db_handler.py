@@ -0,0 +1,140 @@
+"""
+module: backend.tests.test_db_handler
+description: This module contains the tests of the DatabaseHandler class: schema migrations, archival, restore
+and full-text search.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import sqlite3
+
+import pytest
+
+from services.db_handler import SCHEMA_VERSION, DatabaseHandler
+
+def add_session(db_handler, session_id, messages):
+    db_handler.add_chat_session(session_id, "llama3")
+    for role, content in messages:
+        db_handler.add_chat_message(session_id, role, content)
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd"])
+def test_archive_and_restore_keep_history(db_handler, codec):
+    messages = [("user", f"question {index}") if index % 2 == 0 else ("assistant", f"answer {index}") for index in range(10)]
+    add_session(db_handler, "s1", messages)
+
+    archived = db_handler.archive_chat_session("s1", codec)
+
+    assert archived[0] == 10
+    assert db_handler.fetch_one("SELECT COUNT(*) AS n FROM chat_messages")["n"] == 0
+    assert db_handler.get_chat_session("s1")["archived_at"] is not None
+    assert db_handler.restore_chat_session("s1") == 10
+    assert [(row["role"], row["content"]) for row in db_handler.get_chat_history("s1")] == messages
+    assert db_handler.get_chat_session("s1")["archived_at"] is None
+
+def test_archived_sessions_stay_searchable(db_handler):
+    add_session(db_handler, "s2", [("user", "and giraffes?")])
+    add_session(db_handler, "s1", [("user", "tell me about zebras"), ("assistant", "zebras have stripes")])
+
+    def hits(**kwargs):
+        return db_handler.search("zebras", scope="messages", **kwargs)["messages"]
+
+    assert len(hits()) == 2
+    assert all(hit["snippet"] and not hit["archived"] for hit in hits())
+
+    db_handler.archive_chat_session("s1")
+    # The archived messages had the highest IDs, so new messages take them again
+    add_session(db_handler, "s3", [("user", "unrelated"), ("user", "also unrelated")])
+    assert db_handler.fetch_one("SELECT MAX(id) AS id FROM chat_messages")["id"] == 3
+
+    archived_hits = hits()
+    assert len(archived_hits) == 2
+    assert all(hit["archived"] and hit["session_id"] == "s1" and hit["snippet"] is None for hit in archived_hits)
+    assert len(hits(session_id="s1")) == 2
+    assert hits(session_id="s3") == []
+    assert db_handler.search("unrelated", scope="messages")["messages"][0]["session_id"] == "s3"
+
+    db_handler.restore_chat_session("s1")
+
+    restored_hits = hits()
+    assert len(restored_hits) == 2
+    assert all(not hit["archived"] and hit["snippet"] for hit in restored_hits)
+
+def test_deleting_an_archived_session_removes_its_search_entries(db_handler):
+    add_session(db_handler, "s1", [("user", "tell me about zebras")])
+    db_handler.archive_chat_session("s1")
+
+    assert db_handler.delete_chat_session("s1") == 1
+    assert db_handler.search("zebras", scope="messages")["messages"] == []
+    assert db_handler.fetch_one("SELECT COUNT(*) AS n FROM archived_search_index")["n"] == 0
+
+def create_baseline_database(path):
+    """
+    Creates a database with the original schema, where every message inserted its own session row.
+    """
+    connection = sqlite3.connect(path)
+    DatabaseHandler.create_base_tables(None, connection)
+    connection.executemany('INSERT INTO chat_sessions (session_id, model) VALUES (?, ?)', [("s1", "llama3")] * 3)
+    connection.executemany('INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)', [
+        ("s1", "user", "where do penguins live"),
+        ("s1", "assistant", "penguins live in the southern hemisphere"),
+        ("s1", "user", "thanks"),
+    ])
+    connection.execute("INSERT INTO memories (session_id, memory) VALUES ('s1', 'likes penguins')")
+    connection.commit()
+    connection.close()
+
+def test_migrations_upgrade_a_baseline_database(tmp_path, monkeypatch):
+    path = str(tmp_path / 'baseline.db')
+    create_baseline_database(path)
+    monkeypatch.setenv('DB_PATH', path)
+    db_handler = DatabaseHandler()
+    try:
+        db_handler.initialize()
+
+        assert db_handler.get_schema_version() == SCHEMA_VERSION
+        sessions = db_handler.fetch_all('SELECT * FROM chat_sessions')
+        assert len(sessions) == 1
+        assert sessions[0]["message_count"] == 3
+        assert sessions[0]["title"] == "where do penguins live"
+        # Migration 1 made session IDs unique
+        with pytest.raises(sqlite3.IntegrityError):
+            db_handler.execute_write("INSERT INTO chat_sessions (session_id, model) VALUES ('s1', 'llama3')")
+    finally:
+        db_handler.close_connection()
+
+def test_migrations_are_applied_once(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'test.db'))
+    for _ in range(2):
+        db_handler = DatabaseHandler()
+        db_handler.initialize()
+        assert db_handler.get_schema_version() == SCHEMA_VERSION
+        db_handler.close_connection()
+
+def test_search_backfill_indexes_existing_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / 'baseline.db')
+    create_baseline_database(path)
+    monkeypatch.setenv('DB_PATH', path)
+    db_handler = DatabaseHandler()
+    try:
+        db_handler.initialize()
+        # Rows written before the index existed are only searchable once backfilled
+        assert db_handler.search("penguins")["messages"] == []
+        db_handler.add_chat_message("s1", "user", "penguins again")
+
+        while db_handler.backfill_search_index(batch_size=1):
+            pass
+
+        results = db_handler.search("penguins")
+        assert len(results["messages"]) == 3
+        assert len(results["memories"]) == 1
+        assert db_handler.fetch_all('SELECT * FROM search_backfill') == []
+    finally:
+        db_handler.close_connection()
+
+def test_search_treats_operators_as_text(db_handler):
+    add_session(db_handler, "s1", [("user", 'what does "NEAR(a b)" OR mean')])
+
+    assert len(db_handler.search('"NEAR(a b)" OR')["messages"]) == 1
+    assert db_handler.search("   ") == {}
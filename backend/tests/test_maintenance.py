@@ -0,0 +1,71 @@
+"""
+module: backend.tests.test_maintenance
+description: This module contains the tests of the database maintenance: retention and archival of cold sessions.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import pytest
+
+from services.maintenance import DatabaseMaintenance
+
+from conftest import age_session
+
+@pytest.fixture
+def maintenance(db_handler, monkeypatch):
+    monkeypatch.setenv('DB_MAINTENANCE_BATCH', '3')
+    monkeypatch.setenv('DB_MAINTENANCE_PAUSE', '0')
+    monkeypatch.setenv('DB_ARCHIVE_AFTER_DAYS', '30')
+    monkeypatch.setenv('DB_RETENTION_DAYS', '0')
+    monkeypatch.setenv('DB_ARCHIVE_CODEC', 'gzip')
+    return DatabaseMaintenance(db_handler, interval=0)
+
+def test_archive_skips_empty_sessions(db_handler, maintenance):
+    # More empty idle sessions than fit in a batch, as left behind by /api/sessions/create and /api/sessions/clear
+    for index in range(5):
+        db_handler.add_chat_session(f"empty-{index}", "llama3")
+        age_session(db_handler, f"empty-{index}")
+    db_handler.add_chat_session("cold", "llama3")
+    db_handler.add_chat_message("cold", "user", "hello")
+    db_handler.add_chat_message("cold", "assistant", "hi there")
+    age_session(db_handler, "cold")
+
+    result = asyncio.run(asyncio.wait_for(maintenance.run_once(), 10))
+
+    assert result["archived_sessions"] == 1
+    assert result["archived_messages"] == 2
+    assert not maintenance.running
+    assert db_handler.get_chat_session("cold")["archived_at"] is not None
+    assert db_handler.get_chat_session("empty-0")["archived_at"] is None
+
+def test_archive_stops_when_a_batch_archives_nothing(db_handler, maintenance, monkeypatch):
+    for index in range(4):
+        db_handler.add_chat_session(f"cold-{index}", "llama3")
+        db_handler.add_chat_message(f"cold-{index}", "user", "hello")
+        age_session(db_handler, f"cold-{index}")
+    monkeypatch.setattr(db_handler, "archive_chat_session", lambda session_id, codec: None)
+
+    sessions, messages, raw_bytes, archive_bytes = asyncio.run(asyncio.wait_for(maintenance.archive_cold(), 10))
+
+    assert (sessions, messages) == (0, 0)
+
+def test_retention_deletes_expired_sessions(db_handler, maintenance):
+    maintenance.retention_days = 90
+    db_handler.add_chat_session("old", "llama3")
+    db_handler.add_chat_message("old", "user", "hello")
+    age_session(db_handler, "old")
+    db_handler.add_chat_session("recent", "llama3")
+    db_handler.add_chat_message("recent", "user", "hello")
+    deleted = []
+    maintenance.on_delete = deleted.append
+
+    result = asyncio.run(maintenance.run_once())
+
+    assert result["deleted_sessions"] == 1
+    assert deleted == ["old"]
+    assert db_handler.get_chat_session("old") is None
+    assert db_handler.get_chat_session("recent") is not None
@@ -0,0 +1,53 @@
+"""
+module: backend.tests.test_memory_index
+description: This module contains the tests of the MemoryIndex class with a fake embedding client.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import pytest
+
+from services.memory_index import MemoryIndex
+
+class FakeEmbedClient:
+    """
+    Embeds texts about cats and about everything else on two orthogonal axes.
+    """
+    def __init__(self):
+        self.inputs = []
+
+    async def embed(self, model, input):
+        self.inputs.append(list(input))
+        return {"embeddings": [[1.0, 0.0] if "cat" in text else [0.0, 1.0] for text in input]}
+
+@pytest.fixture
+def memory_index(db_handler, monkeypatch):
+    monkeypatch.delenv('MEMORY_SCOPE', raising=False)
+    for session_id, memory in (("alice", "Alice has a cat"), ("bob", "Bob has a cat too"), ("bob", "Bob likes tea")):
+        db_handler.add_chat_session(session_id, "llama3")
+        db_handler.add_memory(session_id, memory)
+    return MemoryIndex(FakeEmbedClient(), db_handler)
+
+def test_retrieval_is_limited_to_the_session(memory_index):
+    memories = asyncio.run(memory_index.retrieve("Tell me about my cat", "alice"))
+
+    assert memories.splitlines()[1:] == ["- Alice has a cat"]
+
+def test_global_scope_searches_every_session(memory_index):
+    memory_index.scope = "global"
+    memories = asyncio.run(memory_index.retrieve("Tell me about my cat", "alice"))
+
+    assert sorted(memories.splitlines()[1:]) == ["- Alice has a cat", "- Bob has a cat too"]
+
+def test_a_session_without_memories_is_not_embedded(memory_index):
+    async def scenario():
+        await memory_index.load()
+        calls = len(memory_index.client.inputs)
+        memories = await memory_index.retrieve("Tell me about my cat", "carol")
+        return memories, len(memory_index.client.inputs) - calls
+
+    assert asyncio.run(scenario()) == (None, 0)
@@ -0,0 +1,112 @@
+"""
+module: backend.tests.test_quotas
+description: This module contains the tests of the TokenBucket and ClientQuotas classes.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import pytest
+
+from services import quotas
+from services.quotas import ClientQuotas, QuotaExceededError, TokenBucket
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A monotonic clock that only moves when the test advances it.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(quotas.time, 'monotonic', lambda: now[0])
+    return now
+
+@pytest.fixture(autouse=True)
+def quota_settings(monkeypatch):
+    for name in ('QUOTA_REQUEST_BURST', 'QUOTA_TOKEN_BURST', 'QUOTA_API_KEYS', 'QUOTA_TRUST_FORWARDED', 'QUOTA_MAX_CLIENTS'):
+        monkeypatch.delenv(name, raising=False)
+
+def test_bucket_refills_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate=1, capacity=5)
+    bucket.take(5)
+    assert bucket.wait_time(1) == 1
+
+    clock[0] += 2
+    bucket.refill()
+    assert bucket.tokens == 2
+
+    clock[0] += 100
+    assert bucket.is_full()
+    assert bucket.tokens == 5
+
+def test_bucket_goes_into_debt(clock):
+    bucket = TokenBucket(rate=10, capacity=100)
+    bucket.take(150)
+    assert bucket.tokens == -50
+    assert bucket.wait_time(1) == pytest.approx(5.1)
+    assert bucket.reset_time() == pytest.approx(15)
+
+def test_requests_over_the_limit_are_rejected(clock):
+    client_quotas = ClientQuotas(requests_per_minute=2, tokens_per_minute=0)
+    client_quotas.acquire("ip:1")
+    headers = client_quotas.acquire("ip:1")
+    assert headers["X-RateLimit-Limit-Requests"] == "2"
+    assert headers["X-RateLimit-Remaining-Requests"] == "0"
+
+    with pytest.raises(QuotaExceededError) as error:
+        client_quotas.acquire("ip:1")
+    assert error.value.retry_after == 30
+    assert error.value.headers["X-RateLimit-Remaining-Requests"] == "0"
+    # Other clients have their own quota
+    client_quotas.acquire("ip:2")
+
+    clock[0] += 30
+    client_quotas.acquire("ip:1")
+    assert client_quotas.stats()["rejected"] == 1
+
+def test_generated_tokens_count_against_the_token_quota(clock):
+    client_quotas = ClientQuotas(requests_per_minute=0, tokens_per_minute=600)
+    client_quotas.acquire("ip:1")
+    client_quotas.record_tokens("ip:1", 700)
+
+    assert client_quotas.wait_time("ip:1") == pytest.approx(10.1)
+    with pytest.raises(QuotaExceededError):
+        client_quotas.acquire("ip:1")
+    clock[0] += 11
+    client_quotas.acquire("ip:1")
+
+def test_disabled_quotas_admit_everything():
+    client_quotas = ClientQuotas(requests_per_minute=0, tokens_per_minute=0)
+    assert not client_quotas.enabled
+    for _ in range(100):
+        assert client_quotas.acquire("ip:1") == {}
+    client_quotas.record_tokens("ip:1", 10 ** 6)
+    assert client_quotas.wait_time("ip:1") == 0
+    assert client_quotas.clients == {}
+
+def test_clients_are_identified_by_hashed_key_or_address(monkeypatch):
+    client_quotas = ClientQuotas(requests_per_minute=1)
+    by_key = client_quotas.identify({"x-api-key": "secret"}, "10.0.0.1")
+    assert by_key.startswith("key:") and "secret" not in by_key
+    assert client_quotas.identify({"authorization": "Bearer secret"}, "10.0.0.2") == by_key
+    assert client_quotas.identify({"x-forwarded-for": "1.2.3.4"}, "10.0.0.1") == "ip:10.0.0.1"
+
+    monkeypatch.setenv('QUOTA_API_KEYS', 'known')
+    monkeypatch.setenv('QUOTA_TRUST_FORWARDED', 'true')
+    client_quotas = ClientQuotas(requests_per_minute=1)
+    assert client_quotas.identify({"x-api-key": "unknown"}, "10.0.0.1") == "ip:10.0.0.1"
+    assert client_quotas.identify({"x-forwarded-for": "1.2.3.4, 10.0.0.1"}, "10.0.0.1") == "ip:1.2.3.4"
+
+def test_idle_clients_are_forgotten_but_not_clients_in_debt(clock, monkeypatch):
+    monkeypatch.setenv('QUOTA_MAX_CLIENTS', '2')
+    client_quotas = ClientQuotas(requests_per_minute=60)
+    client_quotas.acquire("ip:1")
+    client_quotas.acquire("ip:2")
+    client_quotas.acquire("ip:3")
+    # ip:1 still owes its request, so it is kept
+    assert "ip:1" in client_quotas.clients
+
+    clock[0] += 60
+    client_quotas.acquire("ip:4")
+    assert len(client_quotas.clients) == 2
+    assert "ip:4" in client_quotas.clients
@@ -0,0 +1,101 @@
+"""
+module: backend.tests.test_request_tracker
+description: This module contains the tests of the RequestTracker class: explicit cancellation, deadlines
+and cancellation of requests reading a generation.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import pytest
+
+from services.request_tracker import RequestCancelledError, RequestTracker
+from services.single_flight import SingleFlight
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+def test_cancel_interrupts_a_waiting_request():
+    async def scenario():
+        tracker = RequestTracker(default_timeout=0)
+        request = tracker.open("s1", "llama3", request_id="r1")
+        waiting = asyncio.create_task(request.run(asyncio.sleep(10)))
+        await asyncio.sleep(0)
+
+        assert tracker.cancel("r1")
+        with pytest.raises(RequestCancelledError) as error:
+            await waiting
+        assert error.value.reason == "cancelled"
+        assert not request.cancel()
+        request.finish()
+        assert tracker.requests == {}
+        assert not tracker.cancel("r1")
+        assert tracker.stats()["cancelled"] == {"cancelled": 1}
+    run(scenario())
+
+def test_deadline_times_a_request_out():
+    async def scenario():
+        tracker = RequestTracker(default_timeout=0)
+        request = tracker.open("s1", "llama3", timeout=0.05)
+        with pytest.raises(RequestCancelledError) as error:
+            await request.run(asyncio.sleep(10))
+        assert error.value.reason == "timeout"
+        request.finish()
+    run(scenario())
+
+def test_cancelled_caller_stays_cancelled():
+    async def scenario():
+        tracker = RequestTracker(default_timeout=0)
+        request = tracker.open("s1", "llama3")
+        caller = asyncio.create_task(request.run(asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        assert request.reason is None
+    run(scenario())
+
+def test_cancel_stops_a_request_reading_a_generation():
+    async def scenario():
+        tracker = RequestTracker(default_timeout=0)
+        request = tracker.open("s1", "llama3")
+        single_flight = SingleFlight(enabled=True)
+
+        async def generate(flight):
+            flight.start()
+            flight.publish("partial ")
+            await asyncio.sleep(10)
+
+        flight = single_flight.join("key", generate)
+        request.flight = flight
+        reader = asyncio.create_task(flight.result(request))
+        await flight.wait_started()
+        await asyncio.sleep(0)
+
+        request.cancel()
+        with pytest.raises(RequestCancelledError):
+            await reader
+        # The only reader left, so the generation itself is stopped
+        await asyncio.sleep(0)
+        assert flight.task.cancelled()
+    run(scenario())
+
+def test_timeouts_are_capped_by_the_model_limit(monkeypatch):
+    monkeypatch.setenv('GENERATION_MODEL_TIMEOUT', 'small=30')
+    tracker = RequestTracker(default_timeout=600)
+
+    assert tracker.get_timeout("llama3") == 600
+    assert tracker.get_timeout("llama3", 10) == 10
+    assert tracker.get_timeout("small", 120) == 30
+    assert RequestTracker(default_timeout=0).get_timeout("llama3") is None
+
+def test_request_ids_must_be_unique():
+    async def scenario():
+        tracker = RequestTracker(default_timeout=0)
+        tracker.open("s1", "llama3", request_id="r1")
+        with pytest.raises(ValueError):
+            tracker.open("s2", "llama3", request_id="r1")
+    run(scenario())
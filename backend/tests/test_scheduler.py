@@ -0,0 +1,182 @@
+"""
+module: backend.tests.test_scheduler
+description: This module contains the tests of the InferenceScheduler class: slots, priority classes,
+fairness across sessions, cancellation of queued requests and backpressure.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import pytest
+
+from services.scheduler import InferenceScheduler, QueueFullError
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+async def hold(scheduler, order, session_id, priority='interactive', release=None, model='m'):
+    """
+    Takes a slot, records the order in which slots were granted and holds the slot until released.
+    """
+    async with scheduler.slot(model, session_id, priority):
+        order.append(session_id)
+        if release:
+            await release.wait()
+        else:
+            await asyncio.sleep(0)
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+def test_slots_limit_concurrent_generations():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=2)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, order, f"s{index}", release=release)) for index in range(4)]
+        await settle()
+        assert order == ["s0", "s1"]
+        assert scheduler.get_queue('m').depth == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert sorted(order) == ["s0", "s1", "s2", "s3"]
+        assert scheduler.get_queue('m').active == 0
+    run(scenario())
+
+def test_interactive_requests_go_before_batch():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=1)
+        order, release = [], asyncio.Event()
+        first = asyncio.create_task(hold(scheduler, order, "first", release=release))
+        await settle()
+        tasks = [
+            asyncio.create_task(hold(scheduler, order, "batch-1", 'batch')),
+            asyncio.create_task(hold(scheduler, order, "batch-2", 'batch')),
+        ]
+        await settle()
+        tasks.append(asyncio.create_task(hold(scheduler, order, "chat")))
+        await settle()
+        release.set()
+        await asyncio.gather(first, *tasks)
+        assert order == ["first", "chat", "batch-1", "batch-2"]
+    run(scenario())
+
+def test_batch_work_leaves_a_slot_for_chat():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=2)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, order, f"batch-{index}", 'batch', release)) for index in range(2)]
+        await settle()
+        assert order == ["batch-0"]
+        tasks.append(asyncio.create_task(hold(scheduler, order, "chat")))
+        await settle()
+        assert order == ["batch-0", "chat"]
+        release.set()
+        await asyncio.gather(*tasks)
+    run(scenario())
+
+def test_sessions_are_served_round_robin():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=1, max_session_queue=8)
+        order, release = [], asyncio.Event()
+        first = asyncio.create_task(hold(scheduler, order, "busy", release=release))
+        await settle()
+        # One session queues three turns before another session queues one
+        tasks = [asyncio.create_task(hold(scheduler, order, "a")) for _ in range(3)]
+        await settle()
+        tasks.append(asyncio.create_task(hold(scheduler, order, "b")))
+        await settle()
+        release.set()
+        await asyncio.gather(first, *tasks)
+        assert order == ["busy", "a", "b", "a", "a"]
+    run(scenario())
+
+def test_a_session_holds_one_slot_at_a_time():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=3)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, order, "summary:a", 'batch', release))]
+        await settle()
+        # A summary runs under its own key, so the turn of its session is not held back
+        tasks.append(asyncio.create_task(hold(scheduler, order, "a", release=release)))
+        await settle()
+        assert order == ["summary:a", "a"]
+        tasks.append(asyncio.create_task(hold(scheduler, order, "a", release=release)))
+        await settle()
+        # The second turn waits for the first although a slot is free
+        assert order == ["summary:a", "a"]
+        assert scheduler.get_queue('m').depth == 1
+        release.set()
+        await asyncio.gather(*tasks)
+    run(scenario())
+
+def test_cancelling_a_queued_request_frees_its_place():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=1)
+        order, release = [], asyncio.Event()
+        first = asyncio.create_task(hold(scheduler, order, "first", release=release))
+        await settle()
+        cancelled = asyncio.create_task(hold(scheduler, order, "cancelled"))
+        waiting = asyncio.create_task(hold(scheduler, order, "waiting"))
+        await settle()
+        assert scheduler.get_queue('m').depth == 2
+
+        cancelled.cancel()
+        await settle()
+        assert scheduler.get_queue('m').depth == 1
+
+        release.set()
+        await asyncio.gather(first, waiting)
+        assert cancelled.cancelled()
+        assert order == ["first", "waiting"]
+        queue = scheduler.get_queue('m')
+        assert (queue.active, queue.depth) == (0, 0)
+    run(scenario())
+
+def test_full_queues_reject_requests():
+    async def scenario():
+        scheduler = InferenceScheduler(default_slots=1, max_queue=2, max_session_queue=1)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, order, "first", release=release))]
+        await settle()
+        tasks.append(asyncio.create_task(hold(scheduler, order, "a")))
+        await settle()
+        # The session queue of a is full
+        with pytest.raises(QueueFullError):
+            await hold(scheduler, order, "a")
+        tasks.append(asyncio.create_task(hold(scheduler, order, "b")))
+        await settle()
+        # The model queue is full
+        with pytest.raises(QueueFullError) as error:
+            await hold(scheduler, order, "c")
+        assert error.value.retry_after >= 1
+        assert scheduler.get_queue('m').rejected == 2
+        release.set()
+        await asyncio.gather(*tasks)
+    run(scenario())
+
+def test_unknown_priorities_are_rejected():
+    with pytest.raises(ValueError):
+        run(InferenceScheduler().acquire('m', 's', 'urgent'))
+
+def test_slots_scale_with_healthy_backends():
+    async def scenario():
+        backends = [1]
+        scheduler = InferenceScheduler(default_slots=2, backend_count=lambda: backends[0])
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, order, f"s{index}", release=release)) for index in range(6)]
+        await settle()
+        assert len(order) == 2
+
+        backends[0] = 3
+        scheduler.get_queue('m')
+        await settle()
+        assert len(order) == 6
+        assert scheduler.get_queue('m').stats()["batch_slots"] == 5
+
+        release.set()
+        await asyncio.gather(*tasks)
+    run(scenario())
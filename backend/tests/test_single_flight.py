@@ -0,0 +1,126 @@
+"""
+module: backend.tests.test_single_flight
+description: This module contains the tests of the SingleFlight class, which coalesces identical generations.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+from services.single_flight import SingleFlight
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+def generator(calls, release, chunks=("Hel", "lo")):
+    """
+    Builds a generation that publishes its chunks once released.
+    """
+    async def generate(flight):
+        calls.append(flight.key)
+        flight.start()
+        await release.wait()
+        for chunk in chunks:
+            flight.publish(chunk)
+            await asyncio.sleep(0)
+        flight.finish({"eval_count": len(chunks)})
+    return generate
+
+def test_identical_requests_share_one_generation():
+    async def scenario():
+        single_flight = SingleFlight(enabled=True)
+        calls, release = [], asyncio.Event()
+        first = single_flight.join("key", generator(calls, release))
+        await first.wait_started()
+        second = single_flight.join("key", generator(calls, release))
+
+        assert second is first
+        release.set()
+        results = await asyncio.gather(first.result(), second.result())
+
+        assert results == ["Hello", "Hello"]
+        assert calls == ["key"]
+        assert single_flight.stats()["coalesced"] == 1
+        await asyncio.sleep(0)
+        assert single_flight.flights == {}
+    run(scenario())
+
+def test_late_requests_receive_earlier_tokens():
+    async def scenario():
+        single_flight = SingleFlight(enabled=True)
+        calls, release = [], asyncio.Event()
+        first = single_flight.join("key", generator(calls, release))
+        reader = asyncio.create_task(first.result())
+        release.set()
+        while not first.chunks:
+            await asyncio.sleep(0)
+
+        late = single_flight.join("key", generator(calls, release))
+
+        assert await late.result() == "Hello"
+        assert await reader == "Hello"
+    run(scenario())
+
+def test_different_keys_and_disabled_coalescing_start_their_own_generation():
+    async def scenario():
+        for enabled, keys in ((True, ("a", "b")), (False, ("a", "a"))):
+            single_flight = SingleFlight(enabled=enabled)
+            calls, release = [], asyncio.Event()
+            flights = [single_flight.join(key, generator(calls, release)) for key in keys]
+            release.set()
+            await asyncio.gather(*(flight.result() for flight in flights))
+            assert flights[0] is not flights[1]
+            assert len(calls) == 2
+    run(scenario())
+
+def test_the_generation_is_cancelled_when_the_last_request_detaches():
+    async def scenario():
+        single_flight = SingleFlight(enabled=True)
+        calls, release = [], asyncio.Event()
+        flight = single_flight.join("key", generator(calls, release))
+        second = single_flight.join("key", generator(calls, release))
+        await flight.wait_started()
+
+        flight.detach()
+        await asyncio.sleep(0)
+        assert not flight.task.cancelled()
+
+        second.detach()
+        await asyncio.sleep(0)
+        assert flight.task.cancelled()
+    run(scenario())
+
+def test_errors_reach_every_request():
+    async def scenario():
+        single_flight = SingleFlight(enabled=True)
+
+        async def fail(flight):
+            await asyncio.sleep(0)
+            flight.finish(error=RuntimeError("backend down"))
+
+        flights = [single_flight.join("key", fail) for _ in range(2)]
+        results = await asyncio.gather(*(flight.result() for flight in flights), return_exceptions=True)
+        assert [str(result) for result in results] == ["backend down", "backend down"]
+    run(scenario())
+
+def test_a_request_joining_as_the_last_one_detaches_starts_a_new_generation():
+    async def scenario():
+        single_flight = SingleFlight(enabled=True)
+        calls, release = [], asyncio.Event()
+        first = single_flight.join("key", generator(calls, release))
+        await first.wait_started()
+
+        # The last request leaves and another arrives in the same tick, before the cancelled task has ended
+        first.detach()
+        second = single_flight.join("key", generator(calls, release))
+
+        assert second is not first
+        release.set()
+        assert await second.result() == "Hello"
+        assert first.task.cancelled()
+        assert calls == ["key", "key"]
+        await asyncio.sleep(0)
+        assert single_flight.flights == {}
+    run(scenario())
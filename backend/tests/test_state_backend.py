@@ -0,0 +1,109 @@
+"""
+module: backend.tests.test_state_backend
+description: This module contains the tests of the state backends, against the in-process backend and
+against the stand-in Redis server of the benchmarks.
+author: Karim Garba
+date_created: 17-10-26
+date_modified: 17-10-26
+last_modified_by: Karim Garba
+version: 0.1
+"""
+import asyncio
+
+import pytest
+
+from benchmarks.mock_redis import start_server
+from services.state_backend import MemoryStateBackend, StateBackend, create_state_backend
+
+@pytest.fixture(params=["memory", "redis"])
+def backend_url(request):
+    if request.param == "memory":
+        yield ""
+        return
+    pytest.importorskip("redis")
+    server, url = start_server()
+    yield url
+    server.shutdown()
+    server.server_close()
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+def test_the_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        StateBackend()
+
+def test_memory_is_the_default_backend():
+    assert isinstance(create_state_backend(""), MemoryStateBackend)
+    with pytest.raises(ValueError):
+        create_state_backend("etcd://localhost")
+
+def test_values_and_counters(backend_url):
+    async def scenario():
+        state = create_state_backend(backend_url)
+        try:
+            assert await state.get("model") is None
+            await state.set("model", "llama3")
+            assert await state.get("model") == "llama3"
+            assert await state.incr("version") == 1
+            assert await state.incr("version") == 2
+        finally:
+            await state.close()
+    run(scenario())
+
+def test_leases_limit_concurrent_holders(backend_url):
+    async def scenario():
+        state = create_state_backend(backend_url)
+        state.poll_interval = 0.001
+        holders = peak = 0
+
+        async def hold():
+            nonlocal holders, peak
+            async with state.lease("slots:m", 2) as token:
+                assert token
+                holders += 1
+                peak = max(peak, holders)
+                await asyncio.sleep(0.01)
+                holders -= 1
+
+        try:
+            await asyncio.gather(*(hold() for _ in range(8)))
+            assert peak == 2
+            await asyncio.sleep(0.05)
+            assert await state.acquire_lease("slots:m", 2, 1) is not None
+        finally:
+            await state.close()
+    run(scenario())
+
+def test_leases_without_waiting(backend_url):
+    async def scenario():
+        state = create_state_backend(backend_url)
+        try:
+            async with state.lease("maintenance", 1, wait=False) as first:
+                async with state.lease("maintenance", 1, wait=False) as second:
+                    assert first is not None
+                    assert second is None
+        finally:
+            await state.close()
+    run(scenario())
+
+def test_expired_leases_free_their_slot():
+    pytest.importorskip("redis")
+    server, url = start_server()
+
+    async def scenario():
+        state = create_state_backend(url)
+        try:
+            # A worker that crashed while holding the only slot
+            assert await state.acquire_lease("slots:m", 1, 0.05)
+            assert await state.acquire_lease("slots:m", 1, 0.05) is None
+            await asyncio.sleep(0.1)
+            assert await state.acquire_lease("slots:m", 1, 0.05)
+        finally:
+            await state.close()
+
+    try:
+        run(scenario())
+    finally:
+        server.shutdown()
+        server.server_close()